@@ -0,0 +1,188 @@
+'''
+Bulk writing of new datasets, used by the `bulk_load` mode of the harvesters.
+
+The package dicts of a batch are validated one after the other against the
+package create schema and the valid ones are then written with a handful of
+multi-row INSERTs (packages, resources, extras, tags and group memberships)
+instead of one package_create call each. This skips what package_create does
+on top of writing the rows: plugin hooks, activities and search indexing,
+which is left to the caller.
+'''
+import datetime
+
+from ckan import model
+from ckan.model import Session
+from ckan.lib.navl.dictization_functions import validate, ignore
+from ckan.lib.plugins import lookup_package_plugin
+from ckan.logic.validators import ignore_missing
+from ckan.lib.navl.validators import unicode_safe
+
+from ckanext.toscana_harvest.model import advisory_lock, commit, \
+    in_own_transaction
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def to_package_show_form(package_dict):
+    '''
+    Converts a package dict in the legacy REST form (extras as a dict, tags
+    and groups as lists of names) to the form of package_show.
+    '''
+    package_dict = dict(package_dict)
+    extras = package_dict.get('extras')
+    if isinstance(extras, dict):
+        package_dict['extras'] = [{'key': key, 'value': value}
+                                  for key, value in extras.items()]
+    package_dict['tags'] = [tag if isinstance(tag, dict) else {'name': tag}
+                            for tag in package_dict.get('tags') or []]
+    package_dict['groups'] = [group if isinstance(group, dict)
+                              else {'name': group}
+                              for group in package_dict.get('groups') or []]
+    return package_dict
+
+
+def validate_packages(package_dicts, context):
+    '''
+    Validates package dicts in the package_show form against the create
+    schema of their type. Returns a list with (data, errors) for each one.
+    '''
+    schemas = {}
+    results = []
+    for package_dict in package_dicts:
+        package_type = package_dict.get('type') or 'dataset'
+        if package_type not in schemas:
+            schema = lookup_package_plugin(package_type) \
+                .create_package_schema()
+            schema['id'] = [ignore_missing, unicode_safe]
+            schema['__junk'] = [ignore]
+            schemas[package_type] = schema
+        results.append(validate(package_dict, schemas[package_type],
+                                dict(context, schema=schemas[package_type])))
+    return results
+
+
+def _columns(table, data):
+    # Every row of a multi-row INSERT needs the same columns
+    return dict((column.name, data.get(column.name)) for column in table.c)
+
+
+def _query_tag_ids(names):
+    return dict(Session.query(model.Tag.name, model.Tag.id)
+                .filter(model.Tag.name.in_(names))
+                .filter(model.Tag.vocabulary_id == None))
+
+
+def _create_tags(names):
+    # Free tags have no vocabulary, which the unique constraint of the tag
+    # table does not cover, so batches running at the same time take turns
+    with advisory_lock(*['tag:%s' % name for name in names]):
+        tag_ids = _query_tag_ids(names)
+        new_tags = [{'id': model.types.make_uuid(), 'name': name}
+                    for name in names if name not in tag_ids]
+        if new_tags:
+            Session.execute(model.tag_table.insert(), new_tags)
+            tag_ids.update((tag['name'], tag['id']) for tag in new_tags)
+        commit()
+    return tag_ids
+
+
+def _get_tag_ids(names):
+    tag_ids = _query_tag_ids(names)
+    missing = set(names) - set(tag_ids)
+    if missing:
+        # Created and committed on their own, so the locks are not held
+        # until the batch commits
+        tag_ids.update(in_own_transaction(_create_tags, missing))
+    return tag_ids
+
+
+def _get_group_ids(refs):
+    groups = Session.query(model.Group.id, model.Group.name) \
+        .filter(model.Group.id.in_(refs) | model.Group.name.in_(refs)) \
+        .filter(model.Group.state == 'active')
+    group_ids = {}
+    for group_id, name in groups:
+        group_ids[group_id] = group_ids[name] = group_id
+    return group_ids
+
+
+def write_packages(data_dicts, user_id):
+    '''
+    Inserts validated package dicts of new datasets, with their resources,
+    extras, tags and group and organization memberships, in the current
+    transaction. Groups and organizations must exist already.
+    '''
+    now = datetime.datetime.utcnow()
+    packages, resources, extras, package_tags, members = [], [], [], [], []
+
+    tag_ids = _get_tag_ids(set(
+        tag['name'] for data in data_dicts for tag in data.get('tags', [])
+        if not tag.get('vocabulary_id')))
+    group_ids = _get_group_ids(set(
+        group.get('id') or group.get('name')
+        for data in data_dicts for group in data.get('groups', [])))
+
+    for data in data_dicts:
+        package = _columns(model.package_table, data)
+        package.update({
+            'type': data.get('type') or 'dataset',
+            'state': 'active',
+            'private': data.get('private', False),
+            'creator_user_id': user_id,
+            'metadata_created': now,
+            'metadata_modified': now,
+        })
+        packages.append(package)
+        package_id = package['id']
+
+        for position, resource_dict in enumerate(data.get('resources', [])):
+            resource = _columns(model.resource_table, resource_dict)
+            resource_extras = dict(
+                (key, value) for key, value in resource_dict.items()
+                if key not in model.resource_table.c)
+            resource.update({
+                'id': resource_dict.get('id') or model.types.make_uuid(),
+                'package_id': package_id,
+                'position': position,
+                'state': 'active',
+                'created': now,
+                'extras': resource_extras or None,
+            })
+            resources.append(resource)
+
+        for extra in data.get('extras', []):
+            extras.append({'id': model.types.make_uuid(),
+                           'package_id': package_id, 'key': extra['key'],
+                           'value': extra['value'], 'state': 'active'})
+
+        for tag in data.get('tags', []):
+            if tag['name'] in tag_ids and not tag.get('vocabulary_id'):
+                package_tags.append({'id': model.types.make_uuid(),
+                                     'package_id': package_id,
+                                     'tag_id': tag_ids[tag['name']],
+                                     'state': 'active'})
+
+        memberships = [(group_ids.get(group.get('id') or group.get('name')),
+                        'public') for group in data.get('groups', [])]
+        if data.get('owner_org'):
+            memberships.append((data['owner_org'], 'organization'))
+        for group_id, capacity in memberships:
+            if group_id:
+                members.append({'id': model.types.make_uuid(),
+                                'table_id': package_id,
+                                'table_name': 'package',
+                                'group_id': group_id,
+                                'capacity': capacity,
+                                'state': 'active'})
+
+    for table, rows in ((model.package_table, packages),
+                        (model.resource_table, resources),
+                        (model.package_extra_table, extras),
+                        (model.package_tag_table, package_tags),
+                        (model.member_table, members)):
+        if rows:
+            Session.execute(table.insert(), rows)
+    log.info('Bulk inserted %d packages, %d resources, %d extras, %d tags '
+             'and %d memberships', len(packages), len(resources), len(extras),
+             len(package_tags), len(members))
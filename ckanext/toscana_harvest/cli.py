@@ -0,0 +1,470 @@
+import datetime
+import multiprocessing
+import threading
+import time
+
+import click
+
+from ckan import model
+from ckan.model import Session
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestGatherError, HarvestJob, \
+    HarvestObject, HarvestObjectError, HarvestSource
+from ckanext.harvest.queue import get_harvester, gather_stage
+from ckanext.toscana_harvest.harvesters.base import order_by_priority, \
+    delete_job_states
+from ckanext.toscana_harvest import mirror, pipeline, transport
+from ckanext.toscana_harvest.indexing import reindex_job, reindex_finished_jobs
+from ckanext.toscana_harvest.linkcheck import check_job_links, \
+    enqueue_link_checks
+
+
+def get_commands():
+    return [toscana_harvest]
+
+
+@click.group(u'toscana_harvest', short_help=u'Toscana harvest commands')
+def toscana_harvest():
+    pass
+
+
+def _get_source(source_id_or_name):
+    source = HarvestSource.get(source_id_or_name)
+    if not source:
+        # Harvest sources share their id with the harvest source dataset
+        package = model.Package.get(source_id_or_name)
+        source = package and HarvestSource.get(package.id)
+    if not source:
+        raise click.ClickException(
+            u'Harvest source not found: %s' % source_id_or_name)
+    return source
+
+
+def _get_harvester(source):
+    harvester = get_harvester(source.type)
+    if not harvester:
+        raise click.ClickException(
+            u'No harvester found for source type %s' % source.type)
+    harvester._set_config(source.config)
+    return harvester
+
+
+def _get_running_job(source):
+    job = Session.query(HarvestJob) \
+        .filter(HarvestJob.source_id == source.id) \
+        .filter(HarvestJob.status == u'Running') \
+        .order_by(HarvestJob.created.desc()) \
+        .first()
+    if not job:
+        raise click.ClickException(
+            u'No running job for source %s' % source.id)
+    return job
+
+
+def _waiting_object_ids(job_id):
+    return [id_ for (id_,) in order_by_priority(
+                Session.query(HarvestObject.id)
+                .filter(HarvestObject.harvest_job_id == job_id)
+                .filter(HarvestObject.state == u'WAITING'))]
+
+
+@toscana_harvest.command(u'import-batch')
+@click.argument(u'source')
+@click.option(u'--batch-size', type=int, default=None,
+              help=u'Harvest objects imported per transaction '
+                   u'(defaults to the import_batch_size of the source)')
+def import_batch(source, batch_size):
+    u'''Fetch and import the waiting objects of the running job of SOURCE
+    in batches, reporting the import throughput.
+
+    Run it with the fetch consumer stopped, otherwise both will pick up the
+    same objects.
+    '''
+    source = _get_source(source)
+    harvester = _get_harvester(source)
+    job = _get_running_job(source)
+    batch_size = batch_size or harvester.get_import_batch_size()
+
+    object_ids = _waiting_object_ids(job.id)
+    click.echo(u'%d objects waiting in job %s' % (len(object_ids), job.id))
+
+    started = time.time()
+    imported = 0
+    for i in range(0, len(object_ids), batch_size):
+        harvest_objects = Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(object_ids[i:i + batch_size])) \
+            .all()
+        imported += harvester.fetch_and_import_batch(harvest_objects)
+        done = min(i + batch_size, len(object_ids))
+        elapsed = time.time() - started
+        click.echo(u'%d/%d objects processed, %.1f objects/s' %
+                   (done, len(object_ids), done / elapsed if elapsed else 0))
+
+    elapsed = time.time() - started
+    click.secho(u'Imported %d of %d objects in %.2fs (batch size %d)' %
+                (imported, len(object_ids), elapsed, batch_size), fg=u'green')
+
+
+@toscana_harvest.command(u'reindex')
+@click.argument(u'job_id', required=False)
+def reindex(job_id):
+    u'''Reindex the packages whose indexing was deferred by JOB_ID, or by
+    every finished job if no job is given.
+    '''
+    if not job_id:
+        reindex_finished_jobs()
+        return
+
+    with click.progressbar(length=0, label=u'Reindexing') as bar:
+        def progress(done, total):
+            bar.length = total
+            bar.update(done - bar.pos)
+        count = reindex_job(job_id, progress)
+    click.secho(u'Reindexed %d packages' % count, fg=u'green')
+
+
+def _init_worker():
+    # The forked worker must not share the database or HTTP connections of
+    # the parent process
+    Session.remove()
+    model.meta.engine.dispose()
+    transport.reset()
+
+
+def _fetch_and_import_objects(source_id, object_ids):
+    source = HarvestSource.get(source_id)
+    harvester = _get_harvester(source)
+    harvest_objects = Session.query(HarvestObject) \
+        .filter(HarvestObject.id.in_(object_ids)) \
+        .all()
+    return harvester.fetch_and_import_batch(harvest_objects)
+
+
+def _fail_objects(object_ids, message):
+    # Objects of a failed batch that were not finished are flagged as
+    # errored, so the job can finish
+    harvest_objects = Session.query(HarvestObject) \
+        .filter(HarvestObject.id.in_(object_ids)) \
+        .filter(~HarvestObject.state.in_([u'COMPLETE', u'ERROR']))
+    for harvest_object in harvest_objects:
+        HarvestObjectError(message=message, object=harvest_object,
+                           stage=u'Import').save()
+        harvest_object.state = u'ERROR'
+        harvest_object.report_status = u'errored'
+        harvest_object.import_finished = datetime.datetime.utcnow()
+        harvest_object.save()
+
+
+def _fetch_and_import(args):
+    source_id, object_ids = args
+    try:
+        return len(object_ids), _fetch_and_import_objects(source_id,
+                                                          object_ids)
+    except Exception as e:
+        # The other batches go on
+        Session.rollback()
+        click.secho(u'Fetching and importing a batch failed: %r' % e,
+                    fg=u'red')
+        _fail_objects(object_ids, u'Fetching and importing the batch '
+                                  u'failed: %r' % e)
+        return len(object_ids), 0
+    finally:
+        Session.remove()
+
+
+def _get_context():
+    site_user = toolkit.get_action(u'get_site_user')(
+        {u'model': model, u'ignore_auth': True}, {})
+    return {u'model': model, u'session': Session, u'ignore_auth': True,
+            u'user': site_user[u'name']}
+
+
+def _create_job(source, context):
+    try:
+        job = toolkit.get_action(u'harvest_job_create')(
+            dict(context), {u'source_id': source.id, u'run': False})
+    except Exception as e:
+        raise click.ClickException(u'Could not create a job: %s' % e)
+    job = HarvestJob.get(job[u'id'])
+    job.status = u'Running'
+    job.save()
+    return job
+
+
+def _finish_job(job_id, source_id, context):
+    # Finish the job the way harvest_jobs_run would
+    job = HarvestJob.get(job_id)
+    last_object = Session.query(HarvestObject) \
+        .filter(HarvestObject.harvest_job_id == job_id) \
+        .filter(HarvestObject.import_finished != None) \
+        .order_by(HarvestObject.import_finished.desc()) \
+        .first()
+    job.status = u'Finished'
+    job.finished = last_object.import_finished if last_object \
+        else datetime.datetime.utcnow()
+    job.save()
+    reindex_job(job_id)
+    toolkit.get_action(u'harvest_source_reindex')(
+        dict(context), {u'id': source_id})
+    enqueue_link_checks([job_id])
+    delete_job_states([job_id])
+
+
+@toscana_harvest.command(u'run')
+@click.argument(u'source')
+@click.option(u'--workers', type=int, default=None,
+              help=u'Fetch and import processes (defaults to the number of '
+                   u'CPUs)')
+@click.option(u'--batch-size', type=int, default=None,
+              help=u'Harvest objects fetched and imported per transaction '
+                   u'(defaults to the import_batch_size of the source)')
+def run(source, workers, batch_size):
+    u'''Harvest SOURCE without the harvest queues: gather in this process
+    and fetch and import the harvest objects in batches in a pool of worker
+    processes while the gather goes on, reporting the throughput.
+
+    The job is created and finished here, so no gather or fetch consumer
+    (nor Redis or RabbitMQ) is needed.
+    '''
+    source = _get_source(source)
+    harvester = _get_harvester(source)
+    workers = workers or multiprocessing.cpu_count()
+    batch_size = batch_size or harvester.get_import_batch_size()
+    # The gathered objects are handed to the pool here, in batches as gather
+    # creates them, not to the fetch queue
+    handoff = pipeline.BatchHandoff(batch_size)
+    harvester.fetch_handoff = handoff
+    context = _get_context()
+    job = _create_job(source, context)
+    job_id, source_id = job.id, source.id
+
+    # The workers are forked before the gather thread opens connections
+    Session.remove()
+    model.meta.engine.dispose()
+    pool = multiprocessing.get_context(u'fork').Pool(
+        workers, initializer=_init_worker)
+
+    gathered = {}
+
+    def gather():
+        started = time.time()
+        object_ids = None
+        try:
+            job = HarvestJob.get(job_id)
+            job.gather_started = datetime.datetime.utcnow()
+            try:
+                # Not ckanext.harvest.queue.gather_stage, which deletes all
+                # the objects of the job when the harvester raises, even the
+                # ones handed to the workers already
+                object_ids = harvester.gather_stage(job)
+            except Exception as e:
+                Session.rollback()
+                HarvestGatherError.create(message=u'%r' % e, job=job)
+                click.secho(u'Gather failed: %r' % e, fg=u'red')
+                # The objects created before the failure go through
+                object_ids = _waiting_object_ids(job_id)
+            job.gather_finished = datetime.datetime.utcnow()
+            job.save()
+        except Exception as e:
+            click.secho(u'Gather failed: %r' % e, fg=u'red')
+        finally:
+            if not isinstance(object_ids, list):
+                object_ids = []
+            handoff.finish(object_ids)
+            gathered[u'count'] = len(handoff.published)
+            click.echo(u'Gathered %d objects in %.2fs' %
+                       (gathered[u'count'], time.time() - started))
+            Session.remove()
+
+    def batches():
+        while True:
+            object_ids = handoff.batches.get()
+            if object_ids is None:
+                return
+            yield source_id, object_ids
+
+    started = time.time()
+    gather_thread = threading.Thread(target=gather)
+    gather_thread.start()
+    done = imported = 0
+    try:
+        # Batches are handed out in the order gather created the objects
+        for count, batch_imported in pool.imap_unordered(_fetch_and_import,
+                                                         batches()):
+            done += count
+            imported += batch_imported
+            elapsed = time.time() - started
+            click.echo(u'%d objects processed, %.1f objects/s' %
+                       (done, done / elapsed if elapsed else 0))
+    finally:
+        gather_thread.join()
+        pool.close()
+        pool.join()
+        # Whatever happened, the job does not stay Running
+        _finish_job(job_id, source_id, context)
+
+    elapsed = time.time() - started
+    click.secho(u'Imported %d of %d objects in %.2fs with %d workers '
+                u'(batch size %d)' % (imported, gathered.get(u'count', 0),
+                                      elapsed, workers, batch_size),
+                fg=u'green')
+
+
+@toscana_harvest.command(u'run-many')
+@click.argument(u'sources', nargs=-1, required=True)
+@click.option(u'--interleave', is_flag=True,
+              help=u'Fetch and import one batch of each source in turn '
+                   u'instead of one source after the other')
+@click.option(u'--batch-size', type=int, default=None,
+              help=u'Harvest objects fetched and imported per transaction '
+                   u'(defaults to the import_batch_size of each source)')
+def run_many(sources, interleave, batch_size):
+    u'''Harvest all of SOURCES in this process without the harvest
+    queues, for lots of small sources that would each pay for starting a
+    job of their own.
+
+    The sources are gathered one after the other, then their harvest
+    objects are fetched and imported in batches, source after source or in
+    turn with --interleave. Each source gets its own job and errors, while
+    the HTTP connections, the database connection and the harvesters (with
+    what they have looked up) are shared by all of them.
+    '''
+    sources = [_get_source(source) for source in sources]
+    context = _get_context()
+    started = time.time()
+
+    runs = []
+    for source in sources:
+        harvester = _get_harvester(source)
+        harvester.publish_during_gather = False
+        try:
+            job = _create_job(source, context)
+        except click.ClickException as e:
+            click.secho(u'%s: %s' % (source.url, e.message), fg=u'red')
+            continue
+        gather_started = time.time()
+        try:
+            object_ids = gather_stage(harvester, job)
+        except Exception as e:
+            # Record it on the job of the source and go on with the others
+            Session.rollback()
+            HarvestGatherError.create(message=u'%r' % e, job=job)
+            object_ids = None
+        if not isinstance(object_ids, list):
+            object_ids = []
+        size = batch_size or harvester.get_import_batch_size()
+        runs.append({
+            u'source_id': source.id,
+            u'job_id': job.id,
+            u'url': source.url,
+            u'total': len(object_ids),
+            u'imported': 0,
+            u'batches': [object_ids[i:i + size]
+                         for i in range(0, len(object_ids), size)],
+        })
+        click.echo(u'%s: gathered %d objects in %.2fs' %
+                   (source.url, len(object_ids),
+                    time.time() - gather_started))
+
+    def process_batch(run):
+        object_ids = run[u'batches'].pop(0)
+        try:
+            run[u'imported'] += _fetch_and_import_objects(run[u'source_id'],
+                                                          object_ids)
+        except Exception as e:
+            Session.rollback()
+            click.secho(u'%s: fetching and importing a batch failed: %r' %
+                        (run[u'url'], e), fg=u'red')
+            _fail_objects(object_ids, u'Fetching and importing the batch '
+                                      u'failed: %r' % e)
+        if not run[u'batches']:
+            _finish_job(run[u'job_id'], run[u'source_id'], context)
+            click.echo(u'%s: imported %d of %d objects' %
+                       (run[u'url'], run[u'imported'], run[u'total']))
+
+    for run in runs:
+        if not run[u'batches']:
+            _finish_job(run[u'job_id'], run[u'source_id'], context)
+    if interleave:
+        while any(run[u'batches'] for run in runs):
+            for run in runs:
+                if run[u'batches']:
+                    process_batch(run)
+    else:
+        for run in runs:
+            while run[u'batches']:
+                process_batch(run)
+
+    click.secho(u'Harvested %d sources, imported %d of %d objects in %.2fs' %
+                (len(runs), sum(run[u'imported'] for run in runs),
+                 sum(run[u'total'] for run in runs), time.time() - started),
+                fg=u'green')
+
+
+@toscana_harvest.command(u'check-links')
+@click.argument(u'job_id')
+def check_links(job_id):
+    u'''Check the resource URLs of the datasets added or updated by JOB_ID
+    now, instead of in a background job.
+    '''
+    check_job_links(job_id)
+
+
+@toscana_harvest.command(u'mirror-report')
+@click.argument(u'source')
+@click.option(u'--list-missing', is_flag=True,
+              help=u'List the datasets that have gone from the remote')
+def mirror_report(source, list_missing):
+    u'''Report what the mirror index knows about the remote catalogue of
+    SOURCE.
+    '''
+    source = _get_source(source)
+    report = mirror.report(source.id)
+    click.echo(u'%d remote datasets listed, %d imported' %
+               (report[u'total'], report[u'imported']))
+    if not report[u'full_listing_job_id']:
+        click.echo(u'The remote catalogue has not been listed in full yet')
+        return
+    click.echo(u'%d gone from the remote since the full listing of job %s' %
+               (len(report[u'missing']), report[u'full_listing_job_id']))
+    if list_missing:
+        for remote_id, name, package_id in report[u'missing']:
+            click.echo(u'%s\t%s\t%s' % (remote_id, name or u'',
+                                        package_id or u''))
+
+
+@toscana_harvest.command(u'benchmark-adapter')
+@click.argument(u'source')
+@click.option(u'--sample', type=int, default=50,
+              help=u'Datasets fetched, taken from those already harvested')
+def benchmark_adapter(source, sample):
+    u'''Fetch a sample of the datasets of SOURCE and time each step its
+    source adapter takes them through, without importing them.
+    '''
+    source = _get_source(source)
+    harvester = _get_harvester(source)
+    if not getattr(harvester, u'adapter_class', None):
+        raise click.ClickException(
+            u'The %s harvester has no source adapter' % source.type)
+    guids = [guid for (guid,) in Session.query(HarvestObject.guid)
+             .filter(HarvestObject.harvest_source_id == source.id)
+             .filter(HarvestObject.current == True)
+             .limit(sample)]
+    if not guids:
+        raise click.ClickException(
+            u'Source %s has no harvested datasets to sample' % source.id)
+
+    stats = harvester.benchmark_adapter(source.url.rstrip(u'/'), guids)
+    click.echo(u'%s adapter, %d datasets, %d failed' %
+               (harvester.adapter.name, stats[u'datasets'], stats[u'errors']))
+    if not stats[u'datasets']:
+        return
+    for step in (u'fetch', u'project', u'parse', u'clean'):
+        click.echo(u'%-8s %8.2fs %8.2fms/dataset' %
+                   (step, stats[step],
+                    1000 * stats[step] / stats[u'datasets']))
+    click.echo(u'%d bytes fetched, %d stored (%.0f%%)' %
+               (stats[u'fetched_bytes'], stats[u'stored_bytes'],
+                100.0 * stats[u'stored_bytes'] / stats[u'fetched_bytes']
+                if stats[u'fetched_bytes'] else 0))
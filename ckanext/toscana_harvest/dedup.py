@@ -0,0 +1,74 @@
+'''
+Cross-source duplicate detection.
+
+Sources that harvest the same datasets, eg. a Spod and a Metarepo source for
+the same Tuscan catalogue, can be given a `dedup` configuration:
+
+    "dedup": {"key": "name", "priority": 10}
+
+`key` says what identifies a dataset across sources: "id", "name" or
+"extra:<extra key>". Every dataset a source gathers or imports is claimed for
+it in an identity index (toscana_harvest_identity), unless another active
+source with the same or a higher priority owns it already. Gather drops the
+datasets owned by another source before they are fetched, and import skips
+them.
+
+When the key is not known at gather time (the Spod package list only has
+ids) the identity recorded by the last import of the dataset is used, so such
+duplicates are dropped at gather from the second harvest on.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+KEYS = ('id', 'name')
+EXTRA_PREFIX = 'extra:'
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('dedup must be a dictionary')
+    key = value.get('key', 'id')
+    if key not in KEYS and not (
+            isinstance(key, str) and key.startswith(EXTRA_PREFIX) and
+            len(key) > len(EXTRA_PREFIX)):
+        raise ValueError('dedup key must be one of %s or extra:<key>' %
+                         ', '.join(KEYS))
+    try:
+        int(value.get('priority', 0))
+    except (TypeError, ValueError):
+        raise ValueError('dedup priority must be an integer')
+
+
+def settings(config):
+    '''
+    Returns (key, priority), or None if the source does not deduplicate.
+    '''
+    dedup = (config or {}).get('dedup')
+    if dedup is None:
+        return None
+    return dedup.get('key', 'id'), int(dedup.get('priority', 0))
+
+
+def dataset_identity(key, pkg_dict=None, guid=None):
+    '''
+    Returns the normalized identity of a dataset, or None if it can not be
+    worked out from what is given. Both the REST (extras as a dict) and the
+    action API (extras as a list) forms of a dataset are accepted.
+    '''
+    if key == 'id' and guid is not None:
+        value = guid
+    elif pkg_dict is None:
+        return None
+    elif key.startswith(EXTRA_PREFIX):
+        extra_key = key[len(EXTRA_PREFIX):]
+        extras = pkg_dict.get('extras') or {}
+        if isinstance(extras, dict):
+            value = extras.get(extra_key)
+        else:
+            value = next((extra.get('value') for extra in extras
+                          if extra.get('key') == extra_key), None)
+    else:
+        value = pkg_dict.get(key)
+    if value is None or not ('%s' % value).strip():
+        return None
+    return '%s:%s' % (key, ('%s' % value).strip().lower())
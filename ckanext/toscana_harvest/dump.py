@@ -0,0 +1,177 @@
+'''
+Harvesting from a bulk dump of the remote catalogue.
+
+Instead of searching the remote portal and fetching its datasets one by one,
+a source can point to a dump of the whole catalogue:
+
+    "dump": {"url": "https://dati.example.it/catalogue.jsonl.gz",
+             "format": "jsonl", "sha256": "<expected checksum, optional>"}
+
+`jsonl` dumps have one dataset per line, as returned by package_show.
+`dcat` dumps are RDF catalogs, parsed with ckanext-dcat, which then has to
+be installed. Their datasets have no id, so one is derived from their `uri`
+(or `identifier`) extra, as the ckanext-dcat harvester does for its guids,
+and their name is made from the title. Dumps can be gzipped.
+
+The dump is downloaded once per job and streamed into harvest objects that
+already have their content, so the fetch stage has nothing to do. Its ETag,
+size and checksum are kept, and when the dump has not changed since the last
+job that ingested it without errors the whole job is skipped.
+'''
+import gzip
+import hashlib
+import os
+import tempfile
+import uuid
+
+import requests
+import urllib3
+
+from ckan.lib.helpers import json
+from ckan.lib.munge import munge_title_to_name
+
+from ckanext.toscana_harvest import transport
+
+import logging
+log = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'dcat')
+CHUNK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class DumpError(Exception):
+    pass
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('dump must be a dictionary')
+    if not isinstance(value.get('url'), str) or not value['url']:
+        raise ValueError('dump url is required')
+    if value.get('format', 'jsonl') not in FORMATS:
+        raise ValueError('dump format must be one of %s' % ', '.join(FORMATS))
+    if value.get('format') == 'dcat':
+        try:
+            import ckanext.dcat.processors  # noqa: F401
+        except ImportError:
+            raise ValueError('dump format dcat needs ckanext-dcat')
+
+
+def download(url, previous=None, api_key=None, timeouts=None):
+    '''
+    Downloads a dump to a temporary file.
+
+    `previous` is the dict returned for the last dump ingested and
+    `timeouts` the request timeouts (see ckanext.toscana_harvest.timeouts).
+    Returns the path of the file and a dict with the 'etag', 'size' and
+    'sha256' of the dump, or None and `previous` if the dump has not
+    changed.
+    '''
+    previous = previous or {}
+    headers = {}
+    if api_key:
+        headers['Authorization'] = api_key
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+
+    try:
+        response = transport.open_url(url, headers, timeouts)
+    except requests.HTTPError as e:
+        raise DumpError('HTTP error downloading dump %s: %s' %
+                        (url, e.response.status_code))
+    except requests.RequestException as e:
+        raise DumpError('Error downloading dump %s: %s' % (url, e))
+    if response.status_code == 304:
+        response.close()
+        return None, previous
+
+    checksum = hashlib.sha256()
+    size = 0
+    f = tempfile.NamedTemporaryFile(prefix='toscana-harvest-dump-',
+                                    delete=False)
+    try:
+        with f:
+            # The dump is stored as sent, gzipped or not
+            for chunk in response.raw.stream(CHUNK_SIZE,
+                                             decode_content=False):
+                checksum.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except (requests.RequestException, urllib3.exceptions.HTTPError,
+            IOError) as e:
+        os.remove(f.name)
+        raise DumpError('Error downloading dump %s: %s' % (url, e))
+    finally:
+        response.close()
+
+    current = {'etag': response.headers.get('ETag'), 'size': size,
+               'sha256': checksum.hexdigest()}
+    log.info('Downloaded dump %s: %d bytes, sha256 %s', url, size,
+             current['sha256'])
+    if current['sha256'] == previous.get('sha256') and \
+            size == previous.get('size'):
+        os.remove(f.name)
+        return None, dict(previous, etag=current['etag'])
+    return f.name, current
+
+
+def _open(path, mode='rt'):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _dcat_guid(dataset):
+    extras = dict((extra['key'], extra['value'])
+                  for extra in dataset.get('extras') or [])
+    for key in ('uri', 'identifier', 'dcat_identifier'):
+        if extras.get(key):
+            return extras[key]
+    return dataset.get('name')
+
+
+def _identify_dcat_dataset(dataset):
+    '''
+    Gives a dataset parsed from RDF the id and name it lacks, or returns
+    None if there is nothing to identify it by.
+    '''
+    guid = _dcat_guid(dataset)
+    if not guid:
+        log.warning('Skipping dataset of the dump without uri or identifier: '
+                    '%s', dataset.get('title'))
+        return None
+    # The same remote dataset gets the same id on every harvest
+    dataset.setdefault('id', str(uuid.uuid5(uuid.NAMESPACE_URL, guid)))
+    if not dataset.get('name') and dataset.get('title'):
+        dataset['name'] = munge_title_to_name(dataset['title'])
+    return dataset
+
+
+def iter_datasets(path, format='jsonl'):
+    '''
+    Yields the dataset dicts of a dump file, one at a time for JSONL dumps.
+    '''
+    if format == 'dcat':
+        from ckanext.dcat.processors import RDFParser
+        parser = RDFParser()
+        with _open(path, 'rb') as f:
+            parser.parse(f.read())
+        for dataset in parser.datasets():
+            dataset = _identify_dcat_dataset(dataset)
+            if dataset:
+                yield dataset
+        return
+
+    with _open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise DumpError('Invalid JSON on line %d of the dump: %s' %
+                                (number, e))
@@ -0,0 +1,210 @@
+'''
+Dataset filter expressions.
+
+The `filter` key of the source configuration selects which remote datasets
+are harvested with a Python-like expression, eg.
+
+    "filter": "license_id in ['cc-by', 'cc-zero'] and 'csv' in formats and not matches(title, 'test')"
+
+The names that can be used are:
+
+    name, title, notes, license_id, organization, private, metadata_modified,
+    num_resources, tags, groups, formats (of the resources, lower case) and
+    extras.<key>
+
+together with `and`, `or`, `not`, comparisons, `in`, lists, strings and
+numbers, and the functions matches(value, regex), lower(value) and
+len(value). Anything else is rejected by validate_config.
+
+Expressions are compiled once per process. Gather evaluates them against
+the remote datasets it lists, so the excluded ones are never fetched, and
+the parts of the expression that map onto remote search fields are also
+sent to the remote searches as `fq` terms.
+'''
+import ast
+import re
+
+import logging
+log = logging.getLogger(__name__)
+
+FIELDS = ('name', 'title', 'notes', 'license_id', 'organization', 'private',
+          'metadata_modified', 'num_resources', 'tags', 'groups', 'formats',
+          'extras')
+
+FUNCTIONS = {
+    'matches': lambda value, pattern: value is not None and
+    re.search(pattern, '%s' % value, re.IGNORECASE) is not None,
+    'lower': lambda value: ('%s' % value).lower() if value is not None
+    else None,
+    'len': lambda value: len(value) if value is not None else 0,
+}
+
+ALLOWED_NODES = tuple(
+    getattr(ast, node) for node in (
+        'Expression', 'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'Compare',
+        'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Name',
+        'Load', 'Constant', 'Str', 'Num', 'NameConstant', 'List', 'Tuple',
+        'Call', 'Attribute')
+    if hasattr(ast, node))
+
+# Fields that can be sent to a remote CKAN based search as fq terms
+SOLR_FIELDS = {
+    'name': 'name',
+    'license_id': 'license_id',
+    'organization': 'organization',
+    'tags': 'tags',
+    'groups': 'groups',
+    'formats': 'res_format',
+}
+LIST_FIELDS = ('tags', 'groups', 'formats')
+
+_compiled = {}
+
+
+class _Extras(dict):
+    def __getattr__(self, key):
+        return self.get(key)
+
+
+def _parse(expression):
+    if not isinstance(expression, str) or not expression.strip():
+        raise ValueError('filter must be a non empty string')
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('filter is not a valid expression: %s' % e.msg)
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError('filter can not contain %s' %
+                             type(node).__name__)
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or \
+                    node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError('filter can only call %s' %
+                                 ', '.join(sorted(FUNCTIONS)))
+        elif isinstance(node, ast.Attribute):
+            if not isinstance(node.value, ast.Name) or \
+                    node.value.id != 'extras':
+                raise ValueError('filter can only use attributes of extras')
+        elif isinstance(node, ast.Name) and node.id not in FIELDS and \
+                node.id not in FUNCTIONS:
+            raise ValueError('filter can not use %s' % node.id)
+    return tree
+
+
+def validate_config(value):
+    compile_filter(value)
+
+
+def compile_filter(expression):
+    '''
+    Returns a function that tells whether a dataset dict matches the
+    expression. Raises ValueError if the expression is not allowed.
+    '''
+    if expression not in _compiled:
+        code = compile(_parse(expression), '<filter>', 'eval')
+
+        def matches(pkg_dict):
+            namespace = dict(FUNCTIONS, **_namespace(pkg_dict))
+            try:
+                return bool(eval(code, {'__builtins__': {}}, namespace))
+            except Exception as e:
+                log.debug('Filter failed on dataset %s: %r',
+                          pkg_dict.get('id'), e)
+                return False
+        _compiled[expression] = matches
+    return _compiled[expression]
+
+
+def _names(items):
+    return [item.get('name') if isinstance(item, dict) else item
+            for item in items or []]
+
+
+def _namespace(pkg_dict):
+    extras = pkg_dict.get('extras') or {}
+    if not isinstance(extras, dict):
+        extras = dict((extra.get('key'), extra.get('value'))
+                      for extra in extras)
+    organization = pkg_dict.get('organization')
+    if isinstance(organization, dict):
+        organization = organization.get('name')
+    resources = pkg_dict.get('resources') or []
+    return {
+        'name': pkg_dict.get('name'),
+        'title': pkg_dict.get('title'),
+        'notes': pkg_dict.get('notes'),
+        'license_id': pkg_dict.get('license_id'),
+        'organization': organization,
+        'private': pkg_dict.get('private', False),
+        'metadata_modified': pkg_dict.get('metadata_modified'),
+        'num_resources': pkg_dict.get('num_resources', len(resources)),
+        'tags': _names(pkg_dict.get('tags')),
+        'groups': _names(pkg_dict.get('groups')),
+        'formats': [(resource.get('format') or '').lower()
+                    for resource in resources],
+        'extras': _Extras(extras),
+    }
+
+
+def _literal(node):
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_literal(element) for element in node.elts]
+        return values if None not in values else None
+    value = getattr(node, 'value', getattr(node, 's', None))
+    return value if isinstance(value, str) else None
+
+
+def _quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _fq_term(node):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        term = _fq_term(node.operand)
+        return '-' + term if term and not term.startswith('-') else None
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    left, op, right = node.left, node.ops[0], node.comparators[0]
+
+    if isinstance(op, (ast.Eq, ast.NotEq)) and \
+            isinstance(left, ast.Name) and left.id in SOLR_FIELDS and \
+            left.id not in LIST_FIELDS and \
+            isinstance(_literal(right), str):
+        term = '%s:%s' % (SOLR_FIELDS[left.id], _quote(_literal(right)))
+    elif isinstance(op, (ast.In, ast.NotIn)) and \
+            isinstance(left, ast.Name) and left.id in SOLR_FIELDS and \
+            left.id not in LIST_FIELDS and \
+            isinstance(_literal(right), list) and _literal(right):
+        term = '%s:(%s)' % (SOLR_FIELDS[left.id],
+                            ' OR '.join(_quote(v) for v in _literal(right)))
+    elif isinstance(op, (ast.In, ast.NotIn)) and \
+            isinstance(right, ast.Name) and right.id in LIST_FIELDS and \
+            isinstance(_literal(left), str):
+        value = _literal(left)
+        if right.id == 'formats':
+            # Formats are compared in lower case, the remote ones are not
+            term = '%s:(%s OR %s)' % (SOLR_FIELDS[right.id], _quote(value),
+                                      _quote(value.upper()))
+        else:
+            term = '%s:%s' % (SOLR_FIELDS[right.id], _quote(value))
+    else:
+        return None
+    if isinstance(op, (ast.NotEq, ast.NotIn)):
+        term = '-' + term
+    return term
+
+
+def to_fq_terms(expression):
+    '''
+    Returns the remote search fq terms for the parts of the expression that
+    can be expressed as such. The remote search then returns a superset of
+    the datasets matching the expression.
+    '''
+    body = _parse(expression).body
+    if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And):
+        conditions = body.values
+    else:
+        conditions = [body]
+    return [term for term in map(_fq_term, conditions) if term]
@@ -0,0 +1,242 @@
+'''
+Source adapters: what differs between the remote portals the harvesters
+talk to, ie. the layout of their API endpoints and the shape of what they
+send. Everything else (transport, paging, fetch, the transformation of the
+datasets and the import) is done by ToscanaHarvesterBase, which gets the
+adapter of each harvester from its `adapter` attribute.
+'''
+import re
+
+import unidecode
+
+from ckan.lib.helpers import json
+from ckan.lib.munge import munge_name
+
+
+def slugify(text):
+    text = unidecode.unidecode(text).lower()
+    return re.sub(r'\W+', '-', text)
+
+
+def clean_tag(tag):
+    u_tag = tag['name']
+    u_tag = re.sub(r'[^\x00-\x7f]', r'', u_tag)
+    u_tag = u_tag.encode('ascii', 'ignore').decode('ascii')
+    tag['name'] = slugify(u_tag)
+    return tag
+
+
+class SourceAdapter(object):
+    '''
+    Base class of the adapters. `api_version` and `action_api_version` are
+    those of the harvester, which the source configuration can change.
+    '''
+    name = None
+    title = None
+    description = None
+
+    # The form of the dataset dicts handed to _create_or_update_package
+    package_dict_form = 'package_show'
+    # Whether the content stored by fetch is the package dict itself or an
+    # action API response holding it in 'result'
+    wrapped = False
+
+    def __init__(self, api_version=2, action_api_version=3):
+        self.api_version = api_version
+        self.action_api_version = action_api_version
+
+    def rest_api_offset(self):
+        return '/api/%d/rest' % self.api_version
+
+    def action_api_offset(self):
+        return '/api/%d/action' % self.action_api_version
+
+    def search_api_offset(self):
+        return '/api/%d/search' % self.api_version
+
+    def package_url(self, base_url, guid):
+        raise NotImplementedError
+
+    def group_url(self, base_url, group):
+        raise NotImplementedError
+
+    def parse_group(self, content):
+        return json.loads(content)
+
+    def organization_url(self, base_url, org_name):
+        return base_url + self.action_api_offset() + \
+            '/organization_show?id=' + org_name
+
+    def parse_package(self, content):
+        '''
+        Returns the dataset dict of the content of a harvest object.
+        '''
+        package_dict = json.loads(content)
+        if self.wrapped:
+            # Objects gathered before the content was stored wrapped
+            package_dict = package_dict.get('result', package_dict)
+        return package_dict
+
+    def package_content(self, pkg_dict):
+        '''
+        Returns the content of a harvest object for a dataset in the
+        package_show form, as fetch would have stored it.
+        '''
+        if self.wrapped:
+            return json.dumps({'result': pkg_dict})
+        return json.dumps(pkg_dict)
+
+    def validate_default_tags(self, default_tags):
+        pass
+
+    def group_id(self, group):
+        '''
+        Returns the name or id to look up a group of a remote dataset by.
+        '''
+        return group
+
+    def local_group(self, group_dict):
+        '''
+        Returns what goes in the groups of the dataset for a local group.
+        '''
+        return group_dict['id']
+
+    def add_default_groups(self, package_dict, config):
+        raise NotImplementedError
+
+    def get_extra(self, package_dict, key):
+        raise NotImplementedError
+
+    def set_extra(self, package_dict, key, value):
+        raise NotImplementedError
+
+    def clean_package(self, package_dict):
+        '''
+        Fixes up what the remote sends that can not be imported as it is.
+        '''
+        pass
+
+
+class MetarepoAdapter(SourceAdapter):
+    '''
+    Metarepo: package_show style action API under /api, with datasets in
+    the package_show form.
+    '''
+    name = 'Metarepo'
+    title = 'Metarepo'
+    description = 'Harvests remote Metarepo instances'
+    package_dict_form = 'package_show'
+    wrapped = True
+
+    def rest_api_offset(self):
+        return '/api'
+
+    def action_api_offset(self):
+        return '/api'
+
+    def search_api_offset(self):
+        return '/api/package_list'
+
+    def package_url(self, base_url, guid):
+        return base_url + self.rest_api_offset() + '/package_show?id=' + guid
+
+    def group_url(self, base_url, group):
+        return base_url + self.action_api_offset() + '/group_show?id=' + \
+            group['id']
+
+    def parse_group(self, content):
+        data = json.loads(content)
+        if self.action_api_version == 3:
+            return data.pop('result')
+        return data
+
+    def validate_default_tags(self, default_tags):
+        if default_tags and not isinstance(default_tags[0], dict):
+            raise ValueError('default_tags must be a list of dictionaries')
+
+    def group_id(self, group):
+        return group['id']
+
+    def local_group(self, group_dict):
+        return {'id': group_dict['id'], 'name': group_dict['name']}
+
+    def add_default_groups(self, package_dict, config):
+        existing_group_ids = [g['id'] for g in package_dict['groups']]
+        package_dict['groups'].extend(
+            [g for g in config.get('default_group_dicts', [])
+             if g['id'] not in existing_group_ids])
+
+    def get_extra(self, package_dict, key):
+        for extra in package_dict.get('extras', []):
+            if extra['key'] == key:
+                return extra
+
+    def set_extra(self, package_dict, key, value):
+        existing_extra = self.get_extra(package_dict, key)
+        if existing_extra:
+            package_dict['extras'].remove(existing_extra)
+        package_dict.setdefault('extras', []).append(
+            {'key': key, 'value': value})
+
+    def clean_package(self, package_dict):
+        package_dict['tags'] = [clean_tag(t)
+                                for t in package_dict.get('tags', [])]
+
+
+class SpodAdapter(SourceAdapter):
+    '''
+    Spod: CKAN style REST, action and search APIs, with datasets in the REST
+    form (tags and groups as lists of names, extras as a dictionary).
+    '''
+    name = 'Spod'
+    title = 'Spod'
+    description = 'Harvests remote Spod instances'
+    package_dict_form = 'rest'
+    wrapped = False
+
+    def package_url(self, base_url, guid):
+        return base_url + self.rest_api_offset() + '/package/' + guid
+
+    def group_url(self, base_url, group):
+        return base_url + self.rest_api_offset() + '/group/' + \
+            munge_name(group)
+
+    def package_content(self, pkg_dict):
+        # Dumps and searches give the package_show form
+        pkg_dict = dict(pkg_dict)
+        if isinstance(pkg_dict.get('extras'), list):
+            pkg_dict['extras'] = dict((extra['key'], extra['value'])
+                                      for extra in pkg_dict['extras'])
+        pkg_dict['tags'] = [tag['name'] if isinstance(tag, dict) else tag
+                            for tag in pkg_dict.get('tags') or []]
+        pkg_dict['groups'] = [group.get('name') or group.get('id')
+                              if isinstance(group, dict) else group
+                              for group in pkg_dict.get('groups') or []]
+        return json.dumps(pkg_dict)
+
+    def local_group(self, group_dict):
+        if self.api_version == 1:
+            return group_dict['name']
+        return group_dict['id']
+
+    def add_default_groups(self, package_dict, config):
+        package_dict['groups'].extend(
+            [g for g in config.get('default_groups', [])
+             if g not in package_dict['groups']])
+
+    def get_extra(self, package_dict, key):
+        return (package_dict.get('extras') or {}).get(key)
+
+    def set_extra(self, package_dict, key, value):
+        package_dict.setdefault('extras', {})[key] = value
+
+    def clean_package(self, package_dict):
+        # Non-string extras are not allowed since CKAN 2.0, convert them to
+        # strings or drop them
+        extras = package_dict.get('extras') or {}
+        for key in list(extras.keys()):
+            if not isinstance(extras[key], str):
+                try:
+                    extras[key] = json.dumps(extras[key])
+                except TypeError:
+                    del extras[key]
@@ -0,0 +1,1572 @@
+import contextlib
+import datetime
+import functools
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import sqlalchemy as sa
+import sqlalchemy.orm
+
+from ckan import model
+from ckan.model import Session
+from ckan.logic import ValidationError, NotFound, get_action
+from ckan.lib.helpers import json
+from ckan.lib.navl.validators import ignore_missing, ignore
+from ckan.logic.schema import default_create_package_schema
+from ckan.plugins import toolkit
+
+from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.logic.schema import unicode_safe
+from ckanext.harvest.model import HarvestObject, HarvestObjectError, \
+    HarvestObjectExtra
+from ckanext.toscana_harvest import bulk, dedup, dump, filters, linkcheck, \
+    mirror, paging, pipeline, profiling, projection, timeouts, transport
+from ckanext.toscana_harvest.indexing import deferred_indexing, \
+    index_packages, defer_package_index
+from ckanext.toscana_harvest.model import get_state, set_state, \
+    delete_states, get_source_identities, claim_identities, commit, \
+    commit_deferred, save, advisory_lock, in_own_transaction, \
+    DEFERRED_COMMIT
+from ckanext.toscana_harvest.profiling import profiled
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_IMPORT_BATCH_SIZE = 100
+# ckan.group_and_organization_list_all_fields_max defaults to 25
+GROUP_LIST_PAGE_SIZE = 25
+# Remote dataset ids are UUIDs, gather shards split them by first character
+HEX_DIGITS = '0123456789abcdef'
+# Harvest objects created from a dump per dedup and commit round
+DUMP_CHUNK_SIZE = 1000
+
+
+@contextlib.contextmanager
+def deferred_commit():
+    '''
+    Defers the commits of the harvester to the end of the block.
+
+    _create_or_update_package, the package actions and the other commit
+    points of the harvester (see ckanext.toscana_harvest.model.commit)
+    only flush while the block runs, so the imports of a batch share a
+    single transaction, which the caller commits once at the end.
+
+    Groups are created in a transaction of their own (see
+    in_own_transaction).
+
+    The package actions roll the session back before raising a
+    ValidationError. Inside the block that only rolls back to the innermost
+    savepoint, ie. the changes of the object being imported. Both only
+    apply to the session of the current thread.
+    '''
+    session = Session()
+    session.info[DEFERRED_COMMIT] = True
+    session.rollback = functools.partial(_rollback_savepoint, session)
+    try:
+        yield
+    finally:
+        session.info.pop(DEFERRED_COMMIT, None)
+        del session.rollback
+
+
+def _rollback_savepoint(session):
+    if hasattr(session, 'get_nested_transaction'):
+        transaction = session.get_nested_transaction()
+    else:
+        # SQLAlchemy < 1.4
+        transaction = session.transaction
+        while transaction is not None and not transaction.nested:
+            transaction = transaction._parent
+    if transaction is not None and transaction.is_active:
+        transaction.rollback()
+    else:
+        type(session).rollback(session)
+
+
+def _root_transaction(session):
+    if hasattr(session, 'get_transaction'):
+        return session.get_transaction()
+    # SQLAlchemy < 1.4
+    transaction = session.transaction
+    while transaction is not None and transaction._parent is not None:
+        transaction = transaction._parent
+    return transaction
+
+
+class BatchAborted(Exception):
+    pass
+
+
+def delete_job_states(job_ids):
+    '''
+    Deletes what the harvesters keep in the state table for the duration of
+    a job, once the jobs have finished.
+    '''
+    delete_states(ToscanaHarvesterBase._groups_prefetched_key(job_id)
+                  for job_id in job_ids)
+
+
+def order_by_priority(query):
+    '''
+    Orders a query on harvest objects by the priority given to them during
+    gather, highest first. Objects without a priority come last.
+    '''
+    priority = sa.orm.aliased(HarvestObjectExtra)
+    return query.outerjoin(
+        priority, sa.and_(priority.harvest_object_id == HarvestObject.id,
+                          priority.key == 'priority')) \
+        .order_by(priority.value.desc().nullslast(), HarvestObject.gathered)
+
+
+class ToscanaHarvesterBase(HarvesterBase):
+    '''
+    Functionality shared by the Spod and Metarepo harvesters
+    '''
+    config = None
+
+    # Errors saved with _save_object_error while an object is imported as
+    # part of a batch. They are kept aside so they survive the rollback of
+    # the object savepoint.
+    _batch_errors = None
+
+    # Result of _groups_prefetched for the job last asked about, as
+    # (job id, result)
+    _prefetched_groups = None
+
+    # Whether gather may publish harvest objects to the fetch queue itself
+    # when the source sets `pipeline`. Off when something other than the
+    # queues runs the stages.
+    publish_during_gather = True
+
+    # Where gather hands its harvest objects over instead of the fetch
+    # queue, when something in the same process fetches and imports them
+    # (see ckanext.toscana_harvest.pipeline.BatchHandoff)
+    fetch_handoff = None
+
+    # New packages queued by _create_or_update_package while a batch is
+    # imported in bulk_load mode, written together at the end of the batch
+    _bulk_packages = None
+
+    # TimeBudget of the gather that is running (see
+    # ckanext.toscana_harvest.timeouts)
+    _gather_budget = None
+
+    # The SourceAdapter class of the remote portals the harvester talks to
+    # (see ckanext.toscana_harvest.harvesters.adapters)
+    adapter_class = None
+
+    api_version = 2
+    action_api_version = 3
+
+    @property
+    def adapter(self):
+        return self.adapter_class(self.api_version, self.action_api_version)
+
+    def info(self):
+        adapter = self.adapter
+        return {
+            'name': adapter.name,
+            'title': adapter.title,
+            'description': adapter.description,
+            'form_config_interface': 'Text'
+        }
+
+    def _get_rest_api_offset(self):
+        return self.adapter.rest_api_offset()
+
+    def _get_action_api_offset(self):
+        return self.adapter.action_api_offset()
+
+    def _get_search_api_offset(self):
+        return self.adapter.search_api_offset()
+
+    def _set_config(self, config_str):
+        if config_str:
+            self.config = json.loads(config_str)
+            if 'api_version' in self.config:
+                self.api_version = int(self.config['api_version'])
+
+            log.debug('Using config: %r', self.config)
+        else:
+            self.config = {}
+
+    def validate_config(self, config):
+        if not config:
+            return config
+
+        config_obj = json.loads(config)
+
+        if 'api_version' in config_obj:
+            try:
+                int(config_obj['api_version'])
+            except ValueError:
+                raise ValueError('api_version must be an integer')
+
+        if 'default_tags' in config_obj:
+            if not isinstance(config_obj['default_tags'], list):
+                raise ValueError('default_tags must be a list')
+            self.adapter.validate_default_tags(config_obj['default_tags'])
+
+        if 'default_groups' in config_obj:
+            if not isinstance(config_obj['default_groups'], list):
+                raise ValueError('default_groups must be a *list* of group'
+                                 ' names/ids')
+            if config_obj['default_groups'] and \
+                    not isinstance(config_obj['default_groups'][0], str):
+                raise ValueError('default_groups must be a list of group '
+                                 'names/ids (i.e. strings)')
+
+            # Check if default groups exist
+            context = {'model': model, 'user': toolkit.c.user}
+            config_obj['default_group_dicts'] = []
+            for group_name_or_id in config_obj['default_groups']:
+                try:
+                    group = get_action('group_show')(
+                        context.copy(), {'id': group_name_or_id})
+                    # save the dict to the config object, as we'll need it
+                    # in the import_stage of every dataset
+                    config_obj['default_group_dicts'].append(group)
+                except NotFound:
+                    raise ValueError('Default group not found')
+            config = json.dumps(config_obj)
+
+        if 'default_extras' in config_obj:
+            if not isinstance(config_obj['default_extras'], dict):
+                raise ValueError('default_extras must be a dictionary')
+
+        if 'organizations_filter_include' in config_obj \
+                and 'organizations_filter_exclude' in config_obj:
+            raise ValueError('Harvest configuration cannot contain both '
+                             'organizations_filter_include and '
+                             'organizations_filter_exclude')
+
+        if 'user' in config_obj:
+            # Check if user exists
+            context = {'model': model, 'user': toolkit.c.user}
+            try:
+                get_action('user_show')(
+                    context, {'id': config_obj.get('user')})
+            except NotFound:
+                raise ValueError('User not found')
+
+        for key in ('read_only', 'force_all'):
+            if key in config_obj:
+                if not isinstance(config_obj[key], bool):
+                    raise ValueError('%s must be boolean' % key)
+
+        self._validate_common_config(config_obj)
+
+        return config
+
+    def _get_content(self, url):
+        headers = {}
+        api_key = self.config.get('api_key')
+        if api_key:
+            headers['Authorization'] = api_key
+
+        try:
+            return transport.get_content(url, headers,
+                                         timeouts.settings(self.config))
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                raise ContentNotFoundError('HTTP error: %s' %
+                                           e.response.status_code)
+            else:
+                raise ContentFetchError('HTTP error: %s' %
+                                        e.response.status_code)
+        except requests.Timeout as e:
+            raise ContentFetchError('HTTP timeout: %s' % e)
+        except requests.ConnectionError as e:
+            raise ContentFetchError('URL error: %s' % e)
+        except requests.RequestException as e:
+            raise ContentFetchError('HTTP Exception: %s' % e)
+        except Exception as e:
+            raise ContentFetchError('HTTP general exception: %s' % e)
+
+    def _get_group(self, base_url, group):
+        try:
+            content = self._get_content(self.adapter.group_url(base_url,
+                                                               group))
+            return self.adapter.parse_group(content)
+        except (ContentFetchError, ValueError, KeyError):
+            log.debug('Could not fetch/decode remote group')
+            raise RemoteResourceError('Could not fetch/decode remote group')
+
+    def _get_organization(self, base_url, org_name):
+        try:
+            content = self._get_content(
+                self.adapter.organization_url(base_url, org_name))
+            return json.loads(content)['result']
+        except (ContentFetchError, ValueError, KeyError):
+            log.debug('Could not fetch/decode remote organization')
+            raise RemoteResourceError(
+                'Could not fetch/decode remote organization')
+
+    @profiled('fetch')
+    def fetch_stage(self, harvest_object):
+        log.debug('In %s fetch_stage', self.adapter.name)
+
+        self._set_config(harvest_object.job.source.config)
+        if self._out_of_job_time(harvest_object):
+            return None
+
+        if harvest_object.content:
+            # Gather found the whole dataset already, in a dump or in the
+            # remote search results
+            return True
+
+        url = self.adapter.package_url(harvest_object.source.url.rstrip('/'),
+                                       harvest_object.guid)
+        try:
+            content = self._get_content(url)
+        except ContentFetchError as e:
+            log.error('Unable to get content for package: %s: %r', url, e)
+            self._save_object_error('Unable to get content for package: '
+                                    '%s: %r' % (url, e), harvest_object)
+            return None
+
+        # Save the fetched contents in the HarvestObject, only with the
+        # fields the import stage uses
+        harvest_object.content = projection.project_content(
+            content, self.config.get('projection'), self.adapter.wrapped)
+        harvest_object.save()
+        return True
+
+    @profiled('import')
+    def import_stage(self, harvest_object):
+        log.debug('In %s import_stage', self.adapter.name)
+
+        if not harvest_object:
+            log.error('No harvest object received')
+            return False
+
+        if harvest_object.content is None:
+            self._save_object_error('Empty content for object %s' %
+                                    harvest_object.id,
+                                    harvest_object, 'Import')
+            return False
+
+        self._set_config(harvest_object.job.source.config)
+        if self._out_of_job_time(harvest_object, u'Import'):
+            return False
+
+        adapter = self.adapter
+        try:
+            package_dict = adapter.parse_package(harvest_object.content)
+
+            if package_dict.get('type') == 'harvest':
+                log.warn('Remote dataset is a harvest source, ignoring...')
+                return True
+
+            # Datasets gathered without their metadata (the Spod package
+            # list) can only be filtered here
+            if harvest_object.guid in self._filter_out(
+                    {harvest_object.guid: package_dict}):
+                log.info('Dataset %s excluded by the filter, ignoring...',
+                         harvest_object.guid)
+                return 'unchanged'
+
+            self._prepare_package(package_dict, harvest_object, adapter)
+
+            return self._create_or_update_package(
+                package_dict, harvest_object,
+                package_dict_form=adapter.package_dict_form)
+        except ValidationError as e:
+            self._save_object_error('Invalid package with GUID %s: %r' %
+                                    (harvest_object.guid, e.error_dict),
+                                    harvest_object, 'Import')
+        except Exception as e:
+            self._save_object_error('%s' % e, harvest_object, 'Import')
+
+    def _prepare_package(self, package_dict, harvest_object, adapter):
+        '''
+        Turns a remote dataset into the one to create or update locally,
+        applying the defaults of the source configuration and mapping the
+        remote groups and organization to local ones.
+        '''
+        context = {'model': model, 'session': Session,
+                   'user': self._get_user_name()}
+
+        # Set default tags if needed
+        default_tags = self.config.get('default_tags', [])
+        if default_tags:
+            if 'tags' not in package_dict:
+                package_dict['tags'] = []
+            package_dict['tags'].extend(
+                [t for t in default_tags if t not in package_dict['tags']])
+
+        adapter.clean_package(package_dict)
+
+        remote_groups = self.config.get('remote_groups', None)
+        if remote_groups not in ('only_local', 'create'):
+            # Ignore remote groups
+            package_dict.pop('groups', None)
+        else:
+            if 'groups' not in package_dict:
+                package_dict['groups'] = []
+
+            # check if remote groups exist locally, otherwise remove
+            validated_groups = []
+
+            for group_ in package_dict['groups']:
+                try:
+                    group = get_action('group_show')(
+                        context.copy(), {'id': adapter.group_id(group_)})
+                    validated_groups.append(adapter.local_group(group))
+                except NotFound:
+                    log.info('Group %s is not available', group_)
+                    if remote_groups == 'create' and \
+                            not self._groups_prefetched(harvest_object.job,
+                                                        'group'):
+                        try:
+                            group = self._get_group(harvest_object.source.url,
+                                                    group_)
+                        except RemoteResourceError:
+                            log.error('Could not get remote group %s', group_)
+                            continue
+
+                        for key in ['packages', 'created', 'users', 'groups',
+                                    'tags', 'extras', 'display_name']:
+                            group.pop(key, None)
+
+                        group = self._create_group(context, group)
+                        validated_groups.append(adapter.local_group(group))
+
+            package_dict['groups'] = validated_groups
+
+        # Local harvest source organization
+        source_dataset = get_action('package_show')(
+            context.copy(), {'id': harvest_object.source.id})
+        local_org = source_dataset.get('owner_org')
+
+        remote_orgs = self.config.get('remote_orgs', None)
+
+        if remote_orgs not in ('only_local', 'create'):
+            # Assign dataset to the source organization
+            package_dict['owner_org'] = local_org
+        else:
+            if 'owner_org' not in package_dict:
+                package_dict['owner_org'] = None
+
+            # check if remote org exist locally, otherwise remove
+            validated_org = None
+            remote_org = package_dict['owner_org']
+
+            if remote_org:
+                try:
+                    org = get_action('organization_show')(
+                        context.copy(), {'id': remote_org})
+                    validated_org = org['id']
+                except NotFound:
+                    log.info('Organization %s is not available', remote_org)
+                    if remote_orgs == 'create' and \
+                            not self._groups_prefetched(harvest_object.job,
+                                                        'organization'):
+                        try:
+                            try:
+                                org = self._get_organization(
+                                    harvest_object.source.url, remote_org)
+                            except RemoteResourceError:
+                                # fallback if the remote exposes
+                                # organizations as groups, this especially
+                                # targets older versions
+                                org = self._get_group(
+                                    harvest_object.source.url, remote_org)
+
+                            for key in ['packages', 'created', 'users',
+                                        'groups', 'tags', 'extras',
+                                        'display_name', 'type']:
+                                org.pop(key, None)
+                            org = self._create_group(context, org,
+                                                     is_organization=True)
+                            validated_org = org['id']
+                        except (RemoteResourceError, ValidationError):
+                            log.error('Could not get remote org %s',
+                                      remote_org)
+
+            package_dict['owner_org'] = validated_org or local_org
+
+        # Set default groups if needed
+        if self.config.get('default_groups', []):
+            if 'groups' not in package_dict:
+                package_dict['groups'] = []
+            adapter.add_default_groups(package_dict, self.config)
+
+        # Set default extras if needed
+        default_extras = self.config.get('default_extras', {})
+        if default_extras:
+            override_extras = self.config.get('override_extras', False)
+            for key, value in default_extras.items():
+                if adapter.get_extra(package_dict, key) is not None and \
+                        not override_extras:
+                    continue  # no need for the default
+                # Look for replacement strings
+                if isinstance(value, str):
+                    value = value.format(
+                        harvest_source_id=harvest_object.job.source.id,
+                        harvest_source_url=
+                        harvest_object.job.source.url.strip('/'),
+                        harvest_source_title=harvest_object.job.source.title,
+                        harvest_job_id=harvest_object.job.id,
+                        harvest_object_id=harvest_object.id,
+                        dataset_id=package_dict['id'])
+                adapter.set_extra(package_dict, key, value)
+
+        for resource in package_dict.get('resources', []):
+            # Clear remote url_type for resources (eg datastore, upload) as
+            # we are only creating normal resources with links to the
+            # remote ones
+            resource.pop('url_type', None)
+
+            # Clear revision_id as the revision won't exist on this CKAN
+            # and saving it will cause an IntegrityError with the foreign
+            # key.
+            resource.pop('revision_id', None)
+
+    def benchmark_adapter(self, base_url, guids):
+        '''
+        Fetches the remote datasets `guids` and runs them through the steps
+        of the adapter that fetch and import go through, without importing
+        them. Returns the seconds spent in each step, the bytes fetched and
+        stored, and the number of datasets done and failed.
+        '''
+        adapter = self.adapter
+        steps = ('fetch', 'project', 'parse', 'clean')
+        stats = dict((step, 0.0) for step in steps)
+        stats.update({'datasets': 0, 'errors': 0, 'fetched_bytes': 0,
+                      'stored_bytes': 0})
+        for guid in guids:
+            try:
+                started = time.time()
+                content = self._get_content(adapter.package_url(base_url,
+                                                                guid))
+                fetched = time.time()
+                stored = projection.project_content(
+                    content, self.config.get('projection'), adapter.wrapped)
+                projected = time.time()
+                package_dict = adapter.parse_package(stored)
+                parsed = time.time()
+                adapter.clean_package(package_dict)
+                cleaned = time.time()
+            except (ContentFetchError, ValueError) as e:
+                log.info('Benchmark of dataset %s failed: %s', guid, e)
+                stats['errors'] += 1
+                continue
+            stats['fetch'] += fetched - started
+            stats['project'] += projected - fetched
+            stats['parse'] += parsed - projected
+            stats['clean'] += cleaned - parsed
+            stats['fetched_bytes'] += len(content)
+            stats['stored_bytes'] += len(stored)
+            stats['datasets'] += 1
+        return stats
+
+    def _start_gather_budget(self, harvest_job):
+        self._gather_budget = timeouts.gather_budget(self.config, harvest_job)
+
+    def _check_gather_budget(self):
+        '''
+        Raises timeouts.BudgetExceeded once the gather has run out of time.
+        '''
+        if self._gather_budget is not None:
+            self._gather_budget.check()
+
+    def _out_of_job_time(self, harvest_object, stage=u'Fetch'):
+        '''
+        Tells whether the job of the object has run out of time, in which
+        case the object gets an error instead of being processed.
+        '''
+        try:
+            timeouts.job_budget(self.config, harvest_object.job).check()
+        except timeouts.BudgetExceeded as e:
+            self._save_object_error('%s, %s stage skipped' % (e, stage),
+                                    harvest_object, stage)
+            return True
+        return False
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        if self._batch_errors is not None:
+            self._batch_errors.append((message, stage, line))
+            return
+        super(ToscanaHarvesterBase, self)._save_object_error(
+            message, obj, stage, line)
+
+    def _create_group(self, context, group_dict, is_organization=False):
+        '''
+        Creates a local copy of a remote group or organization, unless it
+        already exists, and returns the local one.
+
+        Several import workers can run into the same missing group at the
+        same time. The check and the creation are done holding an advisory
+        lock on the group name, so only one of them creates it and the others
+        get the group it created. Inside a batch this runs in a transaction
+        of its own (see in_own_transaction), so the lock is let go of once
+        the group is there.
+        '''
+        group_type = 'organization' if is_organization else 'group'
+        name = group_dict.get('name') or group_dict['id']
+
+        def create():
+            # Nothing loaded by the session of the caller goes along
+            create_context = {'model': model, 'session': Session,
+                              'user': context['user']}
+            with advisory_lock('%s:%s' % (group_type, name)):
+                existing = self._find_group(create_context, group_dict,
+                                            group_type)
+                if existing:
+                    return existing
+                try:
+                    group = get_action('%s_create' % group_type)(
+                        create_context.copy(), group_dict)
+                    log.info('%s %s has been newly created',
+                             group_type.capitalize(), name)
+                    return group
+                except ValidationError:
+                    # Created by someone not going through the lock, eg. by
+                    # hand
+                    existing = self._find_group(create_context, group_dict,
+                                                group_type)
+                    if existing:
+                        return existing
+                    raise
+        return in_own_transaction(create)
+
+    @staticmethod
+    def _find_group(context, group_dict, group_type):
+        for key in ('id', 'name'):
+            if not group_dict.get(key):
+                continue
+            try:
+                return get_action('%s_show' % group_type)(
+                    context.copy(), {'id': group_dict[key]})
+            except NotFound:
+                pass
+
+    def _prefetch_remote_groups(self, harvest_job, base_url):
+        '''
+        Lists the remote organizations and groups in a few bulk calls and
+        creates the missing ones locally, for the sources that have
+        `remote_orgs` or `remote_groups` set to `create`.
+
+        Once this has worked for a job, its import stage only looks groups
+        and organizations up locally instead of fetching them from the
+        remote one at a time.
+        '''
+        context = {'model': model, 'session': Session,
+                   'user': self._get_user_name()}
+        prefetched = {}
+        for group_type, option in (('organization', 'remote_orgs'),
+                                   ('group', 'remote_groups')):
+            if self.config.get(option) != 'create':
+                continue
+            try:
+                remote_groups = self._list_remote_groups(base_url, group_type)
+            except Exception as e:
+                log.warning('Could not list the remote %ss, they will be '
+                            'fetched during the import: %s', group_type, e)
+                continue
+
+            local_names = set(name for (name,) in Session.query(
+                model.Group.name).filter(
+                    model.Group.is_organization ==
+                    (group_type == 'organization')))
+            failed = 0
+            for group in remote_groups:
+                if group['name'] in local_names:
+                    continue
+                for key in ['packages', 'created', 'users', 'groups', 'tags',
+                            'extras', 'display_name', 'package_count',
+                            'image_display_url', 'num_followers',
+                            'revision_id']:
+                    group.pop(key, None)
+                if group_type == 'organization':
+                    group.pop('type', None)
+                try:
+                    self._create_group(context, group,
+                                       is_organization=group_type ==
+                                       'organization')
+                except ValidationError as e:
+                    log.error('Could not create remote %s %s: %r',
+                              group_type, group['name'], e.error_dict)
+                    failed += 1
+            if failed:
+                # Import still fetches the ones that are missing
+                log.warning('%d of %d remote %ss could not be created, they '
+                            'will be fetched during the import', failed,
+                            len(remote_groups), group_type)
+                continue
+            prefetched[group_type] = True
+            log.info('Prefetched %d remote %ss', len(remote_groups),
+                     group_type)
+
+        set_state(self._groups_prefetched_key(harvest_job.id), prefetched)
+
+    def _list_remote_groups(self, base_url, group_type):
+        url = base_url + self._get_action_api_offset() + \
+            '/%s_list?all_fields=true&limit=%d&offset=%d'
+        groups = []
+        names = set()
+        while True:
+            self._check_gather_budget()
+            content = self._get_content(
+                url % (group_type, GROUP_LIST_PAGE_SIZE, len(groups)))
+            page = json.loads(content)['result']
+            new_groups = [group for group in page
+                          if group['name'] not in names]
+            groups.extend(new_groups)
+            names.update(group['name'] for group in new_groups)
+            # A remote that ignores limit or offset keeps sending the same
+            # groups
+            if len(page) < GROUP_LIST_PAGE_SIZE or not new_groups:
+                return groups
+
+    def _groups_prefetched(self, harvest_job, group_type):
+        '''
+        Whether the gather stage of the job already created every remote
+        group (or organization) locally.
+        '''
+        if self._prefetched_groups is None or \
+                self._prefetched_groups[0] != harvest_job.id:
+            self._prefetched_groups = (harvest_job.id, get_state(
+                self._groups_prefetched_key(harvest_job.id), {}))
+        return self._prefetched_groups[1].get(group_type, False)
+
+    @staticmethod
+    def _groups_prefetched_key(job_id):
+        return 'groups:%s' % job_id
+
+    @staticmethod
+    def _gather_checkpoint_key(harvest_job):
+        return 'gather:%s' % harvest_job.id
+
+    @staticmethod
+    def _get_job_objects(harvest_job):
+        '''
+        Returns the ids of the harvest objects already created by the job
+        and the set of their guids, so a resumed gather can skip them.
+        '''
+        object_ids = []
+        guids = set()
+        for object_id, guid in Session.query(HarvestObject.id,
+                                             HarvestObject.guid) \
+                .filter(HarvestObject.harvest_job_id == harvest_job.id) \
+                .order_by(HarvestObject.gathered):
+            object_ids.append(object_id)
+            guids.add(guid)
+        return object_ids, guids
+
+    def _get_gather_shards(self):
+        '''
+        Splits the remote id space into `gather_shards` partitions, each
+        given as the list of hexadecimal characters its ids start with. The
+        first shard also takes the ids that start with anything else. An
+        empty list stands for the whole id space, when there is no sharding.
+        '''
+        count = int(self.config.get('gather_shards', 1))
+        if count == 1:
+            return [[]]
+        return [list(HEX_DIGITS[i::count]) for i in range(count)]
+
+    @staticmethod
+    def _shard_of(guid, shards):
+        for i, prefixes in enumerate(shards):
+            if guid[:1] in prefixes:
+                return i
+        return 0
+
+    @staticmethod
+    def _shard_fq_term(shard):
+        '''
+        Returns the remote search fq term selecting the datasets of a shard
+        of _get_gather_shards, or None for the whole id space.
+        '''
+        if not shard:
+            return None
+        term = 'id:(%s)' % ' OR '.join('%s*' % prefix for prefix in shard)
+        if HEX_DIGITS[0] in shard:
+            # Ids that do not start with a lower case hexadecimal character
+            term = '(%s OR (*:* -id:(%s)))' % (term, ' OR '.join(
+                '%s*' % prefix for prefix in HEX_DIGITS))
+        return term
+
+    def _run_shards(self, shard_function, shards, max_workers=None):
+        '''
+        Calls shard_function for every item of `shards` and returns the
+        results. Unless there is a single shard or a single worker, the
+        shards run in parallel threads (one per shard by default), each with
+        its own database session. Exceptions raised by a shard are raised
+        again here once all the threads have stopped.
+        '''
+        max_workers = max_workers or len(shards)
+        if len(shards) == 1 or max_workers == 1:
+            return [shard_function(shard) for shard in shards]
+
+        def run(shard):
+            try:
+                return shard_function(shard)
+            finally:
+                Session.remove()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    def _get_fetch_handoff(self):
+        '''
+        Returns the FetchHandoff that publishes the harvest objects of a
+        gather to the fetch queue as they are created.
+        '''
+        if self.fetch_handoff is not None:
+            return self.fetch_handoff
+        if not self.publish_during_gather:
+            return pipeline.FetchHandoff()
+        return pipeline.FetchHandoff(self.config.get('pipeline'),
+                                     self._gather_budget)
+
+    def _gather_from_dump(self, harvest_job):
+        '''
+        Gather stage of a source with a `dump` (see
+        ckanext.toscana_harvest.dump): creates a harvest object with its
+        content already in place for each dataset of the dump, or none at
+        all if the dump has not changed since the last error-free job.
+        '''
+        settings = self.config['dump']
+        state_key = 'dump:%s' % harvest_job.source_id
+        previous = get_state(state_key)
+        last_error_free_job = self.last_error_free_job(harvest_job)
+        if previous and (not last_error_free_job or
+                         previous.get('job_id') != last_error_free_job.id):
+            # The last ingest of the dump did not go through
+            previous = None
+
+        try:
+            path, current = dump.download(settings['url'], previous,
+                                          self.config.get('api_key'),
+                                          timeouts.settings(self.config))
+        except dump.DumpError as e:
+            self._save_gather_error('%s' % e, harvest_job)
+            return None
+        current = dict(current, job_id=harvest_job.id)
+        if path is None:
+            log.info('Dump %s has not changed since job %s, nothing to do',
+                     settings['url'], previous['job_id'])
+            set_state(state_key, current)
+            return []
+
+        local_guids = self._get_local_guids(harvest_job)
+        object_ids, guids = self._get_job_objects(harvest_job)
+        handoff = self._get_fetch_handoff()
+        try:
+            if settings.get('sha256') and \
+                    settings['sha256'].lower() != current['sha256']:
+                self._save_gather_error(
+                    'Checksum of dump %s is %s, expected %s' %
+                    (settings['url'], current['sha256'], settings['sha256']),
+                    harvest_job)
+                return None
+
+            # Only once the dump is known to have changed
+            self._prefetch_remote_groups(harvest_job,
+                                         harvest_job.source.url.rstrip('/'))
+
+            datasets = dump.iter_datasets(path, settings.get('format',
+                                                             'jsonl'))
+            while True:
+                self._check_gather_budget()
+                chunk = {}
+                for pkg_dict in datasets:
+                    guid = pkg_dict.get('id') or pkg_dict.get('name')
+                    if guid and guid not in guids:
+                        guids.add(guid)
+                        chunk[guid] = pkg_dict
+                        if len(chunk) == DUMP_CHUNK_SIZE:
+                            break
+                if not chunk:
+                    break
+                excluded = self._filter_out(chunk)
+                chunk = dict((guid, pkg_dict)
+                             for guid, pkg_dict in chunk.items()
+                             if guid not in excluded)
+                contents = dict((guid, self._gathered_content(pkg_dict))
+                                for guid, pkg_dict in chunk.items())
+                dropped = self._drop_duplicates(harvest_job, chunk) | \
+                    self._mirror_listing(harvest_job, chunk, dict(
+                        (guid, mirror.digest(content))
+                        for guid, content in contents.items()))
+                chunk_object_ids = [
+                    self._create_harvest_object(
+                        harvest_job, guid, contents[guid],
+                        self._priority(guid,
+                                       pkg_dict.get('metadata_modified'),
+                                       local_guids))
+                    for guid, pkg_dict in chunk.items()
+                    if guid not in dropped]
+                object_ids.extend(chunk_object_ids)
+                handoff.add(chunk_object_ids)
+        except dump.DumpError as e:
+            self._save_gather_error('%s' % e, harvest_job)
+            return None
+        except timeouts.BudgetExceeded as e:
+            # The objects created so far still go through, the dump is
+            # ingested again by the next job
+            self._save_gather_error('%s after %d datasets of dump %s' %
+                                    (e, len(object_ids), settings['url']),
+                                    harvest_job)
+            return handoff.remaining(
+                self._sort_by_priority(harvest_job, object_ids))
+        finally:
+            os.remove(path)
+            handoff.close()
+
+        set_state(state_key, current)
+        mirror.finish_full_listing(harvest_job.source_id, harvest_job.id)
+        log.info('Gathered %d datasets from dump %s', len(object_ids),
+                 settings['url'])
+        return handoff.remaining(
+            self._sort_by_priority(harvest_job, object_ids))
+
+    def _gathered_content(self, pkg_dict):
+        '''
+        Returns the content of a harvest object for a dataset found whole by
+        gather (in a dump or in search results), in the form the fetch stage
+        would have stored.
+        '''
+        return self.adapter.package_content(self._project(pkg_dict))
+
+    def _project(self, pkg_dict):
+        '''
+        Returns the fields of a remote dataset to store in its harvest
+        object (see ckanext.toscana_harvest.projection).
+        '''
+        return projection.project(pkg_dict, self.config.get('projection'))
+
+    @staticmethod
+    def _create_harvest_object(harvest_job, guid, content=None,
+                               priority=None):
+        '''
+        Creates and saves a harvest object for the job in the current
+        session, which can be the one of a gather shard thread.
+        '''
+        obj = HarvestObject(guid=guid,
+                            harvest_job_id=harvest_job.id,
+                            harvest_source_id=harvest_job.source_id,
+                            content=content)
+        if priority is not None:
+            obj.extras = [HarvestObjectExtra(key='priority', value=priority)]
+        obj.save()
+        return obj.id
+
+    @staticmethod
+    def _get_local_guids(harvest_job):
+        '''
+        Returns the guids of the datasets that this source has already
+        imported.
+        '''
+        return set(guid for (guid,) in Session.query(HarvestObject.guid)
+                   .filter(HarvestObject.harvest_source_id ==
+                           harvest_job.source_id)
+                   .filter(HarvestObject.current == True))
+
+    @staticmethod
+    def _priority(guid, metadata_modified, local_guids):
+        '''
+        Returns the priority of a gathered dataset, as a string that sorts
+        the datasets new to this site first and then the most recently
+        modified ones.
+        '''
+        return '%d %s' % (guid not in local_guids, metadata_modified or '')
+
+    def _sort_by_priority(self, harvest_job, object_ids):
+        '''
+        Sorts the ids of harvest objects of the job by priority, highest
+        first, which is the order they are sent to the fetch queue in.
+        '''
+        wanted = set(object_ids)
+        return [object_id for (object_id,) in order_by_priority(
+                    Session.query(HarvestObject.id).filter(
+                        HarvestObject.harvest_job_id == harvest_job.id))
+                if object_id in wanted]
+
+    def _validate_common_config(self, config_obj):
+        if 'import_batch_size' in config_obj:
+            try:
+                batch_size = int(config_obj['import_batch_size'])
+            except (TypeError, ValueError):
+                raise ValueError('import_batch_size must be an integer')
+            if batch_size < 1:
+                raise ValueError('import_batch_size must be greater than 0')
+
+        if 'defer_indexing' in config_obj:
+            if not isinstance(config_obj['defer_indexing'], bool):
+                raise ValueError('defer_indexing must be boolean')
+
+        if 'gather_shards' in config_obj:
+            try:
+                shards = int(config_obj['gather_shards'])
+            except (TypeError, ValueError):
+                raise ValueError('gather_shards must be an integer')
+            if not 1 <= shards <= len(HEX_DIGITS):
+                raise ValueError('gather_shards must be between 1 and %d' %
+                                 len(HEX_DIGITS))
+
+        if 'profile' in config_obj:
+            profiling.validate_config(config_obj['profile'])
+
+        if 'filter' in config_obj:
+            filters.validate_config(config_obj['filter'])
+
+        if 'dedup' in config_obj:
+            dedup.validate_config(config_obj['dedup'])
+
+        if 'page_size' in config_obj:
+            paging.validate_config(config_obj['page_size'])
+
+        if 'link_check' in config_obj:
+            linkcheck.validate_config(config_obj['link_check'])
+
+        if 'pipeline' in config_obj:
+            pipeline.validate_config(config_obj['pipeline'])
+
+        if 'dump' in config_obj:
+            dump.validate_config(config_obj['dump'])
+
+        if 'projection' in config_obj:
+            projection.validate_config(config_obj['projection'])
+
+        if 'timeouts' in config_obj:
+            timeouts.validate_config(config_obj['timeouts'])
+
+        if 'precheck' in config_obj:
+            if not isinstance(config_obj['precheck'], bool):
+                raise ValueError('precheck must be boolean')
+
+        if 'bulk_load' in config_obj:
+            if not isinstance(config_obj['bulk_load'], bool):
+                raise ValueError('bulk_load must be boolean')
+
+    def _mirror_listing(self, harvest_job, datasets, digests=None):
+        '''
+        Records gathered datasets in the mirror index of the source.
+
+        `datasets` maps guids to remote dataset dicts, or to None when only
+        the guid is known, and `digests` to the digest of the content the
+        harvest object would get, if known. Returns the guids of the
+        datasets that have not changed since they were last imported, which
+        need not be fetched again unless the source sets `force_all`.
+        '''
+        entries = []
+        for guid, pkg_dict in datasets.items():
+            pkg_dict = pkg_dict or {}
+            entries.append({'remote_id': guid,
+                            'name': pkg_dict.get('name'),
+                            'metadata_modified':
+                                pkg_dict.get('metadata_modified'),
+                            'digest': (digests or {}).get(guid)})
+        mirror.record_listing(harvest_job.source_id, harvest_job.id, entries)
+        if self.config.get('force_all', False):
+            return set()
+        skipped = mirror.unchanged(harvest_job.source_id, entries)
+        if skipped:
+            log.debug('Skipping %d datasets unchanged since their last '
+                      'import', len(skipped))
+        return skipped
+
+    def _get_page_size(self, harvest_job, initial):
+        '''
+        Returns the PageSizeTuner of the searches of the source, starting
+        from `initial` on its first run.
+        '''
+        return paging.PageSizeTuner(harvest_job.source_id,
+                                    self.config.get('page_size'), initial)
+
+    def _remote_unchanged(self, harvest_job, fingerprint):
+        '''
+        Pre-check of the gather stage. `fingerprint` is a cheap summary of
+        the remote catalogue, like its number of datasets and latest
+        modification time, or None if it could not be worked out.
+
+        Returns True when it is the same as at the last error-free job of
+        the source with the same configuration, in which case there is
+        nothing to harvest.
+        '''
+        key = 'fingerprint:%s' % harvest_job.source_id
+        previous = get_state(key)
+        current = {'job_id': harvest_job.id,
+                   'fingerprint': [harvest_job.source.config, fingerprint]}
+        set_state(key, current)
+        if fingerprint is None or not previous or \
+                not self.config.get('precheck', True) or \
+                self.config.get('force_all', False):
+            return False
+        last_error_free_job = self.last_error_free_job(harvest_job)
+        if not last_error_free_job or \
+                previous['job_id'] != last_error_free_job.id or \
+                previous['fingerprint'] != current['fingerprint']:
+            return False
+        log.info('Remote catalogue unchanged since job %s (%r), nothing to '
+                 'harvest', last_error_free_job.id, fingerprint)
+        return True
+
+    def _filter_out(self, datasets):
+        '''
+        Applies the `filter` of the source (see
+        ckanext.toscana_harvest.filters) to gathered datasets.
+
+        `datasets` maps guids to remote dataset dicts, or to None when only
+        the guid is known. Returns the guids of the datasets the filter
+        excludes, which should not be fetched.
+        '''
+        if not self.config.get('filter'):
+            return set()
+        matches = filters.compile_filter(self.config['filter'])
+        excluded = set(guid for guid, pkg_dict in datasets.items()
+                       if pkg_dict is not None and not matches(pkg_dict))
+        if excluded:
+            log.debug('Filtering out %d datasets', len(excluded))
+        return excluded
+
+    def _drop_duplicates(self, harvest_job, datasets):
+        '''
+        Claims the gathered datasets for the source of the job in the
+        cross-source identity index (see ckanext.toscana_harvest.dedup).
+
+        `datasets` maps guids to remote dataset dicts, or to None when only
+        the guid is known. Returns the guids of the datasets owned by
+        another source, which should not be fetched.
+        '''
+        settings = dedup.settings(self.config)
+        if not settings or not datasets:
+            return set()
+        key, priority = settings
+
+        identities = {}
+        for guid, pkg_dict in datasets.items():
+            identity = dedup.dataset_identity(key, pkg_dict, guid)
+            if identity:
+                identities[identity] = guid
+        unknown = set(datasets) - set(identities.values())
+        if unknown:
+            for guid, identity in get_source_identities(
+                    harvest_job.source_id, unknown).items():
+                if identity.startswith(key + ':'):
+                    identities[identity] = guid
+
+        # Only the claims of the same datasets wait for each other
+        with advisory_lock(*['identity:%s' % identity
+                             for identity in identities]):
+            lost = claim_identities(harvest_job.source_id, priority,
+                                    identities)
+        dropped = set(identities[identity] for identity in lost)
+        if dropped:
+            log.info('Dropping %d datasets harvested by sources with a '
+                     'higher priority', len(dropped))
+        return dropped
+
+    def _create_or_update_package(self, package_dict, harvest_object,
+                                  package_dict_form='rest'):
+        '''
+        When the source sets `defer_indexing`, the package is written without
+        being indexed and is recorded for the reindex that runs once the job
+        has finished (see ckanext.toscana_harvest.indexing).
+
+        When the source sets `dedup`, datasets owned by another source are
+        left alone.
+
+        What has been imported is recorded in the mirror index (see
+        ckanext.toscana_harvest.mirror).
+        '''
+        settings = dedup.settings(self.config)
+        if settings:
+            identity = dedup.dataset_identity(settings[0], package_dict,
+                                              harvest_object.guid)
+            if identity:
+                source_id, guid = harvest_object.harvest_source_id, \
+                    harvest_object.guid
+
+                # Inside a batch the lock is only held by the claim
+                def claim():
+                    with advisory_lock('identity:%s' % identity):
+                        return claim_identities(source_id, settings[1],
+                                                {identity: guid})
+                lost = in_own_transaction(claim)
+                if lost:
+                    log.info('Skipping %s, it is harvested by a source with '
+                             'a higher priority', identity)
+                    return 'unchanged'
+
+        if self._bulk_packages is not None and package_dict.get('id') and \
+                not Session.query(model.Package.id) \
+                .filter(model.Package.id == package_dict['id']).first():
+            result = self._queue_bulk_package(package_dict, harvest_object,
+                                              package_dict_form)
+        elif not self.config.get('defer_indexing', False):
+            result = self._write_package(package_dict, harvest_object,
+                                         package_dict_form)
+        else:
+            with deferred_indexing():
+                result = self._write_package(package_dict, harvest_object,
+                                             package_dict_form)
+            if result is True:
+                defer_package_index(harvest_object.harvest_job_id,
+                                    harvest_object.package_id)
+
+        if result is True:
+            mirror.record_import(harvest_object.harvest_source_id,
+                                 harvest_object.guid,
+                                 harvest_object.package_id,
+                                 package_dict.get('metadata_modified'),
+                                 harvest_object.content)
+        return result
+
+    def _write_package(self, package_dict, harvest_object,
+                       package_dict_form):
+        '''
+        Creates or updates the package the way HarvesterBase does, but
+        committing through ckanext.toscana_harvest.model.commit and calling
+        the package actions with `defer_commit` inside a batch.
+        '''
+        assert package_dict_form in ('rest', 'package_show')
+        try:
+            schema = default_create_package_schema()
+            schema['id'] = [ignore_missing, unicode_safe]
+            schema['__junk'] = [ignore]
+            context = {'model': model, 'session': Session,
+                       'user': self._get_user_name(),
+                       'api_version': self.api_version, 'schema': schema,
+                       'ignore_auth': True,
+                       'defer_commit': commit_deferred()}
+
+            if self.config.get('clean_tags', False):
+                package_dict['tags'] = self._clean_tags(
+                    package_dict.get('tags', []))
+
+            try:
+                existing_package_dict = self._find_existing_package(
+                    package_dict)
+                # In case name has been modified when first importing
+                package_dict['name'] = existing_package_dict['name']
+                if 'metadata_modified' in package_dict and \
+                        package_dict['metadata_modified'] <= \
+                        existing_package_dict.get('metadata_modified'):
+                    log.info('No changes to package with GUID %s, '
+                             'skipping...', harvest_object.guid)
+                    return 'unchanged'
+
+                log.info('Package with GUID %s exists and needs to be '
+                         'updated', harvest_object.guid)
+                context['id'] = package_dict['id']
+                for field in toolkit.aslist(toolkit.config.get(
+                        'ckan.harvest.not_overwrite_fields')):
+                    if field in existing_package_dict:
+                        package_dict[field] = existing_package_dict[field]
+                new_package = get_action(
+                    'package_update' if package_dict_form == 'package_show'
+                    else 'package_update_rest')(context, package_dict)
+
+                # Flag the other objects linking to this package as not
+                # current anymore
+                Session.query(HarvestObject).filter(
+                    HarvestObject.package_id == new_package['id']).update(
+                        {'current': False})
+                harvest_object.package_id = new_package['id']
+                harvest_object.current = True
+                Session.add(harvest_object)
+            except NotFound:
+                context.pop('__auth_audit', None)
+                package_dict['name'] = self._gen_new_name(
+                    package_dict.get('name') or package_dict['title'])
+
+                log.info('Package with GUID %s does not exist, let\'s '
+                         'create it', harvest_object.guid)
+                harvest_object.current = True
+                harvest_object.package_id = package_dict['id']
+                # Defer constraints and flush so the dataset can be indexed
+                # with the harvest object id
+                Session.add(harvest_object)
+                Session.execute(sa.text('SET CONSTRAINTS '
+                                        'harvest_object_package_id_fkey '
+                                        'DEFERRED'))
+                Session.flush()
+                get_action(
+                    'package_create' if package_dict_form == 'package_show'
+                    else 'package_create_rest')(context, package_dict)
+
+            commit()
+            return True
+        except ValidationError as e:
+            log.exception(e)
+            self._save_object_error('Invalid package with GUID %s: %r' %
+                                    (harvest_object.guid, e.error_dict),
+                                    harvest_object, 'Import')
+        except Exception as e:
+            log.exception(e)
+            self._save_object_error('%r' % e, harvest_object, 'Import')
+        return None
+
+    def _queue_bulk_package(self, package_dict, harvest_object,
+                            package_dict_form):
+        '''
+        Prepares a new package like _create_or_update_package would and
+        queues it for _write_bulk_packages. The harvest object is linked to
+        the package straight away.
+        '''
+        if self.config.get('clean_tags', False):
+            package_dict['tags'] = self._clean_tags(
+                package_dict.get('tags', []))
+        if package_dict_form == 'rest':
+            package_dict = bulk.to_package_show_form(package_dict)
+
+        name = self._gen_new_name(package_dict.get('name') or
+                                  package_dict['title'])
+        if name in set(queued['name'] for queued, obj in self._bulk_packages):
+            # Taken by another package of the batch, not yet in the database
+            name = '%s-%s' % (name[:94], uuid.uuid4().hex[:5])
+        package_dict['name'] = name
+
+        harvest_object.package_id = package_dict['id']
+        harvest_object.current = True
+        self._bulk_packages.append((package_dict, harvest_object))
+        return True
+
+    def _write_bulk_packages(self, results):
+        '''
+        Validates the packages queued during a bulk_load batch and inserts the
+        valid ones with bulk SQL. Objects whose package is invalid are
+        flagged as errored and unlinked, and so are all of them if the
+        inserts fail, eg. on a name taken in the meantime. Returns the ids of
+        all the queued packages, which are either not written at all or left
+        for the reindex at the end of the job.
+        '''
+        queued, self._bulk_packages = self._bulk_packages, None
+        if not queued:
+            return set()
+        queued_ids = set(package_dict['id'] for package_dict, obj in queued)
+
+        user_name = self._get_user_name()
+        context = {'model': model, 'session': Session, 'user': user_name,
+                   'ignore_auth': True}
+        valid = []
+        validated = bulk.validate_packages(
+            [package_dict for package_dict, obj in queued], context)
+        for (package_dict, harvest_object), (data, errors) in \
+                zip(queued, validated):
+            if errors:
+                self._fail_bulk_package(
+                    harvest_object, results, 'Invalid package with GUID '
+                    '%s: %r' % (harvest_object.guid, errors))
+                continue
+            data['id'] = package_dict['id']
+            valid.append((data, harvest_object))
+
+        if valid:
+            savepoint = Session.begin_nested()
+            try:
+                bulk.write_packages([data for data, obj in valid],
+                                    model.User.get(user_name).id)
+                savepoint.commit()
+            except sa.exc.DBAPIError as e:
+                log.error('Bulk insert of %d packages failed: %s',
+                          len(valid), e)
+                if savepoint.is_active:
+                    savepoint.rollback()
+                for data, harvest_object in valid:
+                    self._fail_bulk_package(
+                        harvest_object, results, 'Could not write package '
+                        'with GUID %s: %s' % (harvest_object.guid, e.orig))
+                return queued_ids
+            for data, harvest_object in valid:
+                defer_package_index(harvest_object.harvest_job_id, data['id'])
+        return queued_ids
+
+    def _fail_bulk_package(self, harvest_object, results, message):
+        save(HarvestObjectError(message=message, object=harvest_object,
+                                stage='Import'))
+        harvest_object.package_id = None
+        harvest_object.current = False
+        results[harvest_object.id] = False
+        self._set_report_status(harvest_object, False)
+        save(harvest_object)
+
+    def get_import_batch_size(self):
+        return int(self.config.get('import_batch_size',
+                                   DEFAULT_IMPORT_BATCH_SIZE))
+
+    def fetch_and_import_batch(self, harvest_objects):
+        '''
+        Fetches the given harvest objects one by one and imports the ones
+        that were fetched successfully with import_batch().
+
+        Returns the number of objects that were imported successfully.
+        '''
+        fetched = []
+        for harvest_object in harvest_objects:
+            harvest_object.fetch_started = datetime.datetime.utcnow()
+            harvest_object.state = 'FETCH'
+            harvest_object.save()
+            success_fetch = self.fetch_stage(harvest_object)
+            harvest_object.fetch_finished = datetime.datetime.utcnow()
+            if success_fetch is True:
+                fetched.append(harvest_object)
+            elif success_fetch == 'unchanged':
+                harvest_object.state = 'COMPLETE'
+                harvest_object.report_status = 'not modified'
+            else:
+                harvest_object.state = 'ERROR'
+                harvest_object.report_status = 'errored'
+            harvest_object.save()
+
+        results = self.import_batch(fetched)
+        return len([r for r in results.values() if r])
+
+    def import_batch(self, harvest_objects):
+        '''
+        Imports several harvest objects in a single database transaction.
+        With `bulk_load` set, the new packages of the batch are written
+        together with bulk SQL at the end (see ckanext.toscana_harvest.bulk).
+
+        Every object is imported inside its own savepoint, so a dataset that
+        fails only rolls back its own changes. Search indexing is suspended
+        while the batch runs and the touched packages are reindexed together
+        once the transaction has been committed, or when the job finishes if
+        the source defers indexing. Should the transaction of the batch be
+        rolled back all the same, every object of the batch is flagged as
+        errored.
+
+        Returns a dict with the import result of each harvest object id.
+        '''
+        results = {}
+        package_ids = set()
+        started = time.time()
+
+        with deferred_indexing():
+            try:
+                with deferred_commit():
+                    batch_transaction = _root_transaction(Session())
+                    if self.config.get('bulk_load', False):
+                        # Harvest objects get linked to their new packages
+                        # before these are inserted
+                        self._bulk_packages = []
+                        Session.execute(sa.text(
+                            'SET CONSTRAINTS harvest_object_package_id_fkey '
+                            'DEFERRED'))
+                    try:
+                        for harvest_object in harvest_objects:
+                            result = self._import_in_savepoint(harvest_object)
+                            if _root_transaction(Session()) is not \
+                                    batch_transaction or \
+                                    not batch_transaction.is_active:
+                                raise BatchAborted(
+                                    'The transaction of the batch was rolled '
+                                    'back while importing object %s' %
+                                    harvest_object.id)
+                            results[harvest_object.id] = result
+                            if result is True and harvest_object.package_id:
+                                package_ids.add(harvest_object.package_id)
+                        package_ids -= self._write_bulk_packages(results)
+                    finally:
+                        self._bulk_packages = None
+            except BatchAborted as e:
+                return self._fail_batch(harvest_objects, e)
+            Session.commit()
+
+        if not self.config.get('defer_indexing', False):
+            index_packages(package_ids)
+
+        elapsed = time.time() - started
+        log.info('Imported %d harvest objects (%d errors) in %.2fs, '
+                 '%.1f objects/s', len(results),
+                 len([r for r in results.values() if not r]), elapsed,
+                 len(results) / elapsed if elapsed else 0)
+        return results
+
+    def _import_in_savepoint(self, harvest_object):
+        harvest_object.import_started = datetime.datetime.utcnow()
+        harvest_object.state = 'IMPORT'
+
+        self._batch_errors = []
+        savepoint = Session.begin_nested()
+        try:
+            result = self.import_stage(harvest_object)
+        except Exception as e:
+            log.exception(e)
+            self._batch_errors.append(('%r' % e, 'Import', None))
+            result = False
+        errors, self._batch_errors = self._batch_errors, None
+
+        if result and not errors and savepoint.is_active:
+            savepoint.commit()
+        else:
+            # A package or group action may have rolled the savepoint back
+            # already
+            if savepoint.is_active:
+                savepoint.rollback()
+            result = False
+            if self._bulk_packages:
+                self._bulk_packages = [
+                    queued for queued in self._bulk_packages
+                    if queued[1] is not harvest_object]
+            for message, stage, line in errors:
+                save(HarvestObjectError(message=message,
+                                        object=harvest_object, stage=stage,
+                                        line=line))
+
+        harvest_object.import_finished = datetime.datetime.utcnow()
+        self._set_report_status(harvest_object, result)
+        save(harvest_object)
+        return result
+
+    def _fail_batch(self, harvest_objects, error):
+        '''
+        Flags every object of a batch whose transaction has been lost as
+        errored, as none of what they imported has been kept.
+        '''
+        log.error('Import batch of %d objects failed: %s',
+                  len(harvest_objects), error)
+        Session.rollback()
+        results = {}
+        for harvest_object in harvest_objects:
+            HarvestObjectError(message='Import batch failed: %s' % error,
+                               object=harvest_object, stage='Import').save()
+            harvest_object.import_finished = datetime.datetime.utcnow()
+            self._set_report_status(harvest_object, False)
+            harvest_object.save()
+            results[harvest_object.id] = False
+        return results
+
+    @staticmethod
+    def _set_report_status(harvest_object, result):
+        # Same outcome as ckanext.harvest.queue.fetch_and_import_stages
+        if not result:
+            harvest_object.state = 'ERROR'
+            harvest_object.report_status = 'errored'
+            return
+        harvest_object.state = 'COMPLETE'
+        if result == 'unchanged':
+            harvest_object.report_status = 'not modified'
+        elif harvest_object.current is False:
+            harvest_object.report_status = 'deleted'
+        elif Session.query(HarvestObject) \
+                .filter_by(package_id=harvest_object.package_id) \
+                .limit(2).count() == 2:
+            harvest_object.report_status = 'updated'
+        else:
+            harvest_object.report_status = 'added'
+
+
+class ContentFetchError(Exception):
+    pass
+
+
+class ContentNotFoundError(ContentFetchError):
+    pass
+
+
+class RemoteResourceError(Exception):
+    pass
+
+
+class SearchError(Exception):
+    pass
@@ -1,208 +1,167 @@
+import datetime
 import urllib
-import http
+import urllib.parse
+import threading
+import time
 
-from ckan.lib.base import c
-from ckan import model
-from ckan.model import Session, Package
-from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.helpers import json
-from ckan.lib.munge import munge_name
 from simplejson.scanner import JSONDecodeError
 
-from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
-from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+from ckanext.toscana_harvest.harvesters.adapters import SpodAdapter
+from ckanext.toscana_harvest.harvesters.base import ToscanaHarvesterBase, \
+    ContentFetchError, ContentNotFoundError
+from ckanext.toscana_harvest.model import get_state, set_state, \
+    delete_states
+from ckanext.toscana_harvest import filters, mirror, timeouts
+from ckanext.toscana_harvest.profiling import profiled
 
 import logging
 log = logging.getLogger(__name__)
 
-class SpodHarvester(HarvesterBase):
+# Datasets per page of the action API searches
+SEARCH_PAGE_SIZE = 100
+
+class SpodHarvester(ToscanaHarvesterBase):
     '''
     A Harvester for Spod instances
     '''
     config = None
 
-    api_version = 2
-    action_api_version = 3
-
-    def _get_rest_api_offset(self):
-        return '/api/%d/rest' % self.api_version
-
-    def _get_action_api_offset(self):
-        return '/api/%d/action' % self.action_api_version
-
-    def _get_search_api_offset(self):
-        return '/api/%d/search' % self.api_version
-
-    def _get_content(self, url):
-        log.error("get_content " + url)
-        http_request = urllib.request.Request(url=url)
-
-        api_key = self.config.get('api_key')
-        if api_key:
-            http_request.add_header('Authorization', api_key)
-
-        try:
-            http_response = urllib.request.urlopen(http_request)
-        except urllib.error.HTTPError as e:
-            log.error("httperror")
-            log.error(e.getcode())
-            log.error(e.reason)
-            if e.getcode() == 404:
-                raise ContentNotFoundError('HTTP error: %s' % e.code)
-            else:
-                raise ContentFetchError('HTTP error: %s' % e.code)
-        except urllib.error.URLError as  e:
-            log.error("urlerror")
-            log.error(e.getcode())
-            log.error(e.reason)
-            raise ContentFetchError('URL error: %s' % e.reason)
-        except http.client.HTTPException as e:
-            log.error("httpexcption")
-            log.error(e.getcode())
-            log.error(e.reason)
-            raise ContentFetchError('HTTP Exception: %s' % e)
-        return http_response.read()
-
-    def _get_group(self, base_url, group_name):
-        url = base_url + self._get_rest_api_offset() + '/group/' + munge_name(group_name)
-        try:
-            content = self._get_content(url)
-            return json.loads(content)
-        except (ContentFetchError, ValueError):
-            log.error('Could not fetch/decode remote group');
-            raise RemoteResourceError('Could not fetch/decode remote group')
-
-    def _get_organization(self, base_url, org_name):
-        url = base_url + self._get_action_api_offset() + '/organization_show?id=' + org_name
-        try:
-            content = self._get_content(url)
-            content_dict = json.loads(content)
-            return content_dict['result']
-        except (ContentFetchError, ValueError, KeyError):
-            log.error('Could not fetch/decode remote group');
-            raise RemoteResourceError('Could not fetch/decode remote organization')
-
-    def _set_config(self,config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-            if 'api_version' in self.config:
-                self.api_version = int(self.config['api_version'])
-
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
-
-    def info(self):
-        return {
-            'name': 'Spod',
-            'title': 'Spod',
-            'description': 'Harvests remote Spod instances',
-            'form_config_interface':'Text'
-        }
-
-    def validate_config(self,config):
-        if not config:
-            return config
-
-        try:
-            config_obj = json.loads(config)
-
-            if 'api_version' in config_obj:
-                try:
-                    int(config_obj['api_version'])
-                except ValueError:
-                    raise ValueError('api_version must be an integer')
-
-            if 'default_tags' in config_obj:
-                if not isinstance(config_obj['default_tags'],list):
-                    raise ValueError('default_tags must be a list')
-
-            if 'default_groups' in config_obj:
-                if not isinstance(config_obj['default_groups'],list):
-                    raise ValueError('default_groups must be a list')
-
-                # Check if default groups exist
-                context = {'model':model,'user':c.user}
-                for group_name in config_obj['default_groups']:
-                    try:
-                        group = get_action('group_show')(context,{'id':group_name})
-                    except NotFound as e:
-                        raise ValueError('Default group not found')
-
-            if 'default_extras' in config_obj:
-                if not isinstance(config_obj['default_extras'],dict):
-                    raise ValueError('default_extras must be a dictionary')
-
-            if 'user' in config_obj:
-                # Check if user exists
-                context = {'model':model,'user':c.user}
-                try:
-                    user = get_action('user_show')(context,{'id':config_obj.get('user')})
-                except NotFound as e:
-                    raise ValueError('User not found')
-
-            for key in ('read_only','force_all'):
-                if key in config_obj:
-                    if not isinstance(config_obj[key],bool):
-                        raise ValueError('%s must be boolean' % key)
-
-        except ValueError as e:
-            raise e
-
-        return config
-
+    adapter_class = SpodAdapter
 
+    @profiled('gather')
     def gather_stage(self,harvest_job):
-        log.error('In SpodHarvester gather_stage (%s)' % harvest_job.source.url)
-        get_all_packages = True
+        log.debug('In SpodHarvester gather_stage (%s)' % harvest_job.source.url)
         package_ids = []
 
         self._set_config(harvest_job.source.config)
-
-        # Check if this source has been harvested before
-        previous_job = Session.query(HarvestJob) \
-                        .filter(HarvestJob.source==harvest_job.source) \
-                        .filter(HarvestJob.gather_finished!=None) \
-                        .filter(HarvestJob.id!=harvest_job.id) \
-                        .order_by(HarvestJob.gather_finished.desc()) \
-                        .limit(1).first()
+        self._start_gather_budget(harvest_job)
 
         # Get source URL
         base_url = harvest_job.source.url.rstrip('/')
         base_rest_url = base_url + self._get_rest_api_offset()
         base_search_url = base_url + self._get_search_api_offset()
 
-        # Filter in/out datasets from particular organizations
-        org_filter_include = self.config.get('organizations_filter_include', [])
-        org_filter_exclude = self.config.get('organizations_filter_exclude', [])
-        def get_pkg_ids_for_organizations(orgs):
-            pkg_ids = set()
-            for organization in orgs:
-                url = base_search_url + '/dataset?organization=%s' % organization
-                content = self._get_content(url)
-                content_json = json.loads(content)
-                result_count = int(content_json['count'])
-                pkg_ids |= set(content_json['results'])
-                while len(pkg_ids) < result_count or not content_json['results']:
-                    url = base_search_url + '/dataset?organization=%s&offset=%s' % (organization, len(pkg_ids))
-                    content = self._get_content(url)
-                    content_json = json.loads(content)
-                    pkg_ids |= set(content_json['results'])
-            return pkg_ids
-        include_pkg_ids = get_pkg_ids_for_organizations(org_filter_include)
-        exclude_pkg_ids = get_pkg_ids_for_organizations(org_filter_exclude)
+        # Sources with a dump of the remote catalogue are gathered from it
+        if self.config.get('dump'):
+            return self._gather_from_dump(harvest_job)
 
-        if (previous_job and not previous_job.gather_errors and not len(previous_job.objects) == 0):
-            if not self.config.get('force_all',False):
-                get_all_packages = True
+        # Paging progress is checkpointed, so that if this gather dies half
+        # way through a new run of it carries on from where it stopped
+        checkpoint_key = self._gather_checkpoint_key(harvest_job)
+        checkpoint = get_state(checkpoint_key, {'organizations': {}})
+        object_ids, created_ids = self._get_job_objects(harvest_job)
+
+        # The checkpoint only keeps how far each organization has been
+        # paged through, the ids of every page are stored on their own
+        def page_key(organization, page):
+            return '%s:%s:%d' % (checkpoint_key, organization, page)
+
+        try:
+            # One search tells whether anything has been added, removed or
+            # modified since the last error-free job, before every package is
+            # listed and fetched again
+            if not object_ids and not checkpoint['organizations'] and \
+                    self._remote_unchanged(harvest_job,
+                                           self._get_remote_summary(base_url)):
+                return []
+            if object_ids or checkpoint['organizations']:
+                log.info('Resuming gather of job %s, %d harvest objects already '
+                         'created' % (harvest_job.id, len(object_ids)))
+
+            # Create the remote organizations and groups up front, so the import
+            # stage does not have to fetch them one at a time
+            self._prefetch_remote_groups(harvest_job, base_url)
+
+            # Filter in/out datasets from particular organizations
+            org_filter_include = self.config.get('organizations_filter_include', [])
+            org_filter_exclude = self.config.get('organizations_filter_exclude', [])
+            # With gather_shards set, several organizations are paged through
+            # at the same time. The package list below is a single request, so
+            # without organization filters this does not speed up the listing
+            shards = self._get_gather_shards()
+            lock = threading.Lock()
+            # The number of datasets asked for per search page adapts to how
+            # fast the remote answers
+            page_size = self._get_page_size(harvest_job, 20)
+            def get_pkg_ids_for_organization(organization):
+                with lock:
+                    progress = checkpoint['organizations'].setdefault(
+                        organization, {'pages': 0, 'done': False})
+                org_pkg_ids = set()
+                for page in range(progress['pages']):
+                    org_pkg_ids.update(get_state(page_key(organization, page), []))
+                while not progress['done']:
+                    self._check_gather_budget()
+                    url = base_search_url + '/dataset?organization=%s&offset=%s&limit=%s' % (organization, len(org_pkg_ids), page_size.size)
+                    request_started = time.time()
+                    try:
+                        content = self._get_content(url)
+                    except ContentFetchError as e:
+                        if isinstance(e, ContentNotFoundError) or \
+                                not page_size.shrink():
+                            raise
+                        log.info('Search failed, retrying with limit %d: %s' %
+                                 (page_size.size, e))
+                        continue
+                    page_size.record(time.time() - request_started, len(content))
+                    content_json = json.loads(content)
+                    new_ids = set(content_json['results']) - org_pkg_ids
+                    org_pkg_ids |= new_ids
+                    with lock:
+                        if new_ids:
+                            set_state(page_key(organization,
+                                               progress['pages']),
+                                      list(new_ids))
+                            progress['pages'] += 1
+                        # A remote that ignores the offset keeps sending
+                        # the same page
+                        progress['done'] = not new_ids or \
+                            len(org_pkg_ids) >= int(content_json['count'])
+                        set_state(checkpoint_key, checkpoint)
+                return org_pkg_ids
+            def get_pkg_ids_for_organizations(orgs):
+                pkg_ids = set()
+                for org_pkg_ids in self._run_shards(get_pkg_ids_for_organization,
+                                                    orgs, len(shards)):
+                    pkg_ids |= org_pkg_ids
+                return pkg_ids
+            try:
+                include_pkg_ids = get_pkg_ids_for_organizations(org_filter_include)
+                exclude_pkg_ids = get_pkg_ids_for_organizations(org_filter_exclude)
+            except timeouts.BudgetExceeded as e:
+                # Only the objects created by an earlier run of this gather
+                # go on
+                self._save_gather_error('%s listing the datasets of the '
+                                        'organizations' % e, harvest_job)
+                return object_ids
+            finally:
+                page_size.save()
+
+            # Datasets this source has already imported and that have not been
+            # modified on the remote since the last error-free job are not
+            # fetched again
+            modified_ids = None
+            last_error_free_job = self.last_error_free_job(harvest_job)
+            if last_error_free_job and not self.config.get('force_all', False):
+                # Going back a little earlier, in case the clocks differ
+                since = (last_error_free_job.gather_started -
+                         datetime.timedelta(hours=1)).isoformat()
+                try:
+                    modified_ids = self._get_modified_ids(base_url, since)
+                    log.info('%d datasets modified since %s UTC' %
+                             (len(modified_ids), since))
+                except (ContentFetchError, ValueError, KeyError, TypeError) as e:
+                    log.info('Could not list the modified datasets, getting all '
+                             'of them: %s' % e)
+                except timeouts.BudgetExceeded as e:
+                    self._save_gather_error('%s listing the modified datasets' %
+                                            e, harvest_job)
+                    return object_ids
 
-        if get_all_packages:
             # Request all remote packages
-            log.error("Request all remote packages")
             url = base_rest_url + '/package'
-            log.error(url)
+            log.info('Requesting all remote packages: %s' % url)
             try:
                 content = self._get_content(url)
                 package_ids = json.loads(content)
@@ -215,230 +174,170 @@ class SpodHarvester(HarvesterBase):
                 self._save_gather_error('Unable to decode content for URL: %s: %s' % (url, str(e)),harvest_job)
                 return None
 
-        if org_filter_include:
-            package_ids = set(package_ids) & include_pkg_ids
-        elif org_filter_exclude:
-            package_ids = set(package_ids) - exclude_pkg_ids
+            if org_filter_include:
+                package_ids = set(package_ids) & include_pkg_ids
+            elif org_filter_exclude:
+                package_ids = set(package_ids) - exclude_pkg_ids
 
-        try:
-            object_ids = []
-            if len(package_ids):
-                for package_id in package_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid = package_id, job = harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-
-                return object_ids
+            # The package list only has ids (names with api_version 1), the
+            # datasets the filter keeps are found with the action API search
+            # so the others are never fetched
+            if self.config.get('filter'):
+                try:
+                    package_ids = set(package_ids) & \
+                        self._get_filtered_ids(base_url)
+                except (ContentFetchError, ValueError, KeyError, TypeError) as e:
+                    log.info('Could not search for the datasets matching the '
+                             'filter, it is applied at import: %s' % e)
+                except timeouts.BudgetExceeded as e:
+                    self._save_gather_error('%s searching for the datasets '
+                                            'matching the filter' % e,
+                                            harvest_job)
+                    return object_ids
 
-            else:
-                self._save_gather_error('No packages received for URL: %s' % url,
-                       harvest_job)
-                log.error("No packages received for URL")
+            try:
+                if len(package_ids):
+                    # Each gather shard creates the harvest objects of its part
+                    # of the id space
+                    shard_package_ids = [[] for shard in shards]
+                    # Datasets harvested by a source with a higher priority
+                    dropped = self._drop_duplicates(harvest_job, dict.fromkeys(
+                        set(package_ids) - created_ids))
+                    # The package list only has ids, so the mirror index can
+                    # not tell unchanged datasets apart, only the ones that
+                    # have gone from the remote
+                    self._mirror_listing(harvest_job, dict.fromkeys(package_ids))
+                    mirror.finish_full_listing(harvest_job.source_id,
+                                               harvest_job.id)
+                    # The package list carries no modification times, so new
+                    # datasets simply go before the ones already harvested
+                    local_guids = self._get_local_guids(harvest_job)
+                    for package_id in package_ids:
+                        if package_id in created_ids or package_id in dropped:
+                            continue
+                        if modified_ids is not None and \
+                                package_id in local_guids and \
+                                package_id not in modified_ids:
+                            continue
+                        shard_package_ids[self._shard_of(package_id, shards)] \
+                            .append(package_id)
+                    def create_harvest_objects(shard_ids):
+                        # Create a new HarvestObject for each identifier
+                        return [self._create_harvest_object(
+                                    harvest_job, package_id, priority=self._priority(
+                                        package_id, None, local_guids))
+                                for package_id in shard_ids]
+                    # Each shard is handed to the fetch queue once created
+                    handoff = self._get_fetch_handoff()
+                    def create_and_hand_off(shard_ids):
+                        shard_object_ids = create_harvest_objects(shard_ids)
+                        handoff.add(shard_object_ids)
+                        return shard_object_ids
+                    try:
+                        for shard_object_ids in self._run_shards(
+                                create_and_hand_off, shard_package_ids):
+                            object_ids.extend(shard_object_ids)
+                    finally:
+                        handoff.close()
+
+                    return handoff.remaining(
+                        self._sort_by_priority(harvest_job, object_ids))
+
+                else:
+                    self._save_gather_error('No packages received for URL: %s' % url,
+                           harvest_job)
+                    log.error("No packages received for URL")
+                    return None
+            except Exception as e:
+                log.exception(e)
+                self._save_gather_error('%r' % e, harvest_job)
                 return None
-        except Exception as e:
-            log.error(e.message)
-            self._save_gather_error('%r'%e.message,harvest_job)
-
-
-    def fetch_stage(self,harvest_object):
-        log.error('In SpodHarvester fetch_stage')
-
-        self._set_config(harvest_object.job.source.config)
-
-        # Get source URL
-        url = harvest_object.source.url.rstrip('/')
-        url = url + self._get_rest_api_offset() + '/package/' + harvest_object.guid
-
-        # Get contents
+        finally:
+            # The checkpoint is only needed if the gather dies, whatever it
+            # returns or raises there is nothing left to resume
+            delete_states([checkpoint_key] + [
+                page_key(organization, page)
+                for organization, progress in
+                checkpoint['organizations'].items()
+                for page in range(progress['pages'])])
+
+
+    def _list_key(self, pkg_dict):
+        '''
+        Returns what the REST package list gives for a dataset found by the
+        action API search: its name with api_version 1, its id otherwise.
+        '''
+        if self.api_version == 1:
+            return pkg_dict['name']
+        return pkg_dict['id']
+
+    def _get_modified_ids(self, base_url, since):
+        '''
+        Returns the remote datasets modified since `since`, an ISO date and
+        time in UTC, paging through the action API search. They are given
+        the way the REST package list gives them (see _list_key).
+        '''
+        params = {'fq': 'metadata_modified:[%sZ TO *]' % since,
+                  'fl': 'id,name', 'sort': 'id asc', 'rows': '1000',
+                  'start': 0}
+        modified_ids = set()
+        while True:
+            self._check_gather_budget()
+            url = base_url + self._get_action_api_offset() + \
+                '/package_search?' + urllib.parse.urlencode(params)
+            result = json.loads(self._get_content(url))['result']
+            page_ids = set(self._list_key(pkg_dict)
+                           for pkg_dict in result['results'])
+            if not page_ids - modified_ids:
+                return modified_ids
+            modified_ids |= page_ids
+            if len(modified_ids) >= int(result['count']):
+                return modified_ids
+            params['start'] += int(params['rows'])
+
+    def _get_filtered_ids(self, base_url):
+        '''
+        Returns the remote datasets that match the `filter` of the source,
+        paging through the action API search narrowed down by the fq terms
+        of the filter. They are given the way the REST package list gives
+        them (see _list_key).
+        '''
+        params = {'sort': 'id asc', 'rows': SEARCH_PAGE_SIZE, 'start': 0}
+        fq_terms = filters.to_fq_terms(self.config['filter'])
+        if fq_terms:
+            params['fq'] = ' '.join(fq_terms)
+        seen_ids = set()
+        filtered_ids = set()
+        while True:
+            self._check_gather_budget()
+            url = base_url + self._get_action_api_offset() + \
+                '/package_search?' + urllib.parse.urlencode(params)
+            result = json.loads(self._get_content(url))['result']
+            page = dict((pkg_dict['id'], pkg_dict)
+                        for pkg_dict in result['results']
+                        if pkg_dict['id'] not in seen_ids)
+            if not page:
+                return filtered_ids
+            seen_ids.update(page)
+            filtered_ids.update(self._list_key(page[package_id])
+                                for package_id in
+                                set(page) - self._filter_out(page))
+            if len(seen_ids) >= int(result['count']):
+                return filtered_ids
+            params['start'] += params['rows']
+
+    def _get_remote_summary(self, base_url):
+        '''
+        Returns the number of datasets of the remote and the
+        metadata_modified of the most recently modified one, or None if the
+        remote can not tell.
+        '''
+        url = base_url + self._get_action_api_offset() + \
+            '/package_search?rows=1&sort=metadata_modified+desc'
         try:
-            content = self._get_content(url)
-        except ContentFetchError as e:
-            log.error('Unable to get content for package: %s: %r' % (url, e))
-            self._save_object_error('Unable to get content for package: %s: %r' % \
-                                        (url, e),harvest_object)
+            result = json.loads(self._get_content(url))['result']
+        except (ContentFetchError, ValueError, KeyError, TypeError) as e:
+            log.info('Could not get the latest modification time: %s' % e)
             return None
-
-        # Save the fetched contents in the HarvestObject
-        harvest_object.content = content
-        harvest_object.save()
-        return True
-
-    def import_stage(self,harvest_object):
-        log.error('In SpodHarvester import_stage')
-
-        context = {'model': model, 'session': Session, 'user': self._get_user_name()}
-        if not harvest_object:
-            log.error('No harvest object received')
-            return False
-
-        if harvest_object.content is None:
-            self._save_object_error('Empty content for object %s' % harvest_object.id,
-                    harvest_object, 'Import')
-            return False
-
-        self._set_config(harvest_object.job.source.config)
-
-        try:
-            package_dict = json.loads(harvest_object.content)
-
-            if package_dict.get('type') == 'harvest':
-                log.warn('Remote dataset is a harvest source, ignoring...')
-                return True
-
-            # Set default tags if needed
-            default_tags = self.config.get('default_tags',[])
-            if default_tags:
-                if not 'tags' in package_dict:
-                    package_dict['tags'] = []
-                package_dict['tags'].extend([t for t in default_tags if t not in package_dict['tags']])
-
-            remote_groups = self.config.get('remote_groups', None)
-            if not remote_groups in ('only_local', 'create'):
-                # Ignore remote groups
-                package_dict.pop('groups', None)
-            else:
-                if not 'groups' in package_dict:
-                    package_dict['groups'] = []
-
-                # check if remote groups exist locally, otherwise remove
-                validated_groups = []
-
-                for group_name in package_dict['groups']:
-                    try:
-                        data_dict = {'id': group_name}
-                        group = get_action('group_show')(context, data_dict)
-                        if self.api_version == 1:
-                            validated_groups.append(group['name'])
-                        else:
-                            validated_groups.append(group['id'])
-                    except NotFound as e:
-                        log.info('Group %s is not available' % group_name)
-                        if remote_groups == 'create':
-                            try:
-                                group = self._get_group(harvest_object.source.url, group_name)
-                            except RemoteResourceError:
-                                log.error('Could not get remote group %s' % group_name)
-                                continue
-
-                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
-                                group.pop(key, None)
-
-                            get_action('group_create')(context, group)
-                            log.info('Group %s has been newly created' % group_name)
-                            if self.api_version == 1:
-                                validated_groups.append(group['name'])
-                            else:
-                                validated_groups.append(group['id'])
-
-                package_dict['groups'] = validated_groups
-
-
-            # Local harvest source organization
-            source_dataset = get_action('package_show')(context, {'id': harvest_object.source.id})
-            local_org = source_dataset.get('owner_org')
-
-            remote_orgs = self.config.get('remote_orgs', None)
-
-            if not remote_orgs in ('only_local', 'create'):
-                # Assign dataset to the source organization
-                package_dict['owner_org'] = local_org
-            else:
-                if not 'owner_org' in package_dict:
-                    package_dict['owner_org'] = None
-
-                # check if remote org exist locally, otherwise remove
-                validated_org = None
-                remote_org = package_dict['owner_org']
-
-                if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(context, data_dict)
-                        validated_org = org['id']
-                    except NotFound as e:
-                        log.info('Organization %s is not available' % remote_org)
-                        if remote_orgs == 'create':
-                            try:
-                                try:
-                                    org = self._get_organization(harvest_object.source.url, remote_org)
-                                except RemoteResourceError:
-                                    # fallback if remote Spod exposes organizations as groups
-                                    # this especially targets older versions of Spod
-                                    org = self._get_group(harvest_object.source.url, remote_org)
-
-                                for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
-                                    org.pop(key, None)
-                                get_action('organization_create')(context, org)
-                                log.info('Organization %s has been newly created' % remote_org)
-                                validated_org = org['id']
-                            except (RemoteResourceError, ValidationError):
-                                log.error('Could not get remote org %s' % remote_org)
-
-                package_dict['owner_org'] = validated_org or local_org
-
-            # Set default groups if needed
-            default_groups = self.config.get('default_groups', [])
-            if default_groups:
-                if not 'groups' in package_dict:
-                    package_dict['groups'] = []
-                package_dict['groups'].extend([g for g in default_groups if g not in package_dict['groups']])
-
-            # Find any extras whose values are not strings and try to convert
-            # them to strings, as non-string extras are not allowed anymore in
-            # CKAN 2.0.
-            for key in package_dict['extras'].keys():
-                if not isinstance(package_dict['extras'][key], basestring):
-                    try:
-                        package_dict['extras'][key] = json.dumps(
-                                package_dict['extras'][key])
-                    except TypeError:
-                        # If converting to a string fails, just delete it.
-                        del package_dict['extras'][key]
-
-            # Set default extras if needed
-            default_extras = self.config.get('default_extras',{})
-            if default_extras:
-                override_extras = self.config.get('override_extras',False)
-                if not 'extras' in package_dict:
-                    package_dict['extras'] = {}
-                for key,value in default_extras.items():
-                    if not key in package_dict['extras'] or override_extras:
-                        # Look for replacement strings
-                        if isinstance(value,basestring):
-                            value = value.format(harvest_source_id=harvest_object.job.source.id,
-                                     harvest_source_url=harvest_object.job.source.url.strip('/'),
-                                     harvest_source_title=harvest_object.job.source.title,
-                                     harvest_job_id=harvest_object.job.id,
-                                     harvest_object_id=harvest_object.id,
-                                     dataset_id=package_dict['id'])
-
-                        package_dict['extras'][key] = value
-
-            for resource in package_dict.get('resources', []):
-                # Clear remote url_type for resources (eg datastore, upload) as
-                # we are only creating normal resources with links to the
-                # remote ones
-                resource.pop('url_type', None)
-
-                # Clear revision_id as the revision won't exist on this CKAN
-                # and saving it will cause an IntegrityError with the foreign
-                # key.
-                resource.pop('revision_id', None)
-
-            result = self._create_or_update_package(package_dict,harvest_object)
-            return result
-        except ValidationError as e:
-            self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
-                    harvest_object, 'Import')
-        except Exception as e:
-            self._save_object_error('%r'%e,harvest_object,'Import')
-
-class ContentFetchError(Exception):
-    pass
-
-class ContentNotFoundError(ContentFetchError):
-    pass
-
-class RemoteResourceError(Exception):
-    pass
+        results = result.get('results') or [{}]
+        return [result.get('count'), results[0].get('metadata_modified')]
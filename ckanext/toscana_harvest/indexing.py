@@ -0,0 +1,117 @@
+import contextlib
+
+from sqlalchemy import exists
+
+from ckan.model import Session
+from ckan.lib import search
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestJob
+from ckanext.toscana_harvest.model import pending_index_table, commit
+
+import logging
+log = logging.getLogger(__name__)
+
+REINDEX_CHUNK_SIZE = 100
+
+
+@contextlib.contextmanager
+def deferred_indexing():
+    '''
+    Stops CKAN from reindexing every package as soon as it is committed.
+
+    The caller is responsible for calling index_packages() with the ids of
+    the packages touched inside the block.
+    '''
+    key = 'ckan.search.automatic_indexing'
+    missing = object()
+    previous = toolkit.config.get(key, missing)
+    toolkit.config[key] = False
+    try:
+        yield
+    finally:
+        if previous is missing:
+            toolkit.config.pop(key, None)
+        else:
+            toolkit.config[key] = previous
+
+
+def index_packages(package_ids, progress=None):
+    '''
+    Reindexes the given packages, committing the search index once per
+    chunk of REINDEX_CHUNK_SIZE packages.
+
+    If given, `progress` is called with the number of packages indexed so
+    far and the total after every chunk.
+    '''
+    package_ids = sorted(package_ids)
+    for i in range(0, len(package_ids), REINDEX_CHUNK_SIZE):
+        search.rebuild(package_ids=package_ids[i:i + REINDEX_CHUNK_SIZE],
+                       defer_commit=True, quiet=True)
+        search.commit()
+        if progress:
+            progress(min(i + REINDEX_CHUNK_SIZE, len(package_ids)),
+                     len(package_ids))
+
+
+def defer_package_index(harvest_job_id, package_id):
+    '''
+    Records that a package imported by the given job needs reindexing when
+    the job finishes.
+    '''
+    table = pending_index_table
+    already_pending = Session.query(exists().where(
+        (table.c.harvest_job_id == harvest_job_id) &
+        (table.c.package_id == package_id))).scalar()
+    if not already_pending:
+        Session.execute(table.insert().values(
+            harvest_job_id=harvest_job_id, package_id=package_id))
+    commit()
+
+
+def reindex_job(harvest_job_id, progress=None):
+    '''
+    Reindexes the packages recorded for a job that deferred indexing and
+    clears them. Returns the number of packages reindexed.
+
+    The pending rows are deleted before indexing and only committed once the
+    index is up to date, so concurrent callers never reindex the same job
+    twice and a failure leaves the rows in place for the next attempt.
+    '''
+    table = pending_index_table
+    result = Session.execute(
+        table.delete()
+             .where(table.c.harvest_job_id == harvest_job_id)
+             .returning(table.c.package_id))
+    package_ids = [row[0] for row in result]
+    if not package_ids:
+        Session.rollback()
+        return 0
+
+    if progress is None:
+        def progress(done, total):
+            log.info('Reindexed %d/%d packages imported by job %s',
+                     done, total, harvest_job_id)
+    try:
+        index_packages(package_ids, progress)
+    except Exception:
+        Session.rollback()
+        raise
+    Session.commit()
+    return len(package_ids)
+
+
+def reindex_finished_jobs():
+    '''
+    Runs reindex_job() for every finished job with packages still waiting
+    to be indexed.
+    '''
+    table = pending_index_table
+    job_ids = [job_id for (job_id,) in
+               Session.query(table.c.harvest_job_id).distinct()
+                      .join(HarvestJob,
+                            HarvestJob.id == table.c.harvest_job_id)
+                      .filter(HarvestJob.status == u'Finished')]
+    for job_id in job_ids:
+        count = reindex_job(job_id)
+        log.info('Reindexed %d packages deferred by job %s', count, job_id)
@@ -0,0 +1,246 @@
+'''
+Checking the URLs of harvested resources.
+
+With `link_check` in the source configuration:
+
+    "link_check": {"per_host": 4, "timeout": 10, "ttl_hours": 24}
+
+every job of the source, once flagged as finished, queues a CKAN background
+job (run by `ckan jobs worker`) that checks the resources of the datasets
+the job added or updated, so imports are never held up by it. asyncio
+schedules the checks, with at most `per_host` of them to the same host at a
+time, but the HEAD requests themselves are blocking urllib calls run on a
+pool of `max_workers` threads: there is no async HTTP client among the
+requirements. Only http and https URLs of hosts that resolve to public
+addresses are checked (redirects included), so a source can not point the
+checks at the internal network. The others are skipped and get no extras.
+The results are cached for
+`ttl_hours`, so a URL checked by a recent job is not checked again, and are
+stored on each resource as the `link_ok`, `link_status`, `link_latency_ms`
+and `link_checked` extras.
+
+The toscana_harvest_link_check table is the record of the checks. The
+resource extras are advisory: they are written straight to the database,
+so the next package_update of the dataset (by a later harvest or by hand)
+drops them until its link check puts them back from the table.
+'''
+import asyncio
+import collections
+import datetime
+import ipaddress
+import socket
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.dialects.postgresql import insert
+
+from ckan import model
+from ckan.model import Session
+from ckan.lib.helpers import json
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.toscana_harvest.indexing import index_packages
+from ckanext.toscana_harvest.model import link_check_table
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'per_host': 4,
+    'timeout': 10,
+    'ttl_hours': 24,
+    'max_workers': 32,
+}
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('link_check must be a dictionary')
+    for key in DEFAULTS:
+        try:
+            if float(value.get(key, DEFAULTS[key])) <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValueError('link_check %s must be a positive number' % key)
+
+
+def _settings(harvest_job):
+    config = json.loads(harvest_job.source.config or '{}')
+    if 'link_check' not in config:
+        return None
+    return dict(DEFAULTS, **config['link_check'])
+
+
+def enqueue_link_checks(harvest_job_ids):
+    '''
+    Queues the link check of those of the given finished jobs whose source
+    asks for it.
+    '''
+    for harvest_job_id in harvest_job_ids:
+        harvest_job = HarvestJob.get(harvest_job_id)
+        if harvest_job and _settings(harvest_job):
+            toolkit.enqueue_job(
+                check_job_links, [harvest_job_id],
+                title=u'Check resource links of harvest job %s' %
+                      harvest_job_id)
+
+
+def check_job_links(harvest_job_id):
+    '''
+    Checks the resource URLs of the datasets added or updated by a job and
+    records the results on the resources. Runs as a background job.
+    '''
+    harvest_job = HarvestJob.get(harvest_job_id)
+    settings = harvest_job and _settings(harvest_job)
+    if not settings:
+        return
+
+    package_ids = [package_id for (package_id,) in
+                   Session.query(HarvestObject.package_id)
+                          .filter(HarvestObject.harvest_job_id ==
+                                  harvest_job_id)
+                          .filter(HarvestObject.current == True)
+                          .filter(HarvestObject.report_status.in_(
+                              [u'added', u'updated']))]
+    if not package_ids:
+        return
+    resources = Session.query(model.Resource) \
+        .filter(model.Resource.package_id.in_(package_ids)) \
+        .filter(model.Resource.state == u'active') \
+        .all()
+    urls = set(resource.url for resource in resources
+               if urllib.parse.urlparse(resource.url or '').scheme
+               in ('http', 'https'))
+
+    results = _get_cached(urls, float(settings['ttl_hours']))
+    to_check = urls - set(results)
+    log.info('Checking %d resource URLs of job %s (%d cached)',
+             len(to_check), harvest_job_id, len(results))
+    started = time.time()
+    checked = asyncio.run(_check_urls(to_check, settings))
+    log.info('Checked %d URLs in %.2fs', len(checked), time.time() - started)
+    _set_cached(checked)
+    results.update(checked)
+
+    for resource in resources:
+        result = results.get(resource.url)
+        if result:
+            resource.extras = dict(resource.extras or {}, **{
+                'link_ok': result['ok'],
+                'link_status': result['status'] or result['error'],
+                'link_latency_ms': result['latency_ms'],
+                'link_checked': result['checked'].isoformat(),
+            })
+    Session.commit()
+    # package_show serves the search index copy of the datasets
+    index_packages(package_ids)
+
+
+def _get_cached(urls, ttl_hours):
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=ttl_hours)
+    urls = list(urls)
+    results = {}
+    for i in range(0, len(urls), 1000):
+        for row in Session.query(link_check_table) \
+                .filter(link_check_table.c.url.in_(urls[i:i + 1000])) \
+                .filter(link_check_table.c.checked >= since):
+            results[row.url] = row._asdict()
+    return results
+
+
+def _set_cached(results):
+    if not results:
+        return
+    table = link_check_table
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.url],
+        set_=dict((name, statement.excluded[name]) for name in
+                  ('status', 'ok', 'latency_ms', 'error', 'checked')))
+    Session.execute(statement,
+                    [dict(result, url=url) for url, result in results.items()])
+    Session.commit()
+
+
+async def _check_urls(urls, settings):
+    loop = asyncio.get_event_loop()
+    per_host = int(settings['per_host'])
+    timeout = float(settings['timeout'])
+    hosts = collections.defaultdict(lambda: asyncio.Semaphore(per_host))
+
+    with ThreadPoolExecutor(int(settings['max_workers'])) as executor:
+        async def check(url):
+            async with hosts[urllib.parse.urlparse(url).netloc]:
+                return url, await loop.run_in_executor(
+                    executor, _check_url, url, timeout)
+        results = await asyncio.gather(*[check(url) for url in urls])
+    return dict((url, result) for url, result in results if result)
+
+
+def _is_public(url):
+    '''
+    Whether the URL is http or https and its host only resolves to public
+    addresses. Raises socket.gaierror if the host does not resolve.
+    '''
+    parsed = urllib.parse.urlparse(url)
+    try:
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            return False
+        port = parsed.port
+    except ValueError:
+        return False
+    addresses = socket.getaddrinfo(parsed.hostname, port)
+    # The scope of IPv6 link-local addresses follows a %
+    return all(ipaddress.ip_address(address[4][0].split('%')[0]).is_global
+               for address in addresses)
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not _is_public(newurl):
+            raise urllib.error.URLError(
+                'redirected to a non public address: %s' % newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_PublicRedirectHandler)
+
+
+def _check_url(url, timeout):
+    '''
+    Returns the result of checking a URL, or None if it is not checked as
+    its host is not public.
+    '''
+    started = time.time()
+    status = error = None
+    try:
+        if not _is_public(url):
+            log.debug('Not checking %s, not a public address', url)
+            return None
+    except socket.gaierror as e:
+        error = ('%s' % e)[:200]
+    methods = ('HEAD', 'GET') if error is None else ()
+    for method in methods:
+        request = urllib.request.Request(url, method=method)
+        if method == 'GET':
+            # Some servers do not allow HEAD, only ask for the first byte
+            request.add_header('Range', 'bytes=0-0')
+        try:
+            response = _opener.open(request, timeout=timeout)
+            status = response.status
+            response.close()
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception as e:
+            error = ('%s' % e)[:200]
+        if status not in (405, 501):
+            break
+    return {'status': status,
+            'ok': status is not None and 200 <= status < 400,
+            'latency_ms': int((time.time() - started) * 1000),
+            'error': error,
+            'checked': datetime.datetime.utcnow()}
@@ -0,0 +1,30 @@
+from ckan.model import Session
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestJob
+from ckanext.toscana_harvest.harvesters.base import delete_job_states
+from ckanext.toscana_harvest.indexing import reindex_finished_jobs
+from ckanext.toscana_harvest.linkcheck import enqueue_link_checks
+
+
+@toolkit.chained_action
+def harvest_jobs_run(original_action, context, data_dict):
+    '''
+    Runs the ckanext-harvest action, which flags the jobs that are done as
+    finished, and then reindexes the packages those jobs deferred, queues
+    the link checks of the sources that want them and deletes the state the
+    harvesters kept for the jobs.
+    '''
+    running_job_ids = [job_id for (job_id,) in
+                       Session.query(HarvestJob.id)
+                              .filter(HarvestJob.status == u'Running')]
+    result = original_action(context, data_dict)
+    reindex_finished_jobs()
+    if running_job_ids:
+        finished_job_ids = [job_id for (job_id,) in
+                            Session.query(HarvestJob.id)
+                                   .filter(HarvestJob.id.in_(running_job_ids))
+                                   .filter(HarvestJob.status == u'Finished')]
+        enqueue_link_checks(finished_job_ids)
+        delete_job_states(finished_job_ids)
+    return result
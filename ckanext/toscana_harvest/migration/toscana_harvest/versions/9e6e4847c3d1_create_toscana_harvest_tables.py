@@ -0,0 +1,95 @@
+"""create toscana harvest tables
+
+Revision ID: 9e6e4847c3d1
+Revises:
+Create Date: 2026-10-19 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9e6e4847c3d1"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    if "toscana_harvest_pending_index" not in tables:
+        op.create_table(
+            "toscana_harvest_pending_index",
+            sa.Column("harvest_job_id", sa.UnicodeText, primary_key=True),
+            sa.Column("package_id", sa.UnicodeText, primary_key=True),
+        )
+
+    if "toscana_harvest_state" not in tables:
+        op.create_table(
+            "toscana_harvest_state",
+            sa.Column("key", sa.UnicodeText, primary_key=True),
+            sa.Column("value", sa.UnicodeText),
+            sa.Column("modified", sa.DateTime),
+        )
+
+    if "toscana_harvest_identity" not in tables:
+        op.create_table(
+            "toscana_harvest_identity",
+            sa.Column("identity", sa.UnicodeText, primary_key=True),
+            sa.Column("harvest_source_id", sa.UnicodeText, nullable=False),
+            sa.Column("guid", sa.UnicodeText),
+            sa.Column("priority", sa.Integer, nullable=False),
+            sa.Column("modified", sa.DateTime),
+        )
+        op.create_index(
+            "idx_toscana_harvest_identity_source_guid",
+            "toscana_harvest_identity",
+            ["harvest_source_id", "guid"],
+        )
+
+    if "toscana_harvest_link_check" not in tables:
+        op.create_table(
+            "toscana_harvest_link_check",
+            sa.Column("url", sa.UnicodeText, primary_key=True),
+            sa.Column("status", sa.Integer),
+            sa.Column("ok", sa.Boolean, nullable=False),
+            sa.Column("latency_ms", sa.Integer),
+            sa.Column("error", sa.UnicodeText),
+            sa.Column("checked", sa.DateTime, nullable=False),
+        )
+
+    if "toscana_harvest_mirror" not in tables:
+        op.create_table(
+            "toscana_harvest_mirror",
+            sa.Column("harvest_source_id", sa.UnicodeText, primary_key=True),
+            sa.Column("remote_id", sa.UnicodeText, primary_key=True),
+            sa.Column("name", sa.UnicodeText),
+            sa.Column("metadata_modified", sa.UnicodeText),
+            sa.Column("last_seen_job_id", sa.UnicodeText),
+            sa.Column("last_seen", sa.DateTime),
+            sa.Column("package_id", sa.UnicodeText),
+            sa.Column("imported_modified", sa.UnicodeText),
+            sa.Column("digest", sa.UnicodeText),
+            sa.Column("imported", sa.DateTime),
+        )
+        op.create_index(
+            "idx_toscana_harvest_mirror_source_modified",
+            "toscana_harvest_mirror",
+            ["harvest_source_id", "metadata_modified"],
+        )
+        op.create_index(
+            "idx_toscana_harvest_mirror_source_seen",
+            "toscana_harvest_mirror",
+            ["harvest_source_id", "last_seen_job_id"],
+        )
+
+
+def downgrade():
+    op.drop_table("toscana_harvest_mirror")
+    op.drop_table("toscana_harvest_link_check")
+    op.drop_table("toscana_harvest_identity")
+    op.drop_table("toscana_harvest_state")
+    op.drop_table("toscana_harvest_pending_index")
@@ -0,0 +1,157 @@
+'''
+Local mirror index of the remote catalogues.
+
+For every source the toscana_harvest_mirror table keeps one row per remote
+dataset with what gather last listed (id, name, metadata_modified, the job
+that listed it) and what was last imported from it (local package id, the
+metadata_modified and a digest of the content imported).
+
+Gather records every page it lists and does not create harvest objects for
+the datasets whose modification time or content digest matches the last
+import of a package that is still there. When a gather has listed the whole
+remote catalogue, the rows it did not see are the datasets that have gone
+from the remote. All of this is answered by indexed queries on the table.
+'''
+import datetime
+import hashlib
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from ckan import model
+from ckan.model import Session
+
+from ckanext.toscana_harvest.model import mirror_table, get_state, set_state, \
+    commit
+
+import logging
+log = logging.getLogger(__name__)
+
+QUERY_CHUNK_SIZE = 1000
+
+
+def digest(content):
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def record_listing(source_id, job_id, entries):
+    '''
+    Records datasets listed by a gather. `entries` is a list of dicts with
+    the 'remote_id' and, if known, the 'name' and 'metadata_modified' of
+    each dataset. Commits.
+    '''
+    now = datetime.datetime.utcnow()
+    table = mirror_table
+    # A row can only be upserted once per statement
+    rows = list(dict(
+        (entry['remote_id'],
+         {'harvest_source_id': source_id,
+          'remote_id': entry['remote_id'],
+          'name': entry.get('name'),
+          'metadata_modified': entry.get('metadata_modified'),
+          'last_seen_job_id': job_id,
+          'last_seen': now}) for entry in entries).values())
+    for i in range(0, len(rows), QUERY_CHUNK_SIZE):
+        statement = insert(table).values(rows[i:i + QUERY_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.harvest_source_id, table.c.remote_id],
+            set_={
+                'name': sa.func.coalesce(statement.excluded.name,
+                                         table.c.name),
+                'metadata_modified': sa.func.coalesce(
+                    statement.excluded.metadata_modified,
+                    table.c.metadata_modified),
+                'last_seen_job_id': statement.excluded.last_seen_job_id,
+                'last_seen': statement.excluded.last_seen,
+            })
+        Session.execute(statement)
+    Session.commit()
+
+
+def unchanged(source_id, entries):
+    '''
+    Returns the remote ids of those `entries` (dicts with the 'remote_id'
+    and the 'metadata_modified' or content 'digest' of listed datasets)
+    that match what was last imported into a package that is still active.
+    '''
+    entries = dict((entry['remote_id'], entry) for entry in entries
+                   if entry.get('metadata_modified') or entry.get('digest'))
+    remote_ids = list(entries)
+    result = set()
+    for i in range(0, len(remote_ids), QUERY_CHUNK_SIZE):
+        rows = Session.query(mirror_table.c.remote_id,
+                             mirror_table.c.imported_modified,
+                             mirror_table.c.digest) \
+            .join(model.Package, model.Package.id == mirror_table.c.package_id) \
+            .filter(model.Package.state == u'active') \
+            .filter(mirror_table.c.harvest_source_id == source_id) \
+            .filter(mirror_table.c.remote_id.in_(
+                remote_ids[i:i + QUERY_CHUNK_SIZE]))
+        for remote_id, imported_modified, imported_digest in rows:
+            entry = entries[remote_id]
+            if (entry.get('metadata_modified') and
+                    entry['metadata_modified'] == imported_modified) or \
+                    (entry.get('digest') and entry['digest'] == imported_digest):
+                result.add(remote_id)
+    return result
+
+
+def record_import(source_id, remote_id, package_id, metadata_modified,
+                  content):
+    '''
+    Records that a remote dataset has been imported into a package. Commits.
+    '''
+    now = datetime.datetime.utcnow()
+    values = {'package_id': package_id,
+              'imported_modified': metadata_modified,
+              'digest': digest(content) if content else None,
+              'imported': now}
+    statement = insert(mirror_table).values(
+        harvest_source_id=source_id, remote_id=remote_id, **values)
+    Session.execute(statement.on_conflict_do_update(
+        index_elements=[mirror_table.c.harvest_source_id,
+                        mirror_table.c.remote_id],
+        set_=values))
+    commit()
+
+
+def finish_full_listing(source_id, job_id):
+    '''
+    Called once a gather has listed the whole remote catalogue. Returns the
+    number of datasets that have gone from the remote since.
+    '''
+    set_state('mirror:%s' % source_id, {'full_listing_job_id': job_id})
+    missing = _missing_query(source_id, job_id).count()
+    if missing:
+        log.info('%d datasets of source %s are no longer on the remote',
+                 missing, source_id)
+    return missing
+
+
+def _missing_query(source_id, job_id):
+    return Session.query(mirror_table) \
+        .filter(mirror_table.c.harvest_source_id == source_id) \
+        .filter(mirror_table.c.last_seen_job_id != job_id)
+
+
+def report(source_id):
+    '''
+    Returns a dict with the number of remote datasets the mirror holds for a
+    source, how many of them have been imported and how many have gone from
+    the remote, with their ids and local packages.
+    '''
+    table = mirror_table
+    query = Session.query(table).filter(table.c.harvest_source_id == source_id)
+    state = get_state('mirror:%s' % source_id) or {}
+    missing = []
+    if state.get('full_listing_job_id'):
+        missing = [(row.remote_id, row.name, row.package_id) for row in
+                   _missing_query(source_id, state['full_listing_job_id'])]
+    return {
+        'total': query.count(),
+        'imported': query.filter(table.c.package_id != None).count(),
+        'full_listing_job_id': state.get('full_listing_job_id'),
+        'missing': missing,
+    }
@@ -0,0 +1,260 @@
+import contextlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Table, Column, Index, text, types
+
+from ckan.model import meta
+from ckan.model.meta import Session
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestSource
+
+import logging
+log = logging.getLogger(__name__)
+
+# Packages imported by a job that defers search indexing, waiting to be
+# reindexed once the job has finished
+pending_index_table = Table(
+    'toscana_harvest_pending_index', meta.metadata,
+    Column('harvest_job_id', types.UnicodeText, primary_key=True),
+    Column('package_id', types.UnicodeText, primary_key=True),
+)
+
+# Small JSON documents the harvesters keep between runs, such as gather
+# checkpoints. Keys are namespaced by what they belong to, eg.
+# 'gather:<job id>'
+state_table = Table(
+    'toscana_harvest_state', meta.metadata,
+    Column('key', types.UnicodeText, primary_key=True),
+    Column('value', types.UnicodeText),
+    Column('modified', types.DateTime, default=datetime.datetime.utcnow,
+           onupdate=datetime.datetime.utcnow),
+)
+
+# The source that owns each dataset harvested by more than one source, see
+# ckanext.toscana_harvest.dedup
+identity_table = Table(
+    'toscana_harvest_identity', meta.metadata,
+    Column('identity', types.UnicodeText, primary_key=True),
+    Column('harvest_source_id', types.UnicodeText, nullable=False),
+    Column('guid', types.UnicodeText),
+    Column('priority', types.Integer, nullable=False, default=0),
+    Column('modified', types.DateTime, default=datetime.datetime.utcnow,
+           onupdate=datetime.datetime.utcnow),
+)
+Index('idx_toscana_harvest_identity_source_guid',
+      identity_table.c.harvest_source_id, identity_table.c.guid)
+
+# Results of the last check of resource URLs, see
+# ckanext.toscana_harvest.linkcheck
+link_check_table = Table(
+    'toscana_harvest_link_check', meta.metadata,
+    Column('url', types.UnicodeText, primary_key=True),
+    Column('status', types.Integer),
+    Column('ok', types.Boolean, nullable=False),
+    Column('latency_ms', types.Integer),
+    Column('error', types.UnicodeText),
+    Column('checked', types.DateTime, nullable=False),
+)
+
+# What each source last listed of its remote catalogue and what of it has
+# been imported, see ckanext.toscana_harvest.mirror
+mirror_table = Table(
+    'toscana_harvest_mirror', meta.metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('remote_id', types.UnicodeText, primary_key=True),
+    Column('name', types.UnicodeText),
+    Column('metadata_modified', types.UnicodeText),
+    Column('last_seen_job_id', types.UnicodeText),
+    Column('last_seen', types.DateTime),
+    Column('package_id', types.UnicodeText),
+    Column('imported_modified', types.UnicodeText),
+    Column('digest', types.UnicodeText),
+    Column('imported', types.DateTime),
+)
+Index('idx_toscana_harvest_mirror_source_modified',
+      mirror_table.c.harvest_source_id, mirror_table.c.metadata_modified)
+Index('idx_toscana_harvest_mirror_source_seen',
+      mirror_table.c.harvest_source_id, mirror_table.c.last_seen_job_id)
+
+IDENTITY_QUERY_CHUNK_SIZE = 1000
+
+# Key of Session.info set while a batch import defers its commits, see
+# ckanext.toscana_harvest.harvesters.base.deferred_commit
+DEFERRED_COMMIT = 'toscana_harvest_deferred_commit'
+
+
+def commit_deferred():
+    '''
+    Whether the session of this thread is importing a batch whose changes
+    are committed together at the end.
+    '''
+    return bool(Session().info.get(DEFERRED_COMMIT))
+
+
+def commit():
+    '''
+    Commits the session, or only flushes it while a batch import defers
+    its commits.
+    '''
+    if commit_deferred():
+        Session.flush()
+    else:
+        Session.commit()
+
+
+def save(obj):
+    '''
+    Like DomainObject.save(), going through commit().
+    '''
+    Session.add(obj)
+    commit()
+
+
+def in_own_transaction(function, *args):
+    '''
+    Calls `function` with its own database session and transaction, which
+    it has to commit, when the session of this thread is importing a batch
+    (see ckanext.toscana_harvest.harvesters.base.deferred_commit).
+
+    Inside a batch the advisory locks and the rows written would otherwise
+    be held until the whole batch commits, and two batches taking the same
+    locks in a different order would deadlock. The function runs in a
+    thread of its own, as scoped sessions are per thread. Outside a batch it
+    is a plain call.
+    '''
+    if not commit_deferred():
+        return function(*args)
+
+    def run():
+        try:
+            return function(*args)
+        finally:
+            Session.remove()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run).result()
+
+
+@contextlib.contextmanager
+def advisory_lock(*keys):
+    '''
+    Holds PostgreSQL advisory locks on `keys` until the current transaction
+    ends, serializing the block across processes and database sessions.
+    The locks are taken in a fixed order, so callers locking overlapping
+    sets of keys do not deadlock.
+    '''
+    keys = ['toscana_harvest:%s' % key for key in keys]
+    if len(keys) == 1:
+        Session.execute(
+            text('SELECT pg_advisory_xact_lock(hashtext(:key))'),
+            {'key': keys[0]})
+    elif keys:
+        Session.execute(text(
+            'SELECT pg_advisory_xact_lock(lock_key) FROM '
+            '(SELECT DISTINCT hashtext(key) AS lock_key '
+            'FROM unnest(CAST(:keys AS text[])) AS key '
+            'ORDER BY lock_key) AS lock_keys'), {'keys': keys})
+    yield
+
+
+def get_state(key, default=None, for_update=False):
+    '''
+    Returns the value stored under `key`, or `default` if there is none.
+
+    With `for_update` the row stays locked until the transaction ends, so
+    a read-modify-write cycle is not interleaved with other workers.
+    '''
+    query = Session.query(state_table.c.value) \
+                   .filter(state_table.c.key == key)
+    if for_update:
+        query = query.with_for_update()
+    row = query.first()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+
+def set_state(key, value):
+    '''
+    Stores a JSON serializable `value` under `key` and commits.
+    '''
+    value = json.dumps(value)
+    updated = Session.execute(
+        state_table.update()
+                   .where(state_table.c.key == key)
+                   .values(value=value)).rowcount
+    if not updated:
+        Session.execute(state_table.insert().values(key=key, value=value))
+    Session.commit()
+
+
+def delete_state(key):
+    Session.execute(state_table.delete().where(state_table.c.key == key))
+    Session.commit()
+
+
+def delete_states(keys):
+    keys = list(keys)
+    if keys:
+        Session.execute(state_table.delete().where(state_table.c.key.in_(keys)))
+        Session.commit()
+
+
+def get_source_identities(source_id, guids):
+    '''
+    Returns a dict with the identities claimed by a source for those of
+    `guids` that it has claimed.
+    '''
+    guids = list(guids)
+    identities = {}
+    for i in range(0, len(guids), IDENTITY_QUERY_CHUNK_SIZE):
+        identities.update(
+            (guid, identity) for identity, guid in Session.query(
+                identity_table.c.identity, identity_table.c.guid)
+            .filter(identity_table.c.harvest_source_id == source_id)
+            .filter(identity_table.c.guid.in_(
+                guids[i:i + IDENTITY_QUERY_CHUNK_SIZE])))
+    return identities
+
+
+def claim_identities(source_id, priority, identities):
+    '''
+    Claims the `identities` (a dict of identity to guid) for a source and
+    commits. An identity already owned by another active source with the
+    same or a higher priority is not taken over.
+
+    Returns the identities that are owned by another source.
+    '''
+    keys = list(identities)
+    owners = {}
+    for i in range(0, len(keys), IDENTITY_QUERY_CHUNK_SIZE):
+        owners.update(
+            (row.identity, row) for row in Session.query(identity_table)
+            .filter(identity_table.c.identity.in_(
+                keys[i:i + IDENTITY_QUERY_CHUNK_SIZE])))
+    active_source_ids = set(source_id for (source_id,) in Session.query(
+        HarvestSource.id).filter(HarvestSource.active == True).filter(
+        HarvestSource.id.in_(set(o.harvest_source_id
+                                 for o in owners.values()))))
+
+    lost = set()
+    for identity, guid in identities.items():
+        owner = owners.get(identity)
+        values = {'harvest_source_id': source_id, 'guid': guid,
+                  'priority': priority}
+        if owner is None:
+            Session.execute(identity_table.insert().values(
+                identity=identity, **values))
+        elif owner.harvest_source_id != source_id and \
+                owner.harvest_source_id in active_source_ids and \
+                owner.priority >= priority:
+            lost.add(identity)
+        elif (owner.harvest_source_id, owner.guid, owner.priority) != \
+                (source_id, guid, priority):
+            Session.execute(identity_table.update()
+                            .where(identity_table.c.identity == identity)
+                            .values(**values))
+    commit()
+    return lost
@@ -0,0 +1,97 @@
+'''
+Adaptive page size for the remote searches.
+
+The number of datasets asked for per page of a remote search is tuned per
+source within the bounds of the `page_size` key of the source configuration:
+
+    "page_size": {"min": 20, "max": 1000, "target_seconds": 5,
+                  "target_bytes": 5000000}
+
+The size doubles while pages come back in less than half the target time and
+size, halves when they take longer or are bigger than the target, and halves
+again, retrying the page, when a request fails (timeouts, 5xx). The size
+reached is stored in the state table and is where the next gather starts.
+'''
+import threading
+
+from ckanext.toscana_harvest.model import get_state, set_state
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'min': 10,
+    'max': 1000,
+    'target_seconds': 5,
+    'target_bytes': 5 * 1024 * 1024,
+}
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('page_size must be a dictionary')
+    settings = dict(DEFAULTS, **value)
+    for key in DEFAULTS:
+        try:
+            if float(settings[key]) <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValueError('page_size %s must be a positive number' % key)
+    if int(settings['min']) > int(settings['max']):
+        raise ValueError('page_size min must not be greater than max')
+
+
+class PageSizeTuner(object):
+    '''
+    Keeps the page size of the searches of a source. It can be shared by
+    the threads of a sharded gather.
+    '''
+
+    def __init__(self, source_id, config, initial):
+        settings = dict(DEFAULTS, **(config or {}))
+        self.min = int(settings['min'])
+        self.max = int(settings['max'])
+        self.target_seconds = float(settings['target_seconds'])
+        self.target_bytes = int(settings['target_bytes'])
+        self.key = 'page_size:%s' % source_id
+        self.saved = get_state(self.key)
+        self.size = self._bounded(self.saved or initial)
+        self.lock = threading.Lock()
+
+    def _bounded(self, size):
+        return max(self.min, min(self.max, int(size)))
+
+    def record(self, seconds, length):
+        '''
+        Records how long a page of the current size took and how big it
+        was, and adjusts the size for the next one.
+        '''
+        with self.lock:
+            if seconds > self.target_seconds or length > self.target_bytes:
+                self._resize(self.size // 2)
+            elif seconds < self.target_seconds / 2 and \
+                    length < self.target_bytes / 2:
+                self._resize(self.size * 2)
+
+    def shrink(self):
+        '''
+        Halves the size after a failed request. Returns False if it is at
+        the minimum already, in which case the failure is not down to the
+        page size.
+        '''
+        with self.lock:
+            if self.size <= self.min:
+                return False
+            self._resize(self.size // 2)
+            return True
+
+    def _resize(self, size):
+        size = self._bounded(size)
+        if size != self.size:
+            log.debug('Page size %d -> %d', self.size, size)
+            self.size = size
+
+    def save(self):
+        if self.size != self.saved:
+            set_state(self.key, self.size)
+            self.saved = self.size
@@ -0,0 +1,175 @@
+'''
+Handing harvest objects over to the fetch queue while gather is running.
+
+Normally gather_stage returns the ids of all the harvest objects at the end
+and the gather consumer publishes them to the fetch queue, so fetch and
+import only start once the whole remote catalogue has been listed. With
+
+    "pipeline": {"chunk_size": 500, "max_queue_depth": 5000, "max_wait": 600}
+
+in the source configuration the objects are published in chunks as gather
+creates them, and gather_stage only returns the ones it has not published
+yet. Publishing waits while the fetch queue holds more than
+`max_queue_depth` messages, so a fast gather does not flood it. If the queue
+is still that deep after `max_wait` seconds, or once the gather has run out
+of time, publishing stops and the objects not published yet are returned by
+gather_stage as usual.
+'''
+import queue
+import threading
+import time
+
+from ckanext.harvest.queue import get_fetch_publisher, get_fetch_queue_name
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_QUEUE_DEPTH = 5000
+DEFAULT_MAX_WAIT = 600
+BACKPRESSURE_WAIT = 1
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('pipeline must be a dictionary')
+    for key in ('chunk_size', 'max_queue_depth', 'max_wait'):
+        try:
+            if int(value.get(key, 1)) < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValueError('pipeline %s must be a positive integer' % key)
+
+
+class FetchHandoff(object):
+    '''
+    Publishes the harvest objects of a gather to the fetch queue in chunks.
+    Without settings it publishes nothing and leaves it all to the gather
+    consumer. It can be shared by the threads of a sharded gather.
+    '''
+
+    def __init__(self, settings=None, budget=None):
+        self.enabled = bool(settings)
+        settings = settings or {}
+        self.chunk_size = int(settings.get('chunk_size', DEFAULT_CHUNK_SIZE))
+        self.max_queue_depth = int(settings.get('max_queue_depth',
+                                                DEFAULT_MAX_QUEUE_DEPTH))
+        self.max_wait = int(settings.get('max_wait', DEFAULT_MAX_WAIT))
+        # TimeBudget of the gather, waiting for the queue stops with it
+        self.budget = budget
+        self.pending = []
+        self.published = set()
+        self.publisher = None
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+
+    def add(self, object_ids):
+        '''
+        Adds newly created (and committed) harvest objects, publishing them
+        once there is a chunk of them.
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            self.pending.extend(object_ids)
+            if len(self.pending) < self.chunk_size:
+                return
+            chunk, self.pending = self.pending, []
+        if not self._publish(chunk):
+            with self.lock:
+                self.pending = chunk + self.pending
+
+    def remaining(self, object_ids):
+        '''
+        Returns those of `object_ids` that have not been published, for
+        gather_stage to return.
+        '''
+        return [object_id for object_id in object_ids
+                if object_id not in self.published]
+
+    def close(self):
+        if self.publisher:
+            self.publisher.close()
+            self.publisher = None
+
+    def _publish(self, chunk):
+        '''
+        Publishes a chunk once the fetch queue has room for it. Returns
+        False, and stops publishing altogether, if there is no room before
+        `max_wait` seconds have passed or the gather has run out of time.
+        '''
+        started = time.time()
+        while True:
+            with self.publish_lock:
+                if not self.enabled:
+                    return False
+                if self.publisher is None:
+                    self.publisher = get_fetch_publisher()
+                if self._queue_depth() <= self.max_queue_depth:
+                    for object_id in chunk:
+                        self.publisher.send({'harvest_object_id': object_id})
+                    self.published.update(chunk)
+                    log.debug('Sent %d objects to the fetch queue during '
+                              'gather', len(chunk))
+                    return True
+                out_of_time = self.budget is not None and \
+                    self.budget.remaining() is not None and \
+                    self.budget.remaining() <= 0
+                if out_of_time or time.time() - started > self.max_wait:
+                    log.warning('The fetch queue holds more than %d messages, '
+                                'leaving the rest of the objects to the end '
+                                'of the gather', self.max_queue_depth)
+                    self.enabled = False
+                    return False
+            # Other shards can add objects while this one waits
+            time.sleep(BACKPRESSURE_WAIT)
+
+    def _queue_depth(self):
+        if hasattr(self.publisher, 'redis'):
+            return self.publisher.redis.llen(self.publisher.routing_key)
+        frame = self.publisher.channel.queue_declare(
+            queue=get_fetch_queue_name(), durable=True, passive=True)
+        return frame.method.message_count
+
+
+class BatchHandoff(object):
+    '''
+    Hands the harvest objects of a gather over in batches to something
+    running in the same process, eg. the worker pool of `toscana_harvest
+    run`, instead of the fetch queue. `batches` is a queue.Queue of lists of
+    harvest object ids, ended by None once finish() has been called.
+    '''
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batches = queue.Queue()
+        self.pending = []
+        self.published = set()
+        self.lock = threading.Lock()
+
+    def add(self, object_ids):
+        with self.lock:
+            self.pending.extend(object_ids)
+            while len(self.pending) >= self.batch_size:
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[self.batch_size:]
+                self.published.update(batch)
+                self.batches.put(batch)
+
+    def remaining(self, object_ids):
+        return [object_id for object_id in object_ids
+                if object_id not in self.published]
+
+    def close(self):
+        pass
+
+    def finish(self, object_ids=None):
+        '''
+        Hands over what gather_stage returned that has not been handed over
+        yet and ends `batches`.
+        '''
+        object_ids = self.remaining(object_ids or [])
+        for i in range(0, len(object_ids), self.batch_size):
+            self.batches.put(object_ids[i:i + self.batch_size])
+        self.published.update(object_ids)
+        self.batches.put(None)
@@ -1,9 +1,15 @@
+from ckanext.toscana_harvest.harvesters.spodharvester import SpodHarvester
+from ckanext.toscana_harvest.harvesters.metarepoharvester import MetarepoHarvester
+from ckanext.toscana_harvest import cli
+from ckanext.toscana_harvest.logic import action
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
 
 class ToscanaHarvestPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -11,3 +17,15 @@ class ToscanaHarvestPlugin(plugins.SingletonPlugin):
         toolkit.add_template_directory(config_, 'templates')
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'toscana-harvest')
+
+    # IActions
+
+    def get_actions(self):
+        return {
+            'harvest_jobs_run': action.harvest_jobs_run,
+        }
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
@@ -0,0 +1,153 @@
+'''
+Opt-in profiling of the harvest stages.
+
+Profiling is switched on either by the `profile` key of the source
+configuration:
+
+    "profile": {"stages": ["gather", "import"], "every": 100,
+                "output_dir": "/var/lib/ckan/harvest-profiles"}
+
+or, for every source, by environment variables:
+
+    TOSCANA_HARVEST_PROFILE=fetch,import
+    TOSCANA_HARVEST_PROFILE_EVERY=100
+    TOSCANA_HARVEST_PROFILE_DIR=/var/lib/ckan/harvest-profiles
+
+Every Nth call of a selected stage of a source (gather is always picked)
+runs under cProfile and tracemalloc. The stats and the top allocations are
+written to <output_dir>/<job id>/<stage>-<object id>.prof and .txt.
+
+cProfile is not a sampling profiler: it traces every function call of the
+calls it profiles, which makes them several times slower. Only the calls are
+sampled, so this is meant to be switched on for a while to look into a
+source, not left on in production.
+'''
+import cProfile
+import functools
+import io
+import itertools
+import os
+import pstats
+import tracemalloc
+
+from ckan.lib.helpers import json
+from ckan.plugins import toolkit
+
+import logging
+log = logging.getLogger(__name__)
+
+STAGES = ('gather', 'fetch', 'import')
+DEFAULT_EVERY = 100
+TOP_ALLOCATIONS = 25
+
+_counters = {}
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('profile must be a dictionary')
+    stages = value.get('stages', STAGES)
+    if not isinstance(stages, list) or \
+            not all(stage in STAGES for stage in stages):
+        raise ValueError('profile stages must be a list of %s' %
+                         ', '.join(STAGES))
+    try:
+        if int(value.get('every', DEFAULT_EVERY)) < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError('profile every must be a positive integer')
+
+
+def _settings(config):
+    '''
+    Returns (stages, every, output_dir), or None if profiling is off.
+    '''
+    settings = (config or {}).get('profile')
+    env_stages = os.environ.get('TOSCANA_HARVEST_PROFILE')
+    if not settings and not env_stages:
+        return None
+    settings = settings or {}
+    if env_stages:
+        stages = [s.strip() for s in env_stages.split(',') if s.strip()]
+    else:
+        stages = settings.get('stages', STAGES)
+    every = int(os.environ.get('TOSCANA_HARVEST_PROFILE_EVERY') or
+                settings.get('every', DEFAULT_EVERY))
+    output_dir = os.environ.get('TOSCANA_HARVEST_PROFILE_DIR') or \
+        settings.get('output_dir') or \
+        os.path.join(toolkit.config.get('ckan.storage_path') or '/tmp',
+                     'toscana_harvest', 'profiles')
+    return stages, every, output_dir
+
+
+def profiled(stage):
+    '''
+    Decorates a harvester stage method so that it is profiled when the
+    source or the environment asks for it.
+
+    The decorated method takes a harvest job (gather) or a harvest object
+    (fetch and import). When profiling is off the only overhead is a
+    substring check on the source config and an environment lookup.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, target):
+            # The stages deal with being called without a job or object
+            if target is None:
+                return method(self, target)
+            job = target if stage == 'gather' else target.job
+            config_str = job.source.config or ''
+            if '"profile"' not in config_str and \
+                    'TOSCANA_HARVEST_PROFILE' not in os.environ:
+                return method(self, target)
+
+            settings = _settings(json.loads(config_str) if config_str else {})
+            if not settings or stage not in settings[0]:
+                return method(self, target)
+
+            stages, every, output_dir = settings
+            counter = _counters.setdefault((job.source_id, stage),
+                                           itertools.count())
+            if stage != 'gather' and next(counter) % every:
+                return method(self, target)
+
+            path = os.path.join(output_dir, job.id, '%s-%s' % (
+                stage, target.id))
+            return _profile(method, self, target, path)
+        return wrapper
+    return decorator
+
+
+def _profile(method, harvester, target, path):
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(method, harvester, target)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            _write_artifacts(profile, snapshot, path)
+        except (IOError, OSError) as e:
+            log.error('Could not write profile to %s: %s', path, e)
+
+
+def _write_artifacts(profile, snapshot, path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    profile.dump_stats(path + '.prof')
+
+    stream = io.StringIO()
+    stream.write('Top %d allocations\n\n' % TOP_ALLOCATIONS)
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        stream.write('%s\n' % stat)
+    stream.write('\nTop functions by cumulative time\n\n')
+    pstats.Stats(profile, stream=stream) \
+          .sort_stats('cumulative').print_stats(TOP_ALLOCATIONS)
+    with open(path + '.txt', 'w') as f:
+        f.write(stream.getvalue())
+    log.info('Profile written to %s.prof', path)
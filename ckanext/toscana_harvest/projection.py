@@ -0,0 +1,93 @@
+'''
+Projection of the remote datasets stored in the harvest objects.
+
+Gather, fetch and dump ingestion store in the harvest objects only the
+fields of the remote datasets that the import stage uses. Dropped by
+default are the fields describing the remote site itself (revisions,
+tracking summaries, followers, relationships), the `url_type`, revision and
+tracking summary of the resources, and everything but the id, name and
+title of the groups and organization. More fields can be dropped with the
+`projection` key of the source configuration:
+
+    "projection": {"drop": ["notes_rendered"], "resource_drop": ["datastore_active"]}
+
+and `"projection": false` stores the remote datasets as they come.
+'''
+from ckan.lib.helpers import json
+
+import logging
+log = logging.getLogger(__name__)
+
+DROP = ('revision_id', 'tracking_summary', 'num_followers',
+        'relationships_as_object', 'relationships_as_subject')
+RESOURCE_DROP = ('url_type', 'revision_id', 'tracking_summary')
+GROUP_FIELDS = ('id', 'name', 'title')
+
+
+def validate_config(value):
+    if value is False:
+        return
+    if not isinstance(value, dict):
+        raise ValueError('projection must be a dictionary or false')
+    for key in ('drop', 'resource_drop'):
+        fields = value.get(key, [])
+        if not isinstance(fields, list) or \
+                not all(isinstance(field, str) for field in fields):
+            raise ValueError('projection %s must be a list of field names' %
+                             key)
+    if 'id' in value.get('drop', []):
+        raise ValueError('projection can not drop the dataset id')
+
+
+def _group(group):
+    if not isinstance(group, dict):
+        return group
+    return dict((key, group[key]) for key in GROUP_FIELDS if key in group)
+
+
+def project(pkg_dict, config=None):
+    '''
+    Returns a copy of a remote dataset dict, in either the package_show or
+    the REST form, with only the fields the import stage uses. `config` is
+    the `projection` of the source configuration.
+    '''
+    if config is False or not isinstance(pkg_dict, dict):
+        return pkg_dict
+    config = config or {}
+    drop = set(DROP).union(config.get('drop', []))
+    resource_drop = set(RESOURCE_DROP).union(config.get('resource_drop', []))
+
+    projected = dict((key, value) for key, value in pkg_dict.items()
+                     if key not in drop)
+    if isinstance(projected.get('resources'), list):
+        projected['resources'] = [
+            dict((key, value) for key, value in resource.items()
+                 if key not in resource_drop)
+            if isinstance(resource, dict) else resource
+            for resource in projected['resources']]
+    if isinstance(projected.get('groups'), list):
+        projected['groups'] = [_group(group) for group in projected['groups']]
+    if isinstance(projected.get('organization'), dict):
+        projected['organization'] = _group(projected['organization'])
+    return projected
+
+
+def project_content(content, config=None, wrapped=False):
+    '''
+    Projects the dataset of a fetched response body, found under 'result'
+    when `wrapped`. Returns the content unchanged if it is not JSON.
+    '''
+    if config is False:
+        return content
+    try:
+        response_dict = json.loads(content)
+    except ValueError:
+        return content
+    if wrapped:
+        if not isinstance(response_dict, dict) or \
+                not isinstance(response_dict.get('result'), dict):
+            return content
+        response_dict['result'] = project(response_dict['result'], config)
+    else:
+        response_dict = project(response_dict, config)
+    return json.dumps(response_dict)
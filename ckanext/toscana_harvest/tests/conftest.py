@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture
+def clean_db(reset_db, migrate_db_for):
+    reset_db()
+    migrate_db_for('harvest')
+    migrate_db_for('toscana_harvest')
@@ -0,0 +1,91 @@
+"""Tests for harvesters/adapters.py."""
+from ckan.lib.helpers import json
+
+from ckanext.toscana_harvest.harvesters.adapters import SpodAdapter, \
+    MetarepoAdapter
+
+
+class TestSpodAdapter(object):
+
+    def test_package_content(self):
+        pkg_dict = {
+            'id': 'dataset-id',
+            'extras': [{'key': 'region', 'value': 'Toscana'}],
+            'tags': [{'name': 'ambiente'}, 'acqua'],
+            'groups': [{'id': 'group-id', 'name': 'environment'},
+                       {'id': 'other-group-id'}, 'health'],
+        }
+        content = json.loads(SpodAdapter().package_content(pkg_dict))
+
+        assert content == {
+            'id': 'dataset-id',
+            'extras': {'region': 'Toscana'},
+            'tags': ['ambiente', 'acqua'],
+            'groups': ['environment', 'other-group-id', 'health'],
+        }
+        assert pkg_dict['extras'] == [{'key': 'region', 'value': 'Toscana'}]
+
+    def test_extras(self):
+        adapter = SpodAdapter()
+        package_dict = {}
+        adapter.set_extra(package_dict, 'region', 'Toscana')
+        assert package_dict == {'extras': {'region': 'Toscana'}}
+        assert adapter.get_extra(package_dict, 'region') == 'Toscana'
+        assert adapter.get_extra({'extras': None}, 'region') is None
+
+    def test_clean_package(self):
+        package_dict = {'extras': {'count': 1, 'tags': ['a'],
+                                   'region': 'Toscana'}}
+        SpodAdapter().clean_package(package_dict)
+        assert package_dict['extras'] == {'count': '1', 'tags': '["a"]',
+                                          'region': 'Toscana'}
+
+    def test_add_default_groups(self):
+        package_dict = {'groups': ['environment']}
+        SpodAdapter().add_default_groups(
+            package_dict, {'default_groups': ['environment', 'health']})
+        assert package_dict['groups'] == ['environment', 'health']
+
+
+class TestMetarepoAdapter(object):
+
+    def test_package_content(self):
+        adapter = MetarepoAdapter()
+        content = adapter.package_content({'id': 'dataset-id'})
+
+        assert json.loads(content) == {'result': {'id': 'dataset-id'}}
+        assert adapter.parse_package(content) == {'id': 'dataset-id'}
+        assert adapter.parse_package('{"id": "dataset-id"}') == \
+            {'id': 'dataset-id'}
+
+    def test_extras(self):
+        adapter = MetarepoAdapter()
+        package_dict = {'extras': [{'key': 'region', 'value': 'Lazio'},
+                                   {'key': 'other', 'value': 'x'}]}
+        adapter.set_extra(package_dict, 'region', 'Toscana')
+
+        assert package_dict['extras'] == [
+            {'key': 'other', 'value': 'x'},
+            {'key': 'region', 'value': 'Toscana'}]
+        assert adapter.get_extra(package_dict, 'region') == \
+            {'key': 'region', 'value': 'Toscana'}
+        assert adapter.get_extra({}, 'region') is None
+
+    def test_groups(self):
+        adapter = MetarepoAdapter()
+        package_dict = {'groups': [{'id': 'group-id', 'name': 'environment'}]}
+        adapter.add_default_groups(package_dict, {'default_group_dicts': [
+            {'id': 'group-id', 'name': 'environment'},
+            {'id': 'other-group-id', 'name': 'health'}]})
+
+        assert [g['id'] for g in package_dict['groups']] == \
+            ['group-id', 'other-group-id']
+        assert adapter.group_id({'id': 'group-id'}) == 'group-id'
+        assert adapter.local_group(
+            {'id': 'group-id', 'name': 'environment', 'title': 'E'}) == \
+            {'id': 'group-id', 'name': 'environment'}
+
+    def test_clean_package(self):
+        package_dict = {'tags': [{'name': u'Qualità dell aria'}]}
+        MetarepoAdapter().clean_package(package_dict)
+        assert package_dict['tags'] == [{'name': 'qualit-dell-aria'}]
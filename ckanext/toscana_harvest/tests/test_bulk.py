@@ -0,0 +1,209 @@
+"""Tests for bulk.py and the bulk_load mode of the harvesters."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ckan import model
+from ckan.model import Session
+from ckan.lib.helpers import json
+from ckan.tests import factories
+
+from ckanext.harvest.model import HarvestObject, HarvestObjectError
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest import bulk
+from ckanext.toscana_harvest.bulk import to_package_show_form
+from ckanext.toscana_harvest.harvesters import SpodHarvester
+
+
+def test_to_package_show_form():
+    package_dict = {
+        'id': 'dataset-id',
+        'extras': {'region': 'Toscana'},
+        'tags': ['ambiente', {'name': 'acqua'}],
+        'groups': ['environment', {'id': 'group-id'}],
+    }
+    converted = to_package_show_form(package_dict)
+
+    assert converted == {
+        'id': 'dataset-id',
+        'extras': [{'key': 'region', 'value': 'Toscana'}],
+        'tags': [{'name': 'ambiente'}, {'name': 'acqua'}],
+        'groups': [{'name': 'environment'}, {'id': 'group-id'}],
+    }
+    assert package_dict['extras'] == {'region': 'Toscana'}
+
+
+def test_to_package_show_form_already_converted():
+    package_dict = {
+        'extras': [{'key': 'region', 'value': 'Toscana'}],
+        'tags': [{'name': 'ambiente'}],
+        'groups': [{'name': 'environment'}],
+    }
+    assert to_package_show_form(package_dict) == package_dict
+
+
+def test_to_package_show_form_empty():
+    assert to_package_show_form({'id': 'dataset-id', 'tags': None}) == \
+        {'id': 'dataset-id', 'tags': [], 'groups': []}
+
+
+def _write(package_dicts, user):
+    context = {'model': model, 'session': Session, 'user': user['name'],
+               'ignore_auth': True}
+    validated = bulk.validate_packages(
+        [to_package_show_form(package_dict) for package_dict in package_dicts],
+        context)
+    assert [errors for data, errors in validated] == [{}] * len(validated)
+    for package_dict, (data, errors) in zip(package_dicts, validated):
+        data['id'] = package_dict['id']
+    bulk.write_packages([data for data, errors in validated], user['id'])
+    Session.commit()
+
+
+class BulkLoadHarvester(SpodHarvester):
+    '''
+    Queues the package dict in the content of each harvest object for the
+    bulk write, as _create_or_update_package does for new packages.
+    '''
+
+    def import_stage(self, harvest_object):
+        return self._queue_bulk_package(json.loads(harvest_object.content),
+                                        harvest_object, 'rest')
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestWritePackages(object):
+
+    def test_writes_packages_with_their_rows(self):
+        user = factories.Sysadmin()
+        org = factories.Organization()
+        group = factories.Group()
+        existing_tag = model.Tag(name='ambiente')
+        existing_tag.save()
+
+        _write([{
+            'id': 'dataset-a',
+            'name': 'dataset-a',
+            'title': 'Dataset A',
+            'owner_org': org['id'],
+            'extras': {'region': 'Toscana'},
+            'tags': ['ambiente', 'acqua'],
+            'groups': [group['name']],
+            'resources': [{'url': 'http://data.example.com/a.csv',
+                           'format': 'CSV', 'custom': 'value'},
+                          {'url': 'http://data.example.com/a.json'}],
+        }, {
+            'id': 'dataset-b',
+            'name': 'dataset-b',
+            'title': 'Dataset B',
+            'owner_org': org['id'],
+            'tags': ['acqua'],
+        }], user)
+
+        package = model.Package.get('dataset-a')
+        assert package.state == 'active'
+        assert package.owner_org == org['id']
+        assert package.creator_user_id == user['id']
+        assert package.extras == {'region': 'Toscana'}
+        assert sorted(tag.name for tag in package.get_tags()) == \
+            ['acqua', 'ambiente']
+        assert [(resource.url, resource.position, resource.extras or None)
+                for resource in package.resources] == [
+            ('http://data.example.com/a.csv', 0, {'custom': 'value'}),
+            ('http://data.example.com/a.json', 1, None)]
+        assert sorted((member.group_id, member.capacity) for member in
+                      Session.query(model.Member)
+                      .filter(model.Member.table_id == 'dataset-a')) == \
+            sorted([(org['id'], 'organization'), (group['id'], 'public')])
+        # Tags are shared, the existing one is reused
+        assert Session.query(model.Tag).count() == 2
+        assert model.Tag.by_name('ambiente').id == existing_tag.id
+        assert [tag.name for tag in
+                model.Package.get('dataset-b').get_tags()] == ['acqua']
+
+    def test_tags_created_at_the_same_time_are_not_duplicated(self):
+        names = set(['ambiente', 'acqua', 'aria'])
+        barrier = threading.Barrier(4)
+
+        def create_tags():
+            try:
+                barrier.wait()
+                return bulk._get_tag_ids(names)
+            finally:
+                Session.remove()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            tag_ids = list(executor.map(lambda i: create_tags(), range(4)))
+
+        assert all(ids == tag_ids[0] for ids in tag_ids)
+        assert set(tag_ids[0]) == names
+        assert Session.query(model.Tag).count() == 3
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestBulkLoad(object):
+
+    def _import(self, package_dicts):
+        factories.Organization(name='regione-toscana')
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod',
+            config=json.dumps({'bulk_load': True}))
+        job = harvest_factories.HarvestJobObj(source=source)
+        harvest_objects = [
+            harvest_factories.HarvestObjectObj(
+                job=job, guid=package_dict['title'],
+                content=json.dumps(dict(package_dict,
+                                        owner_org='regione-toscana')))
+            for package_dict in package_dicts]
+        harvester = BulkLoadHarvester()
+        harvester._set_config(source.config)
+        results = harvester.import_batch(harvest_objects)
+        ids = [harvest_object.id for harvest_object in harvest_objects]
+        # Only what has been committed is left
+        Session.remove()
+        return results, [HarvestObject.get(id_) for id_ in ids]
+
+    def _errors(self, harvest_object):
+        return [error.message for error in Session.query(HarvestObjectError)
+                .filter_by(harvest_object_id=harvest_object.id)]
+
+    def test_writes_the_new_packages(self):
+        results, (first, same_name, invalid) = self._import([
+            {'id': 'id-1', 'name': 'air', 'title': 'Air'},
+            {'id': 'id-2', 'name': 'air', 'title': 'Air again'},
+            {'id': 'id-3', 'name': 'water', 'title': 'Water',
+             'tags': ['x' * 200]}])
+
+        assert results == {first.id: True, same_name.id: True,
+                           invalid.id: False}
+        assert model.Package.get('id-1').name == 'air'
+        # The name taken in the batch gets a suffix
+        assert model.Package.get('id-2').name.startswith('air-')
+        assert (first.state, first.package_id, first.current) == \
+            ('COMPLETE', 'id-1', True)
+        assert same_name.package_id == 'id-2'
+        assert not model.Package.get('id-3')
+        assert (invalid.state, invalid.package_id, invalid.current) == \
+            ('ERROR', None, False)
+        assert 'Invalid package' in self._errors(invalid)[0]
+
+    def test_failed_insert_flags_the_objects(self):
+        # Both packages have the same id, the INSERT fails
+        results, harvest_objects = self._import([
+            {'id': 'same-id', 'name': 'air', 'title': 'Air'},
+            {'id': 'same-id', 'name': 'water', 'title': 'Water'}])
+
+        assert results == dict((harvest_object.id, False)
+                               for harvest_object in harvest_objects)
+        assert not model.Package.get('same-id')
+        for harvest_object in harvest_objects:
+            assert (harvest_object.state, harvest_object.package_id,
+                    harvest_object.current) == ('ERROR', None, False)
+            assert 'Could not write package' in \
+                self._errors(harvest_object)[0]
@@ -0,0 +1,201 @@
+"""Tests for the commands of cli.py that harvest without the queues."""
+import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from ckan.model import Session
+
+from ckanext.harvest.model import HarvestGatherError, HarvestJob, \
+    HarvestObject, HarvestObjectError
+from ckanext.harvest.queue import get_harvester
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest import cli
+from ckanext.toscana_harvest.harvesters import SpodHarvester
+
+
+class InlinePool(object):
+    '''
+    Stands in for the worker pool of `toscana_harvest run`, fetching and
+    importing the batches in this process.
+    '''
+
+    def __init__(self, processes, initializer=None):
+        pass
+
+    def imap_unordered(self, function, iterable):
+        return (function(item) for item in iterable)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class InlineContext(object):
+    Pool = InlinePool
+
+
+class FakeRemote(object):
+    '''
+    What the gather stage of each source creates, by source URL, and the
+    batches the import stage gets. A gather with None raises, and so does
+    the import of a batch with a 'broken' object.
+    '''
+
+    def __init__(self, guids):
+        self.guids = guids
+        self.batches = []
+
+    def gather_stage(self, harvester, harvest_job):
+        guids = self.guids[harvest_job.source.url]
+        object_ids = [harvester._create_harvest_object(harvest_job, guid)
+                      for guid in guids or ['created-before-failing']]
+        if harvester.fetch_handoff is not None:
+            harvester.fetch_handoff.add(object_ids)
+        if guids is None:
+            raise Exception('The remote went away')
+        return object_ids
+
+    def fetch_and_import_batch(self, harvester, harvest_objects):
+        guids = [harvest_object.guid for harvest_object in harvest_objects]
+        self.batches.append(guids)
+        if 'broken' in guids:
+            raise Exception('The worker went away')
+        for harvest_object in harvest_objects:
+            harvest_object.state = u'COMPLETE'
+            harvest_object.report_status = u'added'
+            harvest_object.current = True
+            harvest_object.import_finished = datetime.datetime.utcnow()
+            harvest_object.save()
+        return len(harvest_objects)
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    remote = FakeRemote({})
+    monkeypatch.setattr(
+        SpodHarvester, 'gather_stage',
+        lambda self, harvest_job: remote.gather_stage(self, harvest_job))
+    monkeypatch.setattr(
+        SpodHarvester, 'fetch_and_import_batch',
+        lambda self, harvest_objects: remote.fetch_and_import_batch(
+            self, harvest_objects))
+    monkeypatch.setattr(cli.multiprocessing, 'get_context',
+                        lambda method: InlineContext)
+    # The commands set these on the harvester plugin
+    harvester = get_harvester('Spod')
+    monkeypatch.setattr(harvester, 'fetch_handoff', None)
+    monkeypatch.setattr(harvester, 'publish_during_gather', True)
+    return remote
+
+
+def _states(job_id):
+    return dict(Session.query(HarvestObject.guid, HarvestObject.state)
+                .filter(HarvestObject.harvest_job_id == job_id))
+
+
+def _gather_errors(job_id):
+    return Session.query(HarvestGatherError) \
+        .filter(HarvestGatherError.harvest_job_id == job_id).count()
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestRun(object):
+
+    def _run(self, remote, guids, batch_size):
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod')
+        source_id = source.id
+        remote.guids[source.url] = guids
+        result = CliRunner().invoke(cli.toscana_harvest, [
+            'run', source_id, '--workers', '1',
+            '--batch-size', str(batch_size)])
+        assert result.exit_code == 0, result.output
+        return Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == source_id).one()
+
+    def test_imports_the_gathered_objects(self, remote):
+        job = self._run(remote, ['a', 'b', 'c'], 2)
+
+        assert job.status == u'Finished'
+        assert job.gather_finished
+        assert _states(job.id) == {'a': 'COMPLETE', 'b': 'COMPLETE',
+                                   'c': 'COMPLETE'}
+        assert sorted(map(len, remote.batches)) == [1, 2]
+
+    def test_objects_of_a_failed_gather_are_imported(self, remote):
+        job = self._run(remote, None, 2)
+
+        assert job.status == u'Finished'
+        assert _gather_errors(job.id) == 1
+        assert _states(job.id) == {'created-before-failing': 'COMPLETE'}
+
+    def test_job_finishes_when_a_batch_fails(self, remote):
+        job = self._run(remote, ['a', 'broken', 'c'], 1)
+
+        assert job.status == u'Finished'
+        assert job.finished
+        assert _states(job.id) == {'a': 'COMPLETE', 'broken': 'ERROR',
+                                   'c': 'COMPLETE'}
+        broken = Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == job.id) \
+            .filter(HarvestObject.guid == 'broken').one()
+        errors = Session.query(HarvestObjectError) \
+            .filter(HarvestObjectError.harvest_object_id == broken.id).all()
+        assert len(errors) == 1
+        assert 'The worker went away' in errors[0].message
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestRunMany(object):
+
+    def _run_many(self, remote, guids_by_url, options):
+        source_ids = []
+        for url, guids in guids_by_url:
+            source = harvest_factories.HarvestSourceObj(url=url,
+                                                        source_type='Spod')
+            source_ids.append(source.id)
+            remote.guids[url] = guids
+        result = CliRunner().invoke(cli.toscana_harvest,
+                                    ['run-many'] + source_ids + options)
+        assert result.exit_code == 0, result.output
+        return [Session.query(HarvestJob)
+                .filter(HarvestJob.source_id == source_id).one()
+                for source_id in source_ids]
+
+    def test_a_failed_gather_leaves_the_other_sources(self, remote):
+        jobs = self._run_many(remote, [
+            ('http://a.example.com', ['a1', 'a2']),
+            ('http://b.example.com', None),
+            ('http://c.example.com', ['c1'])], ['--batch-size', '2'])
+
+        assert [job.status for job in jobs] == [u'Finished'] * 3
+        assert _states(jobs[0].id) == {'a1': 'COMPLETE', 'a2': 'COMPLETE'}
+        # As in the gather consumer, the objects of the failed gather go
+        assert _states(jobs[1].id) == {}
+        assert _gather_errors(jobs[1].id) == 1
+        assert _states(jobs[2].id) == {'c1': 'COMPLETE'}
+        assert _gather_errors(jobs[0].id) == _gather_errors(jobs[2].id) == 0
+
+    def test_one_source_after_the_other(self, remote):
+        self._run_many(remote, [
+            ('http://a.example.com', ['a1', 'a2']),
+            ('http://b.example.com', ['b1', 'b2'])], ['--batch-size', '1'])
+
+        assert remote.batches == [['a1'], ['a2'], ['b1'], ['b2']]
+
+    def test_interleave(self, remote):
+        jobs = self._run_many(remote, [
+            ('http://a.example.com', ['a1', 'a2']),
+            ('http://b.example.com', ['b1', 'b2'])],
+            ['--batch-size', '1', '--interleave'])
+
+        assert remote.batches == [['a1'], ['b1'], ['a2'], ['b2']]
+        assert [job.status for job in jobs] == [u'Finished'] * 2
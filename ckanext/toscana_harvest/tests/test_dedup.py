@@ -0,0 +1,38 @@
+"""Tests for dedup.py."""
+import pytest
+
+from ckanext.toscana_harvest import dedup
+
+
+@pytest.mark.parametrize('key, pkg_dict, guid, identity', [
+    ('id', None, ' Dataset-ID ', 'id:dataset-id'),
+    ('id', {'id': 'dataset-id'}, None, 'id:dataset-id'),
+    ('id', None, None, None),
+    ('name', {'name': ' Air-Quality '}, 'dataset-id', 'name:air-quality'),
+    ('name', {'name': '  '}, None, None),
+    ('name', {}, None, None),
+    ('extra:identifier', {'extras': {'identifier': 'IT-1'}}, None,
+     'extra:identifier:it-1'),
+    ('extra:identifier',
+     {'extras': [{'key': 'other', 'value': 'x'},
+                 {'key': 'identifier', 'value': 'IT-1'}]}, None,
+     'extra:identifier:it-1'),
+    ('extra:identifier', {'extras': []}, None, None),
+    ('extra:identifier', {'extras': None}, None, None),
+])
+def test_dataset_identity(key, pkg_dict, guid, identity):
+    assert dedup.dataset_identity(key, pkg_dict, guid) == identity
+
+
+def test_settings():
+    assert dedup.settings({}) is None
+    assert dedup.settings({'dedup': {}}) == ('id', 0)
+    assert dedup.settings({'dedup': {'key': 'name', 'priority': '10'}}) == \
+        ('name', 10)
+
+
+@pytest.mark.parametrize('value', [
+    'name', {'key': 'title'}, {'key': 'extra:'}, {'priority': 'high'}])
+def test_validate_config_rejects(value):
+    with pytest.raises(ValueError):
+        dedup.validate_config(value)
@@ -0,0 +1,162 @@
+"""Tests for dump.py and the gathering of dumps."""
+import gzip
+import hashlib
+import os
+
+import pytest
+
+from ckan.model import Session
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestGatherError, HarvestObject
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest import dump, transport
+from ckanext.toscana_harvest.harvesters import MetarepoHarvester
+
+DUMP_URL = 'http://metarepo.example.com/catalogue.jsonl.gz'
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_code=200, etag=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = {'ETag': etag} if etag else {}
+        self.raw = self
+
+    def stream(self, chunk_size, decode_content=True):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def remote_dump(monkeypatch):
+    '''
+    Serves the body of a dump, set on the returned dict, to dump.download.
+    '''
+    served = {'body': b'', 'status_code': 200, 'requests': []}
+
+    def open_url(url, headers, timeouts):
+        served['requests'].append(headers)
+        return FakeResponse(served['body'], served['status_code'],
+                            served.get('etag'))
+    monkeypatch.setattr(transport, 'open_url', open_url)
+    return served
+
+
+def _jsonl(datasets):
+    return ''.join(json.dumps(dataset) + '\n' for dataset in datasets)
+
+
+def test_download(remote_dump):
+    remote_dump['body'] = b'{"id": "a"}\n'
+    remote_dump['etag'] = '"v1"'
+
+    path, current = dump.download(DUMP_URL)
+    try:
+        with open(path, 'rb') as f:
+            assert f.read() == b'{"id": "a"}\n'
+    finally:
+        os.remove(path)
+    assert current == {'etag': '"v1"', 'size': 12,
+                       'sha256': hashlib.sha256(b'{"id": "a"}\n').hexdigest()}
+
+
+def test_download_unchanged(remote_dump):
+    remote_dump['body'] = b'{"id": "a"}\n'
+    previous = {'etag': '"v1"', 'size': 12,
+                'sha256': hashlib.sha256(b'{"id": "a"}\n').hexdigest()}
+
+    # The remote has no ETag support, the checksum tells
+    assert dump.download(DUMP_URL, previous) == (
+        None, dict(previous, etag=None))
+    assert remote_dump['requests'][-1]['If-None-Match'] == '"v1"'
+
+    remote_dump['status_code'] = 304
+    assert dump.download(DUMP_URL, previous) == (None, previous)
+
+
+def test_iter_datasets(tmpdir):
+    content = _jsonl([{'id': 'a'}, {'id': 'b'}]) + '\n'
+    plain = tmpdir.join('dump.jsonl')
+    plain.write(content)
+    compressed = str(tmpdir.join('dump.jsonl.gz'))
+    with gzip.open(compressed, 'wt') as f:
+        f.write(content)
+
+    for path in (str(plain), compressed):
+        assert list(dump.iter_datasets(path)) == [{'id': 'a'}, {'id': 'b'}]
+
+
+def test_iter_datasets_invalid_line(tmpdir):
+    path = tmpdir.join('dump.jsonl')
+    path.write('{"id": "a"}\n{"id": \n')
+
+    with pytest.raises(dump.DumpError) as e:
+        list(dump.iter_datasets(str(path)))
+    assert 'line 2' in str(e.value)
+
+
+def test_identify_dcat_dataset():
+    dataset = {'title': 'Air quality 2026',
+               'extras': [{'key': 'uri',
+                           'value': 'http://dati.example.it/dataset/1'}]}
+    identified = dump._identify_dcat_dataset(dict(dataset))
+
+    assert identified['name'] == 'air-quality-2026'
+    # The same on every harvest
+    assert identified['id'] == dump._identify_dcat_dataset(dict(dataset))['id']
+    assert dump._identify_dcat_dataset({'title': 'No uri'}) is None
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest metarepo_harvester')
+class TestGatherFromDump(object):
+
+    def _gather(self, settings):
+        source = harvest_factories.HarvestSourceObj(
+            url='http://metarepo.example.com', source_type='Metarepo',
+            config=json.dumps({'dump': dict(settings, url=DUMP_URL)}))
+        job = harvest_factories.HarvestJobObj(source=source)
+        return job, MetarepoHarvester().gather_stage(job)
+
+    def test_creates_objects_with_content(self, remote_dump):
+        remote_dump['body'] = gzip.compress(_jsonl([
+            {'id': 'a', 'name': 'dataset-a'},
+            {'id': 'b', 'name': 'dataset-b'},
+            {'id': 'a', 'name': 'dataset-a'}]).encode('utf8'))
+
+        job, object_ids = self._gather({})
+
+        harvest_objects = [HarvestObject.get(object_id)
+                           for object_id in object_ids]
+        assert sorted(obj.guid for obj in harvest_objects) == ['a', 'b']
+        adapter = MetarepoHarvester().adapter
+        assert all(adapter.parse_package(obj.content)['name'] ==
+                   'dataset-%s' % obj.guid for obj in harvest_objects)
+
+    def test_rejects_a_dump_with_another_checksum(self, remote_dump):
+        remote_dump['body'] = _jsonl([{'id': 'a'}]).encode('utf8')
+
+        job, object_ids = self._gather({'sha256': '0' * 64})
+
+        assert object_ids is None
+        assert Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == job.id).count() == 0
+        errors = Session.query(HarvestGatherError) \
+            .filter(HarvestGatherError.harvest_job_id == job.id).all()
+        assert len(errors) == 1
+        assert 'Checksum of dump' in errors[0].message
+
+    def test_accepts_the_expected_checksum(self, remote_dump):
+        remote_dump['body'] = _jsonl([{'id': 'a'}]).encode('utf8')
+
+        job, object_ids = self._gather({
+            'sha256': hashlib.sha256(remote_dump['body']).hexdigest().upper()})
+
+        assert len(object_ids) == 1
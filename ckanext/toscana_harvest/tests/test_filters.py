@@ -0,0 +1,78 @@
+"""Tests for filters.py."""
+import pytest
+
+from ckanext.toscana_harvest import filters
+
+
+DATASET = {
+    'id': 'dataset-id',
+    'name': 'air-quality',
+    'title': 'Air quality 2020',
+    'license_id': 'cc-by',
+    'organization': {'name': 'regione-toscana'},
+    'tags': [{'name': 'ambiente'}],
+    'groups': ['environment'],
+    'resources': [{'format': 'CSV'}, {'format': 'json'}],
+    'extras': [{'key': 'region', 'value': 'Toscana'}],
+}
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ("license_id in ['cc-by', 'cc-zero'] and 'csv' in formats", True),
+    ("organization == 'regione-toscana'", True),
+    ("'ambiente' in tags and 'environment' in groups", True),
+    ("extras.region == 'Toscana'", True),
+    ("matches(title, '^air') and not matches(title, 'test')", True),
+    ("lower(title) == 'air quality 2020' and num_resources == 2", True),
+    ("'pdf' in formats", False),
+    ("extras.missing == 'x'", False),
+    ("len(notes) > 0", False),
+    # Failing comparisons do not match instead of raising
+    ("num_resources > 'a'", False),
+])
+def test_compile_filter(expression, expected):
+    assert filters.compile_filter(expression)(DATASET) is expected
+
+
+def test_compile_filter_rest_form():
+    matches = filters.compile_filter(
+        "'ambiente' in tags and extras.region == 'Toscana'")
+    assert matches({'tags': ['ambiente'], 'extras': {'region': 'Toscana'}})
+
+
+@pytest.mark.parametrize('expression', [
+    '',
+    'name ==',
+    "__import__('os')",
+    'name.upper()',
+    "open('/etc/passwd')",
+    'title[0]',
+    '[tag for tag in tags]',
+    'lambda: name',
+    'tags.__class__',
+    'unknown == 1',
+    'name if title else notes',
+    "matches(value=title, pattern='x')",
+    'num_resources + 1 > 2',
+])
+def test_compile_filter_rejects(expression):
+    with pytest.raises(ValueError):
+        filters.compile_filter(expression)
+
+
+@pytest.mark.parametrize('expression, terms', [
+    ("license_id in ['cc-by', 'cc-zero'] and 'csv' in formats and "
+     "not matches(title, 'test')",
+     ['license_id:("cc-by" OR "cc-zero")', 'res_format:("csv" OR "CSV")']),
+    ("organization != 'regione-toscana'", ['-organization:"regione-toscana"']),
+    ("not organization == 'regione-toscana'",
+     ['-organization:"regione-toscana"']),
+    ("'ambiente' not in tags", ['-tags:"ambiente"']),
+    ("name == 'a\"b'", ['name:"a\\"b"']),
+    # Alternatives and list fields compared as a whole narrow nothing down
+    ("name == 'a' or name == 'b'", []),
+    ("tags == 'ambiente'", []),
+    ("matches(title, 'air')", []),
+])
+def test_to_fq_terms(expression, terms):
+    assert filters.to_fq_terms(expression) == terms
@@ -0,0 +1,96 @@
+"""Tests for the batch import of harvesters/base.py."""
+import pytest
+import sqlalchemy as sa
+
+from ckan import model
+from ckan.model import Session
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestObject, HarvestObjectError
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest.harvesters import SpodHarvester
+from ckanext.toscana_harvest.model import commit_deferred, DEFERRED_COMMIT
+
+
+class DatasetPerObjectHarvester(SpodHarvester):
+    '''
+    Creates an empty dataset named after the guid of each harvest object.
+    '''
+
+    def import_stage(self, harvest_object):
+        if harvest_object.guid == 'database-error':
+            Session.execute(sa.text('SELECT 1 / 0'))
+        context = {'user': self._get_user_name(),
+                   'defer_commit': commit_deferred()}
+        try:
+            package = toolkit.get_action('package_create')(
+                context, {'name': harvest_object.guid})
+        except toolkit.ValidationError as e:
+            self._save_object_error('Invalid package: %r' % e.error_dict,
+                                    harvest_object, 'Import')
+            return False
+        harvest_object.package_id = package['id']
+        harvest_object.current = True
+        return True
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestImportBatch(object):
+
+    def _import(self, guids):
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod')
+        job = harvest_factories.HarvestJobObj(source=source)
+        harvest_objects = [
+            harvest_factories.HarvestObjectObj(job=job, guid=guid,
+                                               content='{}')
+            for guid in guids]
+        harvester = DatasetPerObjectHarvester()
+        harvester._set_config(source.config)
+        results = harvester.import_batch(harvest_objects)
+        return results, [harvest_object.id
+                         for harvest_object in harvest_objects]
+
+    def test_failed_object_only_rolls_back_its_own_changes(self):
+        results, ids = self._import(
+            ['first-dataset', 'Not a valid name!', 'third-dataset'])
+        # Only what has been committed is left
+        Session.remove()
+
+        assert results == {ids[0]: True, ids[1]: False, ids[2]: True}
+        assert model.Package.by_name('first-dataset')
+        assert model.Package.by_name('third-dataset')
+
+        first, invalid = HarvestObject.get(ids[0]), HarvestObject.get(ids[1])
+        assert first.state == 'COMPLETE'
+        assert first.report_status == 'added'
+        assert invalid.state == 'ERROR'
+        assert invalid.report_status == 'errored'
+        errors = Session.query(HarvestObjectError) \
+            .filter_by(harvest_object_id=ids[1]).all()
+        assert len(errors) == 1
+        assert errors[0].stage == 'Import'
+        assert 'Invalid package' in errors[0].message
+
+    def test_database_error_only_rolls_back_its_own_changes(self):
+        results, ids = self._import(
+            ['first-dataset', 'database-error', 'third-dataset'])
+        # Only what has been committed is left
+        Session.remove()
+
+        assert results == {ids[0]: True, ids[1]: False, ids[2]: True}
+        assert model.Package.by_name('first-dataset')
+        assert not model.Package.by_name('database-error')
+        assert model.Package.by_name('third-dataset')
+        assert HarvestObject.get(ids[1]).state == 'ERROR'
+
+    def test_commits_are_no_longer_deferred(self):
+        self._import(['first-dataset'])
+
+        session = Session()
+        assert DEFERRED_COMMIT not in session.info
+        assert 'rollback' not in vars(session)
+        assert not commit_deferred()
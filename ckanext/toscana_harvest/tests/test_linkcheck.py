@@ -0,0 +1,146 @@
+"""Tests for linkcheck.py."""
+import asyncio
+import collections
+import datetime
+import threading
+import time
+
+import pytest
+
+from ckan import model
+from ckan.model import Session
+from ckan.lib.helpers import json
+from ckan.tests import factories
+
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest import linkcheck
+
+
+def _result(status=200, checked=None):
+    return {'status': status, 'ok': 200 <= status < 400, 'latency_ms': 5,
+            'error': None,
+            'checked': checked or datetime.datetime.utcnow()}
+
+
+@pytest.mark.parametrize('value', [
+    [], {'per_host': 0}, {'timeout': 'slow'}, {'ttl_hours': -1}])
+def test_validate_config_rejects(value):
+    with pytest.raises(ValueError):
+        linkcheck.validate_config(value)
+
+
+@pytest.mark.parametrize('url, public', [
+    ('http://8.8.8.8/data.csv', True),
+    ('https://8.8.8.8:8443/data.csv', True),
+    ('ftp://8.8.8.8/data.csv', False),
+    ('file:///etc/passwd', False),
+    ('http://127.0.0.1/data.csv', False),
+    ('http://10.0.0.1/data.csv', False),
+    ('http://192.168.1.1/data.csv', False),
+    ('http://169.254.169.254/latest/meta-data', False),
+    ('http://[::1]/data.csv', False),
+    ('http://[fc00::1]/data.csv', False),
+    ('http://8.8.8.8:99999/data.csv', False),
+])
+def test_is_public(url, public):
+    assert linkcheck._is_public(url) == public
+
+
+def test_check_url_skips_private_addresses():
+    assert linkcheck._check_url('http://127.0.0.1:5000/api/3', 1) is None
+
+
+def test_check_urls_limits_requests_per_host(monkeypatch):
+    running = collections.Counter()
+    most = collections.Counter()
+    lock = threading.Lock()
+
+    def check_url(url, timeout):
+        host = url.split('/')[2]
+        with lock:
+            running[host] += 1
+            most[host] = max(most[host], running[host])
+        time.sleep(0.05)
+        with lock:
+            running[host] -= 1
+        if url.endswith('skipped'):
+            return None
+        return _result()
+    monkeypatch.setattr(linkcheck, '_check_url', check_url)
+    urls = set(['http://%s.example.com/%d' % (host, i)
+                for host in ('a', 'b') for i in range(6)] +
+               ['http://a.example.com/skipped'])
+
+    results = asyncio.run(linkcheck._check_urls(
+        urls, dict(linkcheck.DEFAULTS, per_host=2)))
+
+    assert set(results) == urls - set(['http://a.example.com/skipped'])
+    assert most == {'a.example.com': 2, 'b.example.com': 2}
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest toscana_harvest')
+class TestCache(object):
+
+    def test_results_are_replaced(self):
+        url = 'http://data.example.com/a.csv'
+        linkcheck._set_cached({url: _result(404)})
+        linkcheck._set_cached({url: _result(200)})
+
+        cached = linkcheck._get_cached([url], 24)
+        assert cached[url]['status'] == 200
+        assert cached[url]['ok'] is True
+
+    def test_old_results_are_not_used(self):
+        url = 'http://data.example.com/a.csv'
+        linkcheck._set_cached({url: _result(
+            checked=datetime.datetime.utcnow() - datetime.timedelta(hours=2))})
+
+        assert linkcheck._get_cached([url], 1) == {}
+        assert url in linkcheck._get_cached([url], 3)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestCheckJobLinks(object):
+
+    def test_records_results_on_the_resources(self, monkeypatch):
+        checked = []
+
+        def check_url(url, timeout):
+            checked.append(url)
+            return _result(404 if url.endswith('gone.csv') else 200)
+        monkeypatch.setattr(linkcheck, '_check_url', check_url)
+
+        dataset = factories.Dataset(resources=[
+            {'url': 'http://data.example.com/ok.csv'},
+            {'url': 'http://data.example.com/gone.csv'},
+            {'url': 'http://data.example.com/cached.csv'}])
+        linkcheck._set_cached({'http://data.example.com/cached.csv':
+                               _result(500)})
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod',
+            config=json.dumps({'link_check': {'per_host': 2}}))
+        job = harvest_factories.HarvestJobObj(source=source)
+        harvest_object = harvest_factories.HarvestObjectObj(
+            job=job, guid=dataset['id'])
+        harvest_object.package_id = dataset['id']
+        harvest_object.current = True
+        harvest_object.report_status = u'added'
+        Session.commit()
+
+        linkcheck.check_job_links(job.id)
+
+        assert sorted(checked) == ['http://data.example.com/gone.csv',
+                                   'http://data.example.com/ok.csv']
+        extras = dict((resource.url, resource.extras) for resource in
+                      Session.query(model.Resource)
+                      .filter(model.Resource.package_id == dataset['id']))
+        assert extras['http://data.example.com/ok.csv']['link_ok'] is True
+        assert extras['http://data.example.com/gone.csv']['link_ok'] is False
+        assert extras['http://data.example.com/gone.csv']['link_status'] == \
+            404
+        assert extras['http://data.example.com/cached.csv'][
+            'link_status'] == 500
@@ -0,0 +1,299 @@
+"""Tests for the gather stage of harvesters/metarepoharvester.py."""
+import datetime
+import re
+import urllib.parse
+
+import pytest
+
+from ckan.model import Session
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest.harvesters import MetarepoHarvester
+from ckanext.toscana_harvest.harvesters.base import HEX_DIGITS, \
+    order_by_priority
+from ckanext.toscana_harvest.model import get_state
+
+
+class FakeMetarepo(object):
+    '''
+    Answers the searches of the Metarepo gather stage from a list of
+    dataset dicts, honouring the metadata_modified and gather shard fq
+    terms, the sort and the paging. There are no remote organizations or
+    groups.
+    '''
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.searches = []
+        self.group_lists = []
+
+    def get_content(self, url):
+        parsed = urllib.parse.urlparse(url)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path.endswith('_list'):
+            self.group_lists.append(url)
+            return json.dumps({'result': []})
+        self.searches.append(params)
+        datasets = list(self.datasets)
+        since = re.search(r'metadata_modified:\[(\S+)Z TO \*\]',
+                          params.get('fq', ''))
+        if since:
+            datasets = [dataset for dataset in datasets
+                        if dataset['metadata_modified'] >= since.group(1)]
+        shard = re.search(r'id:\(([^)]*)\)', params.get('fq', ''))
+        if shard:
+            prefixes = [prefix.rstrip('*')
+                        for prefix in shard.group(1).split(' OR ')]
+            # The catch-all of the first shard
+            others = '-id:(' in params['fq']
+            datasets = [dataset for dataset in datasets
+                        if dataset['id'][:1] in prefixes or
+                        (others and dataset['id'][:1] not in HEX_DIGITS)]
+        if params['sort'] == 'metadata_modified desc':
+            datasets.sort(key=lambda dataset: dataset['metadata_modified'],
+                          reverse=True)
+        else:
+            datasets.sort(key=lambda dataset: dataset['id'])
+        start = int(params['start'])
+        return json.dumps({
+            'count': len(datasets),
+            'more': datasets[start:start + int(params['rows'])]})
+
+    def listing_searches(self):
+        return [params for params in self.searches
+                if params['sort'] == 'id asc']
+
+
+def _dataset(dataset_id, modified):
+    return {'id': dataset_id, 'name': 'dataset-%s' % dataset_id,
+            'metadata_modified': modified}
+
+
+def _finish(job):
+    '''
+    Marks a job and its objects as harvested without errors.
+    '''
+    for harvest_object in Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == job.id):
+        harvest_object.current = True
+        harvest_object.state = u'COMPLETE'
+        harvest_object.report_status = u'added'
+    job.status = u'Finished'
+    job.gather_started = job.gather_started or datetime.datetime.utcnow()
+    Session.commit()
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest metarepo_harvester')
+class MetarepoGatherTests(object):
+
+    def _source(self, config=None):
+        return harvest_factories.HarvestSourceObj(
+            url='http://metarepo.example.com', source_type='Metarepo',
+            config=json.dumps(config or {}))
+
+    def _gather(self, source, remote, monkeypatch):
+        job = harvest_factories.HarvestJobObj(source=source)
+        job.gather_started = datetime.datetime.utcnow()
+        Session.commit()
+        harvester = MetarepoHarvester()
+        monkeypatch.setattr(harvester, '_get_content', remote.get_content)
+        object_ids = harvester.gather_stage(job)
+        return job, set(HarvestObject.get(object_id).guid
+                        for object_id in object_ids or [])
+
+
+class TestHighWaterMark(MetarepoGatherTests):
+
+    def test_first_job_sets_the_mark(self, monkeypatch):
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00'),
+                               _dataset('b', '2026-01-02T00:00:00'),
+                               _dataset('c', '2026-01-02T00:00:00')])
+
+        job, guids = self._gather(self._source(), remote, monkeypatch)
+
+        assert guids == set(['a', 'b', 'c'])
+        assert get_state('hwm:%s' % job.id) == {
+            'modified': '2026-01-02T00:00:00', 'ids': ['b', 'c']}
+
+    def test_next_job_lists_from_the_mark(self, monkeypatch):
+        source = self._source()
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00'),
+                               _dataset('b', '2026-01-02T00:00:00'),
+                               _dataset('c', '2026-01-02T00:00:00')])
+        first_job, guids = self._gather(source, remote, monkeypatch)
+        _finish(first_job)
+
+        # Modified at the same instant as the mark, and later
+        remote.datasets.extend([_dataset('d', '2026-01-02T00:00:00'),
+                                _dataset('e', '2026-01-03T00:00:00')])
+        remote.searches = []
+        job, guids = self._gather(source, remote, monkeypatch)
+
+        assert guids == set(['d', 'e'])
+        assert remote.listing_searches()[0]['fq'] == \
+            'metadata_modified:[2026-01-02T00:00:00Z TO *]'
+        assert get_state('hwm:%s' % job.id) == {
+            'modified': '2026-01-03T00:00:00', 'ids': ['e']}
+
+    def test_mark_stays_when_nothing_is_listed(self, monkeypatch):
+        source = self._source({'precheck': False})
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+        first_job, guids = self._gather(source, remote, monkeypatch)
+        _finish(first_job)
+
+        job, guids = self._gather(source, remote, monkeypatch)
+
+        assert guids == set()
+        assert get_state('hwm:%s' % job.id) == {
+            'modified': '2026-01-01T00:00:00', 'ids': ['a']}
+
+
+class TestPrecheck(MetarepoGatherTests):
+
+    def _gather_twice(self, source, remote, monkeypatch, config=None):
+        first_job, guids = self._gather(source, remote, monkeypatch)
+        _finish(first_job)
+        if config is not None:
+            source.config = json.dumps(config)
+            Session.commit()
+        remote.searches = []
+        remote.group_lists = []
+        return self._gather(source, remote, monkeypatch)
+
+    def test_unchanged_remote_is_not_listed(self, monkeypatch):
+        source = self._source({'remote_orgs': 'create'})
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+
+        job, guids = self._gather_twice(source, remote, monkeypatch)
+
+        assert guids == set()
+        assert remote.listing_searches() == []
+        # Nor are the remote organizations
+        assert remote.group_lists == []
+        # The next job starts from the same mark
+        assert get_state('hwm:%s' % job.id) == {
+            'modified': '2026-01-01T00:00:00', 'ids': ['a']}
+
+    def test_changed_remote_is_listed(self, monkeypatch):
+        source = self._source()
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+        first_job, guids = self._gather(source, remote, monkeypatch)
+        _finish(first_job)
+
+        remote.datasets.append(_dataset('b', '2026-01-02T00:00:00'))
+        job, guids = self._gather(source, remote, monkeypatch)
+
+        assert guids == set(['b'])
+
+    def test_changed_configuration_lists_again(self, monkeypatch):
+        source = self._source()
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+
+        job, guids = self._gather_twice(source, remote, monkeypatch,
+                                        {'force_all': True})
+
+        assert guids == set(['a'])
+
+    def test_can_be_switched_off(self, monkeypatch):
+        source = self._source({'precheck': False})
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+
+        job, guids = self._gather_twice(source, remote, monkeypatch)
+
+        assert remote.listing_searches() != []
+
+
+def test_gather_shards():
+    harvester = MetarepoHarvester()
+    harvester.config = {}
+    assert harvester._get_gather_shards() == [[]]
+
+    harvester.config = {'gather_shards': 3}
+    shards = harvester._get_gather_shards()
+    assert len(shards) == 3
+    assert sorted(sum(shards, [])) == sorted(HEX_DIGITS)
+
+
+@pytest.mark.parametrize('guid, shard', [
+    ('0a1b', 0), ('3a1b', 0), ('1a1b', 1), ('f1b2', 2),
+    # Not lower case hexadecimal
+    ('A1b2', 0), ('dataset-name', 1), ('zeta', 0), ('', 0)])
+def test_shard_of(guid, shard):
+    shards = [['0', '3', '6', '9', 'c'], ['1', '4', '7', 'a', 'd'],
+              ['2', '5', '8', 'b', 'e', 'f']]
+    assert MetarepoHarvester._shard_of(guid, shards) == shard
+
+
+def test_shard_fq_term():
+    assert MetarepoHarvester._shard_fq_term([]) is None
+    assert MetarepoHarvester._shard_fq_term(['1', '3']) == 'id:(1* OR 3*)'
+    term = MetarepoHarvester._shard_fq_term(['0', '2'])
+    assert term.startswith('(id:(0* OR 2*) OR (*:* -id:(0* OR 1* OR ')
+    assert term.endswith(' OR f*)))')
+
+
+class TestShardedGather(MetarepoGatherTests):
+
+    def test_every_dataset_is_gathered_once(self, monkeypatch):
+        ids = ['0a', '1b', '7c', 'ab', 'fe', 'Upper', 'zeta', '-dash']
+        remote = FakeMetarepo([_dataset(dataset_id, '2026-01-01T00:00:00')
+                               for dataset_id in ids])
+
+        job, guids = self._gather(self._source({'gather_shards': 4}),
+                                  remote, monkeypatch)
+
+        assert guids == set(ids)
+        assert Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == job.id).count() == \
+            len(ids)
+        assert len(remote.listing_searches()) >= 4
+
+
+def test_priority():
+    local_guids = set(['local'])
+    priorities = dict(
+        (guid, MetarepoHarvester._priority(guid, modified, local_guids))
+        for guid, modified in [('local', '2026-03-01T00:00:00'),
+                               ('old', '2026-01-01T00:00:00'),
+                               ('recent', '2026-02-01T00:00:00'),
+                               ('unknown', None)])
+    assert sorted(priorities, key=priorities.get, reverse=True) == \
+        ['recent', 'old', 'unknown', 'local']
+
+
+class TestPriority(MetarepoGatherTests):
+
+    def test_new_and_recent_datasets_go_first(self, monkeypatch):
+        source = self._source({'force_all': True})
+        remote = FakeMetarepo([_dataset('a', '2026-01-01T00:00:00')])
+        first_job, guids = self._gather(source, remote, monkeypatch)
+        _finish(first_job)
+
+        remote.datasets = [_dataset('a', '2026-03-01T00:00:00'),
+                           _dataset('b', '2026-01-01T00:00:00'),
+                           _dataset('c', '2026-02-01T00:00:00')]
+        job = harvest_factories.HarvestJobObj(source=source)
+        harvester = MetarepoHarvester()
+        monkeypatch.setattr(harvester, '_get_content', remote.get_content)
+        object_ids = harvester.gather_stage(job)
+
+        assert [HarvestObject.get(object_id).guid
+                for object_id in object_ids] == ['c', 'b', 'a']
+
+    def test_objects_without_priority_come_last(self):
+        job = harvest_factories.HarvestJobObj(source=self._source())
+        harvest_factories.HarvestObjectObj(job=job, guid='no-priority')
+        for guid, priority in [('low', '0 2026-01-01T00:00:00'),
+                               ('high', '1 ')]:
+            MetarepoHarvester._create_harvest_object(job, guid,
+                                                     priority=priority)
+
+        query = Session.query(HarvestObject.guid) \
+            .filter(HarvestObject.harvest_job_id == job.id)
+        assert [guid for (guid,) in order_by_priority(query)] == \
+            ['high', 'low', 'no-priority']
@@ -0,0 +1,88 @@
+"""Tests for mirror.py."""
+import pytest
+
+from ckan.tests import factories, helpers
+
+from ckanext.toscana_harvest import mirror
+
+SOURCE_ID = 'source-id'
+
+
+def _entry(remote_id, modified=None, digest=None):
+    return {'remote_id': remote_id, 'name': 'dataset-%s' % remote_id,
+            'metadata_modified': modified, 'digest': digest}
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest toscana_harvest')
+class TestMirror(object):
+
+    def test_unchanged_since_import(self):
+        package = factories.Dataset()
+        other_package = factories.Dataset()
+        mirror.record_listing(SOURCE_ID, 'job-1', [
+            _entry('a', '2026-01-01T00:00:00'),
+            _entry('b', '2026-01-01T00:00:00'),
+            _entry('c')])
+        mirror.record_import(SOURCE_ID, 'a', package['id'],
+                             '2026-01-01T00:00:00', '{"id": "a"}')
+        mirror.record_import(SOURCE_ID, 'b', other_package['id'],
+                             '2026-01-01T00:00:00', '{"id": "b"}')
+        mirror.record_import(SOURCE_ID, 'c', package['id'], None,
+                             '{"id": "c"}')
+
+        assert mirror.unchanged(SOURCE_ID, [
+            # Same modification time
+            _entry('a', '2026-01-01T00:00:00'),
+            # Modified since
+            _entry('b', '2026-01-02T00:00:00'),
+            # Same content
+            _entry('c', digest=mirror.digest('{"id": "c"}')),
+            # Never imported
+            _entry('d', '2026-01-01T00:00:00')]) == set(['a', 'c'])
+        # Nor for another source
+        assert mirror.unchanged('other-source-id', [
+            _entry('a', '2026-01-01T00:00:00')]) == set()
+
+    def test_deleted_packages_are_not_unchanged(self):
+        package = factories.Dataset()
+        helpers.call_action('package_delete', id=package['id'])
+        mirror.record_listing(SOURCE_ID, 'job-1', [
+            _entry('a', '2026-01-01T00:00:00')])
+        mirror.record_import(SOURCE_ID, 'a', package['id'],
+                             '2026-01-01T00:00:00', '{"id": "a"}')
+
+        assert mirror.unchanged(SOURCE_ID, [
+            _entry('a', '2026-01-01T00:00:00')]) == set()
+
+    def test_listing_keeps_known_names(self):
+        mirror.record_listing(SOURCE_ID, 'job-1', [
+            _entry('a', '2026-01-01T00:00:00')])
+        # A package list that only gives the ids, listing one twice
+        mirror.record_listing(SOURCE_ID, 'job-2', [
+            {'remote_id': 'a'}, {'remote_id': 'a'}])
+        mirror.finish_full_listing(SOURCE_ID, 'job-3')
+
+        report = mirror.report(SOURCE_ID)
+        assert report['total'] == 1
+        assert report['missing'] == [('a', 'dataset-a', None)]
+
+    def test_full_listing_finds_what_has_gone(self):
+        package = factories.Dataset()
+        mirror.record_listing(SOURCE_ID, 'job-1', [
+            _entry('a', '2026-01-01T00:00:00'),
+            _entry('b', '2026-01-01T00:00:00')])
+        mirror.record_import(SOURCE_ID, 'b', package['id'],
+                             '2026-01-01T00:00:00', '{"id": "b"}')
+        assert mirror.finish_full_listing(SOURCE_ID, 'job-1') == 0
+
+        mirror.record_listing(SOURCE_ID, 'job-2', [
+            _entry('a', '2026-01-01T00:00:00')])
+
+        assert mirror.finish_full_listing(SOURCE_ID, 'job-2') == 1
+        assert mirror.report(SOURCE_ID) == {
+            'total': 2,
+            'imported': 1,
+            'full_listing_job_id': 'job-2',
+            'missing': [('b', 'dataset-b', package['id'])],
+        }
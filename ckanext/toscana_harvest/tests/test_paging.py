@@ -0,0 +1,52 @@
+"""Tests for paging.py."""
+import pytest
+
+from ckanext.toscana_harvest.paging import PageSizeTuner
+
+CONFIG = {'min': 10, 'max': 100, 'target_seconds': 5, 'target_bytes': 1000}
+
+
+@pytest.mark.usefixtures('clean_db')
+class TestPageSizeTuner(object):
+
+    def test_grow(self):
+        tuner = PageSizeTuner('source-id', CONFIG, 20)
+        tuner.record(1, 100)
+        assert tuner.size == 40
+        tuner.record(1, 100)
+        tuner.record(1, 100)
+        assert tuner.size == 100
+
+    def test_keep(self):
+        tuner = PageSizeTuner('source-id', CONFIG, 20)
+        tuner.record(3, 100)
+        tuner.record(1, 600)
+        assert tuner.size == 20
+
+    def test_shrink_on_slow_or_big_pages(self):
+        tuner = PageSizeTuner('source-id', CONFIG, 80)
+        tuner.record(6, 100)
+        assert tuner.size == 40
+        tuner.record(1, 2000)
+        assert tuner.size == 20
+
+    def test_shrink_on_failure(self):
+        tuner = PageSizeTuner('source-id', CONFIG, 30)
+        assert tuner.shrink()
+        assert tuner.size == 15
+        assert tuner.shrink()
+        assert tuner.size == 10
+        assert not tuner.shrink()
+        assert tuner.size == 10
+
+    def test_bounds(self):
+        assert PageSizeTuner('source-id', CONFIG, 5).size == 10
+        assert PageSizeTuner('source-id', CONFIG, 500).size == 100
+
+    def test_save(self):
+        tuner = PageSizeTuner('source-id', CONFIG, 20)
+        tuner.record(1, 100)
+        tuner.save()
+
+        assert PageSizeTuner('source-id', CONFIG, 20).size == 40
+        assert PageSizeTuner('other-source-id', CONFIG, 20).size == 20
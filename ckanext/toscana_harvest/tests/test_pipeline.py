@@ -0,0 +1,65 @@
+"""Tests for pipeline.py."""
+import time
+
+import pytest
+
+from ckanext.toscana_harvest import pipeline
+from ckanext.toscana_harvest.pipeline import FetchHandoff
+from ckanext.toscana_harvest.timeouts import TimeBudget
+
+
+class FakePublisher(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def publisher(monkeypatch):
+    publisher = FakePublisher()
+    monkeypatch.setattr(pipeline, 'get_fetch_publisher', lambda: publisher)
+    return publisher
+
+
+def test_remaining_disabled():
+    handoff = FetchHandoff()
+    handoff.add(['a', 'b'])
+    assert handoff.remaining(['a', 'b']) == ['a', 'b']
+
+
+def test_remaining_below_chunk_size(publisher):
+    handoff = FetchHandoff({'chunk_size': 10})
+    handoff.add(['a', 'b'])
+    assert handoff.remaining(['a', 'b']) == ['a', 'b']
+    assert publisher.messages == []
+
+
+def test_remaining_published(publisher, monkeypatch):
+    monkeypatch.setattr(FetchHandoff, '_queue_depth', lambda self: 0)
+    handoff = FetchHandoff({'chunk_size': 2})
+    handoff.add(['a'])
+    handoff.add(['b'])
+    handoff.add(['c'])
+    handoff.close()
+
+    assert handoff.remaining(['a', 'b', 'c']) == ['c']
+    assert publisher.messages == [{'harvest_object_id': 'a'},
+                                  {'harvest_object_id': 'b'}]
+
+
+def test_remaining_queue_full(publisher, monkeypatch):
+    monkeypatch.setattr(FetchHandoff, '_queue_depth', lambda self: 10)
+    budget = TimeBudget(1, started=time.time() - 2)
+    handoff = FetchHandoff({'chunk_size': 2, 'max_queue_depth': 5}, budget)
+    handoff.add(['a', 'b'])
+
+    assert not handoff.enabled
+    assert handoff.pending == ['a', 'b']
+    assert handoff.remaining(['a', 'b']) == ['a', 'b']
+    assert publisher.messages == []
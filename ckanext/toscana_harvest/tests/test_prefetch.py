@@ -0,0 +1,93 @@
+"""Tests for the prefetching of remote groups of harvesters/base.py."""
+import urllib.parse
+
+import pytest
+
+from ckan import model
+from ckan.lib.helpers import json
+
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest.harvesters import SpodHarvester
+from ckanext.toscana_harvest.harvesters.base import ContentNotFoundError, \
+    delete_job_states
+from ckanext.toscana_harvest.model import get_state
+
+
+class FakeGroupLists(object):
+    '''
+    Answers organization_list and group_list, or fails for the types not
+    given.
+    '''
+
+    def __init__(self, **groups):
+        self.groups = groups
+
+    def get_content(self, url):
+        parsed = urllib.parse.urlparse(url)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        group_type = parsed.path.rsplit('/', 1)[-1][:-len('_list')]
+        if group_type not in self.groups:
+            raise ContentNotFoundError('HTTP error: 404')
+        offset, limit = int(params['offset']), int(params['limit'])
+        return json.dumps({'result': [
+            {'name': name, 'title': name.capitalize()}
+            for name in self.groups[group_type][offset:offset + limit]]})
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestPrefetchRemoteGroups(object):
+
+    def _prefetch(self, remote, monkeypatch):
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod',
+            config=json.dumps({'remote_orgs': 'create',
+                               'remote_groups': 'create'}))
+        job = harvest_factories.HarvestJobObj(source=source)
+        harvester = SpodHarvester()
+        harvester._set_config(source.config)
+        monkeypatch.setattr(harvester, '_get_content', remote.get_content)
+        harvester._prefetch_remote_groups(job, source.url)
+        # As the import stage, in another process
+        return job, SpodHarvester()
+
+    def test_creates_the_missing_groups(self, monkeypatch):
+        remote = FakeGroupLists(
+            organization=['org-%02d' % i for i in range(30)],
+            group=['environment', 'health'])
+
+        job, harvester = self._prefetch(remote, monkeypatch)
+
+        assert model.Group.by_name('org-29').is_organization
+        assert not model.Group.by_name('health').is_organization
+        assert harvester._groups_prefetched(job, 'organization')
+        assert harvester._groups_prefetched(job, 'group')
+
+    def test_a_failed_group_leaves_its_type_to_the_import(self, monkeypatch):
+        remote = FakeGroupLists(organization=['valid-org', 'Not valid!'],
+                                group=['environment'])
+
+        job, harvester = self._prefetch(remote, monkeypatch)
+
+        assert model.Group.by_name('valid-org')
+        assert not harvester._groups_prefetched(job, 'organization')
+        assert harvester._groups_prefetched(job, 'group')
+
+    def test_a_failed_list_leaves_its_type_to_the_import(self, monkeypatch):
+        remote = FakeGroupLists(group=['environment'])
+
+        job, harvester = self._prefetch(remote, monkeypatch)
+
+        assert not harvester._groups_prefetched(job, 'organization')
+        assert harvester._groups_prefetched(job, 'group')
+
+    def test_job_states_are_deleted(self, monkeypatch):
+        remote = FakeGroupLists(organization=['valid-org'], group=[])
+
+        job, harvester = self._prefetch(remote, monkeypatch)
+        assert get_state('groups:%s' % job.id) is not None
+        delete_job_states([job.id])
+
+        assert get_state('groups:%s' % job.id) is None
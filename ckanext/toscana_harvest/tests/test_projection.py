@@ -0,0 +1,79 @@
+"""Tests for projection.py."""
+import pytest
+
+from ckan.lib.helpers import json
+
+from ckanext.toscana_harvest import projection
+
+
+def _dataset():
+    return {
+        'id': 'dataset-id',
+        'name': 'dataset',
+        'notes_rendered': '<p>Notes</p>',
+        'revision_id': 'revision-id',
+        'tracking_summary': {'total': 1, 'recent': 1},
+        'num_followers': 3,
+        'resources': [{'id': 'resource-id', 'url': 'http://example.com',
+                       'url_type': None, 'revision_id': 'revision-id',
+                       'datastore_active': True}],
+        'groups': [{'id': 'group-id', 'name': 'group', 'title': 'Group',
+                    'image_url': 'http://example.com/group.png'}],
+        'organization': {'id': 'org-id', 'name': 'org', 'title': 'Org',
+                         'description': 'An organization'},
+    }
+
+
+def test_project():
+    dataset = _dataset()
+    projected = projection.project(dataset)
+
+    assert projected == {
+        'id': 'dataset-id',
+        'name': 'dataset',
+        'notes_rendered': '<p>Notes</p>',
+        'resources': [{'id': 'resource-id', 'url': 'http://example.com',
+                       'datastore_active': True}],
+        'groups': [{'id': 'group-id', 'name': 'group', 'title': 'Group'}],
+        'organization': {'id': 'org-id', 'name': 'org', 'title': 'Org'},
+    }
+    assert dataset == _dataset()
+
+
+def test_project_config():
+    projected = projection.project(_dataset(), {
+        'drop': ['notes_rendered'], 'resource_drop': ['datastore_active']})
+
+    assert 'notes_rendered' not in projected
+    assert projected['resources'] == [
+        {'id': 'resource-id', 'url': 'http://example.com'}]
+
+
+def test_project_disabled():
+    dataset = _dataset()
+    assert projection.project(dataset, False) is dataset
+
+
+def test_project_rest_form():
+    projected = projection.project({'id': 'dataset-id', 'groups': ['group'],
+                                    'revision_id': 'revision-id'})
+    assert projected == {'id': 'dataset-id', 'groups': ['group']}
+
+
+def test_project_content_wrapped():
+    content = json.dumps({'success': True, 'result': _dataset()})
+    projected = json.loads(projection.project_content(content, wrapped=True))
+
+    assert projected['success'] is True
+    assert 'revision_id' not in projected['result']
+
+
+def test_project_content_not_json():
+    assert projection.project_content('not json') == 'not json'
+
+
+@pytest.mark.parametrize('value', [
+    [], {'drop': 'notes'}, {'resource_drop': [1]}, {'drop': ['id']}])
+def test_validate_config_rejects(value):
+    with pytest.raises(ValueError):
+        projection.validate_config(value)
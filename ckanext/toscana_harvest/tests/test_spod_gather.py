@@ -0,0 +1,114 @@
+"""Tests for the organization paging checkpoint of the Spod gather stage."""
+import urllib.parse
+
+import pytest
+
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.toscana_harvest.harvesters import SpodHarvester
+from ckanext.toscana_harvest.harvesters.base import ContentNotFoundError
+from ckanext.toscana_harvest.model import get_state, set_state
+
+
+class FakeSpod(object):
+    '''
+    Answers the requests of the Spod gather stage from lists of dataset
+    ids, by organization.
+    '''
+
+    def __init__(self, organizations, ignore_offset=False, fail_offset=None):
+        self.organizations = organizations
+        self.ignore_offset = ignore_offset
+        self.fail_offset = fail_offset
+        self.urls = []
+
+    def get_content(self, url):
+        self.urls.append(url)
+        parsed = urllib.parse.urlparse(url)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path.endswith('/rest/package'):
+            return json.dumps(sorted(set(
+                package_id for ids in self.organizations.values()
+                for package_id in ids)))
+        if parsed.path.endswith('/search/dataset'):
+            ids = self.organizations[params['organization']]
+            offset = int(params['offset'])
+            if offset == self.fail_offset:
+                raise ContentNotFoundError('HTTP error: 404')
+            if self.ignore_offset:
+                # Always the first page, claiming there is more
+                return json.dumps({'count': len(ids) + 10,
+                                   'results': ids[:int(params['limit'])]})
+            return json.dumps({
+                'count': len(ids),
+                'results': ids[offset:offset + int(params['limit'])]})
+        raise ContentNotFoundError('HTTP error: 404')
+
+    def search_offsets(self):
+        return [int(dict(urllib.parse.parse_qsl(
+                    urllib.parse.urlparse(url).query))['offset'])
+                for url in self.urls if '/search/dataset' in url]
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@pytest.mark.ckan_config('ckan.plugins',
+                         'harvest toscana_harvest spod_harvester')
+class TestSpodGatherCheckpoint(object):
+
+    def _job(self):
+        source = harvest_factories.HarvestSourceObj(
+            url='http://spod.example.com', source_type='Spod',
+            config=json.dumps({'organizations_filter_include': ['org-a']}))
+        return harvest_factories.HarvestJobObj(source=source)
+
+    def _gather(self, job, remote, monkeypatch):
+        harvester = SpodHarvester()
+        monkeypatch.setattr(harvester, '_get_content', remote.get_content)
+        return harvester.gather_stage(job)
+
+    def _guids(self, object_ids):
+        return set(HarvestObject.get(object_id).guid
+                   for object_id in object_ids)
+
+    def test_resumes_from_the_last_stored_page(self, monkeypatch):
+        job = self._job()
+        checkpoint_key = 'gather:%s' % job.id
+        # A gather of the job that died after the first page
+        set_state(checkpoint_key, {'organizations': {
+            'org-a': {'pages': 1, 'done': False}}})
+        set_state('%s:org-a:0' % checkpoint_key, ['id-1', 'id-2'])
+        remote = FakeSpod({'org-a': ['id-1', 'id-2', 'id-3'],
+                           'org-b': ['id-4']})
+
+        object_ids = self._gather(job, remote, monkeypatch)
+
+        assert remote.search_offsets() == [2]
+        assert self._guids(object_ids) == set(['id-1', 'id-2', 'id-3'])
+        assert get_state(checkpoint_key) is None
+        assert get_state('%s:org-a:0' % checkpoint_key) is None
+        assert get_state('%s:org-a:1' % checkpoint_key) is None
+
+    def test_stops_on_a_repeated_page(self, monkeypatch):
+        job = self._job()
+        remote = FakeSpod({'org-a': ['id-1', 'id-2']}, ignore_offset=True)
+
+        object_ids = self._gather(job, remote, monkeypatch)
+
+        assert remote.search_offsets() == [0, 2]
+        assert self._guids(object_ids) == set(['id-1', 'id-2'])
+        assert get_state('gather:%s' % job.id) is None
+
+    def test_deletes_the_checkpoint_when_the_gather_fails(self, monkeypatch):
+        job = self._job()
+        remote = FakeSpod({'org-a': ['id-%d' % i for i in range(30)]},
+                          fail_offset=20)
+
+        with pytest.raises(ContentNotFoundError):
+            self._gather(job, remote, monkeypatch)
+
+        assert remote.search_offsets() == [0, 20]
+        assert get_state('gather:%s' % job.id) is None
+        assert get_state('gather:%s:org-a:0' % job.id) is None
@@ -0,0 +1,26 @@
+"""Tests for timeouts.py."""
+import time
+
+import pytest
+
+from ckanext.toscana_harvest.timeouts import TimeBudget, BudgetExceeded
+
+
+def test_no_budget():
+    budget = TimeBudget(None)
+    assert budget.remaining() is None
+    budget.check()
+
+
+def test_budget_left():
+    budget = TimeBudget(60)
+    assert 0 < budget.remaining() <= 60
+    budget.check()
+
+
+def test_budget_run_out():
+    budget = TimeBudget(10, started=time.time() - 20, name='job')
+    assert budget.remaining() < 0
+    with pytest.raises(BudgetExceeded) as e:
+        budget.check()
+    assert 'job' in str(e.value)
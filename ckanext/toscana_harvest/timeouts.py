@@ -0,0 +1,101 @@
+'''
+Timeouts of the requests to the remotes and time budgets of the jobs.
+
+Every request sent to a remote (see ckanext.toscana_harvest.transport)
+gives up after `connect` seconds without a connection and after `read`
+seconds without the whole response (for dumps, without any data). The
+defaults can be changed with the `timeouts` key of
+the source configuration, which can also set time budgets:
+
+    "timeouts": {"connect": 10, "read": 60, "gather": 7200, "job": 21600}
+
+A gather that has been running for `gather` seconds stops, records a gather
+error and hands over the harvest objects it has created so far. Once `job`
+seconds have gone by since the gather of a job started, its remaining
+harvest objects are not fetched or imported but get an object error
+instead. Neither budget is set by default.
+'''
+import datetime
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'connect': 10,
+    'read': 60,
+}
+BUDGETS = ('gather', 'job')
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def validate_config(value):
+    if not isinstance(value, dict):
+        raise ValueError('timeouts must be a dictionary')
+    for key in list(DEFAULTS) + list(BUDGETS):
+        if key not in value:
+            continue
+        try:
+            if float(value[key]) <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValueError('timeouts %s must be a positive number' % key)
+
+
+def settings(config):
+    return dict(DEFAULTS, **(config or {}).get('timeouts', {}))
+
+
+class TimeBudget(object):
+    '''
+    Time left to a stage of a job. `seconds` may be None for no limit.
+    '''
+
+    def __init__(self, seconds, started=None, name='gather'):
+        self.name = name
+        self.deadline = None
+        if seconds:
+            self.seconds = float(seconds)
+            self.deadline = (started or time.time()) + self.seconds
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check(self):
+        '''
+        Raises BudgetExceeded once the budget has run out.
+        '''
+        if self.deadline is not None and time.time() > self.deadline:
+            raise BudgetExceeded('The %s time budget of %d seconds has run '
+                                 'out' % (self.name, self.seconds))
+
+
+def gather_budget(config, harvest_job):
+    '''
+    Returns the TimeBudget of a gather, which is the `gather` budget or
+    what is left of the `job` budget, whichever runs out first.
+    '''
+    timeouts = (config or {}).get('timeouts', {})
+    budget = TimeBudget(timeouts.get('gather'), name='gather')
+    job = job_budget(config, harvest_job)
+    if job.deadline is not None and (budget.deadline is None or
+                                     job.deadline < budget.deadline):
+        return job
+    return budget
+
+
+def job_budget(config, harvest_job):
+    '''
+    Returns the TimeBudget of a job, counted from the start of its gather.
+    '''
+    seconds = (config or {}).get('timeouts', {}).get('job')
+    started = harvest_job.gather_started or harvest_job.created
+    if started:
+        started = time.time() - \
+            (datetime.datetime.utcnow() - started).total_seconds()
+    return TimeBudget(seconds, started, name='job')
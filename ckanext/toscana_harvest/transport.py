@@ -0,0 +1,88 @@
+'''
+Shared HTTP connections to the remotes.
+
+Every request the harvesters send to a remote goes through one requests
+Session per process, so the keep-alive connections it opens to a host are
+reused by the following requests, by the threads of a sharded gather and by
+every source harvested in the same process (eg. by `toscana_harvest
+run-many`), instead of connecting again for each request. The timeouts of
+the source (see ckanext.toscana_harvest.timeouts) apply to each request.
+'''
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from ckanext.toscana_harvest.timeouts import DEFAULTS as DEFAULT_TIMEOUTS
+
+import logging
+log = logging.getLogger(__name__)
+
+# Hosts whose connections are kept, and connections kept per host, enough
+# for every shard of a gather
+POOL_HOSTS = 32
+POOL_SIZE = 16
+READ_CHUNK_SIZE = 64 * 1024
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def reset():
+    '''
+    Forgets the connections of the process without closing them, for a
+    forked process that must not share the ones of its parent.
+    '''
+    global _session
+    _session = None
+
+
+def open_url(url, headers=None, timeouts=None):
+    '''
+    Sends a GET request and returns the streamed response, which has to be
+    closed to give the connection back. Raises requests.HTTPError for error
+    statuses.
+    '''
+    timeouts = timeouts or DEFAULT_TIMEOUTS
+    response = get_session().get(
+        url, headers=headers, stream=True,
+        timeout=(float(timeouts['connect']), float(timeouts['read'])))
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    return response
+
+
+def get_content(url, headers=None, timeouts=None):
+    '''
+    Returns the body of a GET request, raising requests.ReadTimeout if it is
+    not read in full within the `read` timeout.
+    '''
+    timeouts = timeouts or DEFAULT_TIMEOUTS
+    response = open_url(url, headers, timeouts)
+    deadline = time.time() + float(timeouts['read'])
+    chunks = []
+    try:
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            chunks.append(chunk)
+            if time.time() > deadline:
+                raise requests.ReadTimeout('Response of %s not read within '
+                                           '%ss' % (url, timeouts['read']))
+    finally:
+        response.close()
+    return b''.join(chunks)